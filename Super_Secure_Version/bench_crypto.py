@@ -0,0 +1,192 @@
+# bench_crypto.py - Microbenchmarks for the crypto primitives
+"""
+Times the crypto operations the server and clients run per login and per message:
+encrypt/decrypt on the rsa, hybrid and x25519 paths across payload sizes, key
+generation and signing/verification for both key suites, scrypt password hashing at several cost settings and the
+challenge response. Results are written as JSON so runs from different commits
+can be compared.
+
+Examples:
+    python bench_crypto.py --out before.json
+    python bench_crypto.py --out after.json --compare before.json
+    python bench_crypto.py --filter hybrid --min-time 2
+"""
+import argparse
+import base64
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+from crypto.key_management import generate_key_pair, load_private_keys, SUITE_RSA, SUITE_X25519
+from crypto.encryption import encrypt_message, decrypt_message, RSA_MAX_BYTES
+from crypto.password import secure_password_hash, verify_password
+from crypto.signatures import sign_message, verify_signature, SignatureVerifier
+from hash_utils import generate_salt, hash_password, compute_challenge_response
+
+# Payload sizes in bytes. The rsa path tops out at RSA_MAX_BYTES, anything bigger goes hybrid.
+RSA_SIZES = [16, 64, RSA_MAX_BYTES]
+HYBRID_SIZES = [RSA_MAX_BYTES + 1, 1024, 16 * 1024, 256 * 1024]
+SIGN_SIZES = [64, 1024, 16 * 1024]
+VERIFY_BATCH = 256
+SCRYPT_PARAMS = [(2 ** 14, 8, 1), (2 ** 15, 8, 1), (2 ** 16, 8, 1), (2 ** 14, 8, 2)]
+
+def measure(fn, min_time: float, min_iterations: int, max_iterations: int) -> list:
+    """Call fn repeatedly and return per-call times in nanoseconds"""
+    fn()  # warm up
+    samples = []
+    started = time.perf_counter()
+    while len(samples) < max_iterations and (len(samples) < min_iterations or time.perf_counter() - started < min_time):
+        t0 = time.perf_counter_ns()
+        fn()
+        samples.append(time.perf_counter_ns() - t0)
+    return samples
+
+def summarize(name: str, params: dict, samples: list) -> dict:
+    """Turn raw samples into one result row"""
+    ordered = sorted(samples)
+    mean = statistics.fmean(ordered)
+    return {
+        "name": name,
+        "params": params,
+        "iterations": len(ordered),
+        "mean_us": mean / 1000,
+        "median_us": statistics.median(ordered) / 1000,
+        "p95_us": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] / 1000,
+        "stdev_us": (statistics.stdev(ordered) if len(ordered) > 1 else 0.0) / 1000,
+        "ops_per_s": 1e9 / mean if mean else float("inf"),
+    }
+
+def cases():
+    """Yield (name, params, fn, max_iterations) for every benchmark"""
+    # Private keys are loaded once, as SecureMessaging does, so only the operation is timed
+    private_pem, public_key = generate_key_pair(SUITE_RSA)
+    private_key = load_private_keys(private_pem)
+
+    for method, sizes in (("rsa", RSA_SIZES), ("hybrid", HYBRID_SIZES)):
+        for size in sizes:
+            message = "x" * size
+            ciphertext = encrypt_message(message, public_key)
+            assert json.loads(ciphertext)["method"].startswith(method)
+            yield f"encrypt_message.{method}", {"bytes": size}, lambda m=message: encrypt_message(m, public_key), 100000
+            yield f"decrypt_message.{method}", {"bytes": size}, lambda c=ciphertext: decrypt_message(c, private_key), 100000
+
+    yield "generate_key_pair", {"bits": 2048}, lambda: generate_key_pair(SUITE_RSA), 50
+
+    for size in SIGN_SIZES:
+        message = "x" * size
+        signature = sign_message(message, private_key)
+        yield "sign_message", {"bytes": size}, lambda m=message: sign_message(m, private_key), 100000
+        yield "verify_signature", {"bytes": size}, lambda m=message, s=signature: verify_signature(m, s, public_key), 100000
+
+    # Same operations with an X25519/Ed25519 key
+    x_private_pem, x_public = generate_key_pair(SUITE_X25519)
+    x_private = load_private_keys(x_private_pem)
+    for size in RSA_SIZES + HYBRID_SIZES:
+        message = "x" * size
+        ciphertext = encrypt_message(message, x_public)
+        yield "encrypt_message.x25519", {"bytes": size}, lambda m=message: encrypt_message(m, x_public), 100000
+        yield "decrypt_message.x25519", {"bytes": size}, lambda c=ciphertext: decrypt_message(c, x_private), 100000
+
+    yield "generate_key_pair", {"suite": SUITE_X25519}, lambda: generate_key_pair(SUITE_X25519), 10000
+
+    for size in SIGN_SIZES:
+        message = "x" * size
+        signature = sign_message(message, x_private)
+        params = {"bytes": size, "suite": SUITE_X25519}
+        yield "sign_message", params, lambda m=message: sign_message(m, x_private), 100000
+        yield "verify_signature", params, lambda m=message, s=signature: verify_signature(m, s, x_public), 100000
+
+    # A backlog of signed messages from a few senders, checked in one call
+    backlog = [(f"user{i % 8}", x_public, f"message {i}", sign_message(f"message {i}", x_private)) for i in range(VERIFY_BATCH)]
+    verifier = SignatureVerifier()
+    yield "SignatureVerifier.verify_many", {"messages": VERIFY_BATCH, "workers": verifier.workers}, lambda: verifier.verify_many(backlog), 1000
+
+    salt = generate_salt()
+    for n, r, p in SCRYPT_PARAMS:
+        yield "hash_password", {"n": n, "r": r, "p": p}, lambda n=n, r=r, p=p: hash_password("correct horse", salt, n=n, r=r, p=p), 200
+
+    for n, r, p in SCRYPT_PARAMS:
+        stored = secure_password_hash("correct horse", n=n, r=r, p=p)
+        yield "verify_password", {"n": n, "r": r, "p": p}, lambda s=stored: verify_password(s, "correct horse"), 200
+
+    password_hash = hash_password("correct horse", salt)
+    challenge = base64.b64encode(os.urandom(32)).decode()
+    yield "compute_challenge_response", {}, lambda: compute_challenge_response(password_hash, challenge), 1000000
+
+def environment() -> dict:
+    """Where and on what the numbers were taken"""
+    try:
+        import cryptography
+        crypto_version = cryptography.__version__
+    except ImportError:
+        crypto_version = None
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "cryptography": crypto_version,
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "system": platform.platform(),
+        "commit": commit,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+
+def result_key(result: dict) -> str:
+    """Identify a result across runs"""
+    return result["name"] + json.dumps(result["params"], sort_keys=True)
+
+def compare(current: list, baseline_path: str) -> None:
+    """Print the change in median time against a previous run"""
+    with open(baseline_path) as f:
+        baseline = {result_key(r): r for r in json.load(f)["results"]}
+
+    print(f"\n{'benchmark':<45} {'before us':>12} {'after us':>12} {'change':>9}", file=sys.stderr)
+    for result in current:
+        before = baseline.get(result_key(result))
+        if before is None:
+            continue
+        change = (result["median_us"] - before["median_us"]) / before["median_us"] * 100
+        label = result["name"] + " " + ",".join(f"{k}={v}" for k, v in result["params"].items())
+        print(f"{label:<45} {before['median_us']:>12.1f} {result['median_us']:>12.1f} {change:>+8.1f}%", file=sys.stderr)
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark the crypto primitives")
+    parser.add_argument("--out", help="write results as JSON to this file (default: stdout)")
+    parser.add_argument("--compare", help="previous JSON output to compare against")
+    parser.add_argument("--filter", default="", help="only run benchmarks whose name contains this")
+    parser.add_argument("--min-time", type=float, default=0.5, help="seconds to spend per benchmark")
+    parser.add_argument("--min-iterations", type=int, default=5)
+    args = parser.parse_args()
+
+    results = []
+    for name, params, fn, max_iterations in cases():
+        if args.filter not in name:
+            continue
+        samples = measure(fn, args.min_time, args.min_iterations, max_iterations)
+        result = summarize(name, params, samples)
+        results.append(result)
+        label = name + " " + ",".join(f"{k}={v}" for k, v in params.items())
+        print(f"{label:<45} {result['median_us']:>12.1f} us  ({result['iterations']} runs)", file=sys.stderr)
+
+    report = {"environment": environment(), "results": results}
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+    if args.compare:
+        compare(results, args.compare)
+
+if __name__ == "__main__":
+    main()
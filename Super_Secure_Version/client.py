@@ -60,7 +60,7 @@ async def main():
             
             # Generate key pair
             print("Generating key pair...")
-            private_key, public_key = generate_key_pair()
+            private_key, public_key = await asyncio.to_thread(generate_key_pair)
             
             # Save keys
             os.makedirs("keys", exist_ok=True)
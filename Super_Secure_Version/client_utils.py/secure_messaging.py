@@ -1,32 +1,158 @@
 import asyncio
+import codecs
+import itertools
 import json
 import sys
 import os
+from collections import OrderedDict, deque
 
 # Add parent directory to path so we can import crypto modules
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from crypto.key_management import generate_key_pair, save_keys_to_file, load_private_key, load_public_key
+from crypto.key_management import generate_key_pair, save_keys_to_file, load_private_key, load_private_keys, load_public_key, key_fingerprint
+from crypto.key_store import KeyStore
 from crypto.encryption import encrypt_message, decrypt_message
+from crypto.signatures import sign_message, SignatureVerifier
+
+KEY_CACHE_SIZE = 1024  # Other users' public keys kept in memory
+SIGNED_ENVELOPE = '{"signed": 1, '  # How a signed message's plaintext starts
+MAX_FRAME = 1024 * 1024  # Largest frame waited for before the stream counts as garbage
+
+def signed_payload(sender, recipient, text):
+    """What a signed message's signature covers, so it can't be replayed as from or to someone else"""
+    return f"{sender}\n{recipient}\n{text}"
+
+class KeyCache(OrderedDict):
+    """
+    Bounded LRU of username -> public key PEM, remembering each key's fingerprint.
+    With a KeyStore behind it, misses are filled from disk and new keys are written
+    through, so the cache starts warm after a restart.
+    """
+    def __init__(self, maxsize=KEY_CACHE_SIZE, store=None):
+        super().__init__()
+        self.maxsize = maxsize
+        self.store = store
+        self.fingerprints = {}
+
+    def _remember(self, username, key, fingerprint):
+        super().__setitem__(username, key)
+        self.move_to_end(username)
+        self.fingerprints[username] = fingerprint
+        while len(self) > self.maxsize:
+            evicted, _ = self.popitem(last=False)
+            self.fingerprints.pop(evicted, None)
+
+    def __contains__(self, username):
+        if super().__contains__(username):
+            return True
+        if self.store is None or username not in self.store:
+            return False
+        key = self.store.get(username)
+        if key is None:
+            return False
+        self._remember(username, key, self.store.fingerprint(username))
+        return True
+
+    def __getitem__(self, username):
+        if not self.__contains__(username):
+            raise KeyError(username)
+        key = super().__getitem__(username)
+        self.move_to_end(username)
+        return key
+
+    def __setitem__(self, username, key):
+        self._remember(username, key, key_fingerprint(key))
+        if self.store is not None:
+            self.store.put(username, key)
+
+    def __delitem__(self, username):
+        if super().__contains__(username):
+            super().__delitem__(username)
+        self.fingerprints.pop(username, None)
+        if self.store is not None:
+            self.store.discard(username)
+
+    def validate(self, username, fingerprint):
+        """Drop a cached key that no longer matches the server's fingerprint. True if still valid."""
+        if username not in self or fingerprint is None:
+            return True
+        if self.fingerprints.get(username) == fingerprint:
+            return True
+        del self[username]
+        return False
+
+    def close(self):
+        if self.store is not None:
+            self.store.close()
+            self.store = None
 
 class SecureMessaging:
-    def __init__(self, username, reader, writer):
+    """
+    Keys and encryption for one user. With sign_messages on, outbound messages are
+    signed with the user's private key before they are encrypted (the signature
+    travels inside the ciphertext), and open_message() tells signed messages apart
+    so the receiver can check them with verify_opened().
+    
+    Requests to the server are tagged commands. If the owner of the connection runs
+    its own reader, it sets command to a coroutine that sends one and returns the
+    reply. Otherwise the request reads frames here until its reply comes back, and
+    the frames that arrive in the meantime (chat messages, offers) are kept in inbox.
+    """
+    def __init__(self, username, reader, writer, sign_messages=False):
         self.username = username
         self.reader = reader
         self.writer = writer
-        self.private_key = None
+        self._private_key = None
+        self._private_keys = None  # The private key loaded once, see private_keys
         self.public_key = None
-        self.public_keys_cache = {}  # Cache for other users' public keys
+        self.public_keys_cache = KeyCache()  # Cache for other users' public keys
+        self.sign_messages = sign_messages
+        self.verifier = SignatureVerifier()
+        self.command = None  # async (text) -> reply, when the owner reads the socket
+        self.inbox = deque()  # (code, msg, id) frames read while waiting for a reply
+        self._ids = itertools.count(1)
+        self._buffer = ""
+        self._utf8 = codecs.getincrementaldecoder("utf-8")()
+        self._decoder = json.JSONDecoder()
+    
+    @property
+    def private_key(self):
+        return self._private_key
+    
+    @private_key.setter
+    def private_key(self, private_key):
+        self._private_key = private_key
+        self._private_keys = None
+    
+    @property
+    def private_keys(self):
+        """The private key loaded (load_private_keys), kept for this user only and loaded once."""
+        if self._private_keys is None and self._private_key:
+            self._private_keys = load_private_keys(self._private_key)
+        return self._private_keys
     
-    async def initialize_keys(self):
-        """Initialize encryption keys for this client."""
+    def close(self):
+        """Release the key store and the verifier's threads."""
+        self.public_keys_cache.close()
+        self.verifier.close()
+    
+    def use_key_store(self, path="."):
+        """Back the key cache with keys/<username>_contacts.keys so it survives restarts."""
+        self.public_keys_cache.close()
+        self.public_keys_cache = KeyCache(store=KeyStore(self.username, path))
+    
+    async def initialize_keys(self, key_pool=None):
+        """Initialize encryption keys for this client, taking a new pair from key_pool if given."""
         # Check if keys already exist
         private_key = load_private_key(self.username)
         public_key = load_public_key(self.username)
         
         # If keys don't exist, generate them
         if not private_key or not public_key:
-            private_key, public_key = generate_key_pair()
+            if key_pool is not None:
+                private_key, public_key = await key_pool.take_async()
+            else:
+                private_key, public_key = await asyncio.to_thread(generate_key_pair)
             save_keys_to_file(self.username, private_key, public_key)
             
             # Upload public key to server
@@ -34,6 +160,7 @@ class SecureMessaging:
         
         self.private_key = private_key
         self.public_key = public_key
+        self.use_key_store()
     
     async def upload_public_key(self, public_key):
         """Upload the public key to the server."""
@@ -49,14 +176,19 @@ class SecureMessaging:
             return self.public_keys_cache[recipient_username]
         
         # Request public key from server
-        self.writer.write(f"GETKEY {recipient_username}".encode())
-        await self.writer.drain()
-        
-        # Wait for response
-        data = await self.reader.read(4096)  # Public keys can be large
-        response = data.decode()
+        try:
+            if self.command is not None:
+                response = await self.command(f"GETKEY {recipient_username}")
+            else:
+                code, response = await self.request(f"GETKEY {recipient_username}")
+                if code != "SUCCESS":
+                    return None
+        except (ConnectionError, asyncio.TimeoutError):
+            raise
+        except Exception:
+            return None
         
-        # Parse response (format: "KEY <username> <base64-encoded-key>")
+        # Parse response (format: "KEY <username> <PEM-encoded-key>")
         if response.startswith("KEY "):
             parts = response.split(" ", 2)
             if len(parts) == 3 and parts[1] == recipient_username:
@@ -67,6 +199,50 @@ class SecureMessaging:
         
         return None
     
+    async def request(self, text):
+        """
+        Send a tagged command and read frames until the reply carrying its id.
+        Returns (code, msg). Every other frame read on the way goes to inbox.
+        """
+        request_id = str(next(self._ids))
+        payload = text.encode()
+        self.writer.write(f"#{request_id}:{len(payload)} ".encode() + payload)
+        await self.writer.drain()
+        
+        reply = None
+        while reply is None:
+            for code, message, frame_id in self._split():
+                if reply is None and frame_id == request_id:
+                    reply = code, message
+                else:
+                    self.inbox.append((code, message, frame_id))
+            if reply is None:
+                data = await self.reader.read(4096)
+                if not data:
+                    raise ConnectionError("Connection closed while waiting for a reply")
+                self._buffer += self._utf8.decode(data)
+        return reply
+    
+    def _split(self):
+        """Take every complete frame off the read buffer as (code, msg, id)"""
+        frames = []
+        pos = 0
+        while pos < len(self._buffer):
+            try:
+                fields, end = self._decoder.raw_decode(self._buffer, pos)
+            except ValueError:
+                # Not all here yet
+                if len(self._buffer) - pos > MAX_FRAME:
+                    raise ConnectionError("Malformed frame from server")
+                break
+            if (not isinstance(fields, dict) or not isinstance(fields.get("code"), str)
+                    or not isinstance(fields.get("msg"), str)):
+                raise ConnectionError("Malformed frame from server")
+            frames.append((fields["code"], fields["msg"], fields.get("id")))
+            pos = end
+        self._buffer = self._buffer[pos:]
+        return frames
+    
     async def send_encrypted_message(self, message, recipient_username):
         """Encrypt and send a message to another user."""
         # Get recipient's public key
@@ -76,7 +252,7 @@ class SecureMessaging:
             return False, "Could not get recipient's public key"
         
         # Encrypt the message
-        encrypted_message = encrypt_message(message, recipient_public_key)
+        encrypted_message = self.seal_message(message, recipient_username, recipient_public_key)
         
         # Send the encrypted message
         self.writer.write(f"SEND {encrypted_message} TO {recipient_username}".encode())
@@ -84,9 +260,41 @@ class SecureMessaging:
         
         return True, "Message sent"
     
+    def seal_message(self, message, recipient_username, recipient_public_key):
+        """Encrypt a message for a recipient, signing it first if sign_messages is on."""
+        if self.sign_messages:
+            signature = sign_message(signed_payload(self.username, recipient_username, message), self.private_keys)
+            message = json.dumps({"signed": 1, "text": message, "sig": signature})
+        return encrypt_message(message, recipient_public_key)
+    
+    def open_message(self, encrypted_message):
+        """
+        Decrypt a received message. Returns (text, signature), where signature is None
+        for an unsigned message. Check a signature with verify_opened().
+        """
+        text = self.decrypt_received_message(encrypted_message)
+        if not text.startswith(SIGNED_ENVELOPE):
+            return text, None
+        try:
+            envelope = json.loads(text)
+            return envelope["text"], envelope["sig"]
+        except (ValueError, KeyError, TypeError):
+            return text, None
+    
+    def verify_opened(self, opened):
+        """
+        Check (sender, sender_public_key, text, signature) tuples from open_message,
+        returns whether each is the sender's signature of that text sent to us. A
+        backlog is spread over the verifier's thread pool.
+        """
+        return self.verifier.verify_many(
+            (sender, public_key, signed_payload(sender, self.username, text), signature)
+            for sender, public_key, text, signature in opened
+        )
+    
     def decrypt_received_message(self, encrypted_message):
         """Decrypt a received message."""
         try:
-            return decrypt_message(encrypted_message, self.private_key)
+            return decrypt_message(encrypted_message, self.private_keys)
         except Exception as e:
             return f"Error decrypting message: {e}"
\ No newline at end of file
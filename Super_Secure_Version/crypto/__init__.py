@@ -1,10 +1,13 @@
 # crypto/__init__.py
 
 # Import key functions from submodules to make them available directly from the crypto package
-from .key_management import generate_key_pair, save_keys_to_file, load_private_key, load_public_key
+from .key_management import generate_key_pair, save_keys_to_file, load_private_key, load_public_key, key_fingerprint, key_suite
+from .key_store import KeyStore
+from .key_pool import KeyPairPool
 from .encryption import encrypt_message, decrypt_message
-from .password import secure_password_hash, verify_password
-from .signatures import sign_message, verify_signature
+from .stream import encrypt_stream, decrypt_stream, new_stream_key, seal_stream_key, open_stream_key
+from .password import secure_password_hash, verify_password, needs_rehash, tune_scrypt
+from .signatures import sign_message, verify_signature, SignatureVerifier
 
 # You can define what gets exported when using "from crypto import *"
 __all__ = [
@@ -12,10 +15,22 @@ __all__ = [
     'save_keys_to_file',
     'load_private_key',
     'load_public_key',
+    'key_fingerprint',
+    'key_suite',
+    'KeyStore',
+    'KeyPairPool',
     'encrypt_message',
     'decrypt_message',
+    'encrypt_stream',
+    'decrypt_stream',
+    'new_stream_key',
+    'seal_stream_key',
+    'open_stream_key',
     'secure_password_hash',
     'verify_password',
+    'needs_rehash',
+    'tune_scrypt',
     'sign_message',
-    'verify_signature'
+    'verify_signature',
+    'SignatureVerifier'
 ]
\ No newline at end of file
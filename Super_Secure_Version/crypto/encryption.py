@@ -1,21 +1,31 @@
 import os
 import json
 import base64
-from cryptography.hazmat.primitives.asymmetric import padding
+from cryptography.hazmat.primitives.asymmetric import padding, x25519
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from cryptography.hazmat.primitives import hashes, serialization
+from .key_management import load_public_keys, load_private_keys, SUITE_X25519
 
 # Maximum bytes that can be encrypted with RSA-2048 using OAEP padding with SHA-256
 RSA_MAX_BYTES = 190
 
+# HKDF context for the X25519 suite. Bump the version if the construction changes.
+X25519_INFO = b"secure-texting x25519-aesgcm v1"
+
 def encrypt_message(message, recipient_public_key_pem):
     """
     Encrypt a message for a recipient using their public key.
-    Automatically chooses between direct RSA or hybrid encryption based on message size.
+    X25519 keys always use X25519 + AES-GCM. For RSA keys it chooses between direct
+    RSA or hybrid encryption based on message size.
     """
     # Convert message to bytes
     message_bytes = message.encode('utf-8')
     
+    if load_public_keys(recipient_public_key_pem)[0] == SUITE_X25519:
+        return encrypt_with_x25519(message_bytes, recipient_public_key_pem)
+    
     # For small messages, use RSA directly
     if len(message_bytes) <= RSA_MAX_BYTES:
         return encrypt_with_rsa(message_bytes, recipient_public_key_pem)
@@ -26,7 +36,7 @@ def encrypt_message(message, recipient_public_key_pem):
 def encrypt_with_rsa(message_bytes, recipient_public_key_pem):
     """Encrypt small messages directly with RSA."""
     # Load recipient's public key
-    recipient_key = serialization.load_pem_public_key(recipient_public_key_pem)
+    recipient_key = load_public_keys(recipient_public_key_pem)[1]
     
     # Encrypt the message
     encrypted = recipient_key.encrypt(
@@ -45,20 +55,18 @@ def encrypt_with_rsa(message_bytes, recipient_public_key_pem):
     })
 
 def encrypt_with_hybrid(message_bytes, recipient_public_key_pem):
-    """Encrypt larger messages with AES + RSA."""
+    """Encrypt larger messages with AES-GCM + RSA."""
     # Generate a random AES key
     aes_key = os.urandom(32)  # 256-bit key
     
-    # Generate random IV
-    iv = os.urandom(16)
+    # Generate random nonce
+    nonce = os.urandom(12)
     
-    # Encrypt the message with AES
-    cipher = Cipher(algorithms.AES(aes_key), modes.CFB(iv))
-    encryptor = cipher.encryptor()
-    encrypted_message = encryptor.update(message_bytes) + encryptor.finalize()
+    # Encrypt and authenticate the message with AES-GCM (one call, no concatenation)
+    encrypted_message = AESGCM(aes_key).encrypt(nonce, message_bytes, None)
     
     # Encrypt the AES key with RSA
-    recipient_key = serialization.load_pem_public_key(recipient_public_key_pem)
+    recipient_key = load_public_keys(recipient_public_key_pem)[1]
     encrypted_key = recipient_key.encrypt(
         aes_key,
         padding.OAEP(
@@ -70,23 +78,61 @@ def encrypt_with_hybrid(message_bytes, recipient_public_key_pem):
     
     # Return everything as a JSON object
     return json.dumps({
-        "method": "hybrid",
+        "method": "hybrid-gcm",
         "encrypted_key": base64.b64encode(encrypted_key).decode('utf-8'),
-        "iv": base64.b64encode(iv).decode('utf-8'),
+        "nonce": base64.b64encode(nonce).decode('utf-8'),
         "data": base64.b64encode(encrypted_message).decode('utf-8')
     })
 
+def x25519_key(shared_secret, ephemeral_public, recipient_public):
+    """AES-256 key for one message, bound to both public keys"""
+    return HKDF(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=None,
+        info=X25519_INFO + ephemeral_public + recipient_public
+    ).derive(shared_secret)
+
+def raw_public_bytes(public_key):
+    return public_key.public_bytes(encoding=serialization.Encoding.Raw, format=serialization.PublicFormat.Raw)
+
+def encrypt_with_x25519(message_bytes, recipient_public_key_pem):
+    """Encrypt with an ephemeral X25519 key agreement and AES-GCM (ECIES style)."""
+    recipient_key = load_public_keys(recipient_public_key_pem)[1]
+    ephemeral = x25519.X25519PrivateKey.generate()
+    ephemeral_public = raw_public_bytes(ephemeral.public_key())
+    
+    key = x25519_key(ephemeral.exchange(recipient_key), ephemeral_public, raw_public_bytes(recipient_key))
+    nonce = os.urandom(12)
+    encrypted = AESGCM(key).encrypt(nonce, message_bytes, None)
+    
+    return json.dumps({
+        "method": "x25519",
+        "epk": base64.b64encode(ephemeral_public).decode('utf-8'),
+        "nonce": base64.b64encode(nonce).decode('utf-8'),
+        "data": base64.b64encode(encrypted).decode('utf-8')
+    })
+
 def decrypt_message(encrypted_data_json, private_key_pem):
-    """Decrypt a message using the recipient's private key."""
+    """Decrypt a message using the recipient's private key (PEM, or a load_private_keys tuple)."""
     # Parse the JSON data
     encrypted_data = json.loads(encrypted_data_json)
     method = encrypted_data["method"]
     
     # Load private key
-    private_key = serialization.load_pem_private_key(
-        private_key_pem,
-        password=None
-    )
+    private_key = load_private_keys(private_key_pem)[1]
+    
+    # X25519 + AES-GCM, the tag check fails if the message was altered
+    if method == "x25519":
+        ephemeral_public = base64.b64decode(encrypted_data["epk"])
+        shared = private_key.exchange(x25519.X25519PublicKey.from_public_bytes(ephemeral_public))
+        key = x25519_key(shared, ephemeral_public, raw_public_bytes(private_key.public_key()))
+        decrypted = AESGCM(key).decrypt(
+            base64.b64decode(encrypted_data["nonce"]),
+            base64.b64decode(encrypted_data["data"]),
+            None
+        )
+        return decrypted.decode('utf-8')
     
     # If RSA was used directly
     if method == "rsa":
@@ -101,8 +147,8 @@ def decrypt_message(encrypted_data_json, private_key_pem):
         )
         return decrypted.decode('utf-8')
     
-    # If hybrid encryption was used
-    elif method == "hybrid":
+    # If hybrid encryption was used (AES-GCM, or AES-CFB from older clients)
+    elif method in ("hybrid-gcm", "hybrid"):
         # Decrypt the AES key
         encrypted_key = base64.b64decode(encrypted_data["encrypted_key"])
         aes_key = private_key.decrypt(
@@ -115,9 +161,12 @@ def decrypt_message(encrypted_data_json, private_key_pem):
         )
         
         # Decrypt the message with the AES key
-        iv = base64.b64decode(encrypted_data["iv"])
         encrypted_message = base64.b64decode(encrypted_data["data"])
+        if method == "hybrid-gcm":
+            nonce = base64.b64decode(encrypted_data["nonce"])
+            return AESGCM(aes_key).decrypt(nonce, encrypted_message, None).decode('utf-8')
         
+        iv = base64.b64decode(encrypted_data["iv"])
         cipher = Cipher(algorithms.AES(aes_key), modes.CFB(iv))
         decryptor = cipher.decryptor()
         decrypted = decryptor.update(encrypted_message) + decryptor.finalize()
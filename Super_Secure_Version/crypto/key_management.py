@@ -1,11 +1,25 @@
 import os
 import json
 import base64
-from cryptography.hazmat.primitives.asymmetric import rsa
+import hashlib
+from functools import lru_cache
+from cryptography.hazmat.primitives.asymmetric import rsa, x25519, ed25519
 from cryptography.hazmat.primitives import serialization
 
-def generate_key_pair():
-    """Generate a new RSA key pair for a user."""
+# Key suites. The suite of a user's key decides how messages to them are encrypted and
+# how their signatures are checked, so RSA users keep working next to X25519 ones.
+SUITE_RSA = "rsa2048"            # RSA-2048, OAEP encryption and PSS signatures
+SUITE_X25519 = "x25519-ed25519"  # X25519 + AES-GCM encryption, Ed25519 signatures
+SUITES = (SUITE_RSA, SUITE_X25519)
+DEFAULT_SUITE = SUITE_RSA        # Suite for newly generated keys, X25519 is opt-in
+
+def generate_key_pair(suite=DEFAULT_SUITE):
+    """Generate a new key pair for a user in the given suite, as (private_pem, public_pem)."""
+    if suite == SUITE_X25519:
+        return generate_x25519_key_pair()
+    if suite != SUITE_RSA:
+        raise ValueError(f"Unknown key suite: {suite}")
+
     private_key = rsa.generate_private_key(
         public_exponent=65537,
         key_size=2048
@@ -27,6 +41,77 @@ def generate_key_pair():
     
     return private_pem, public_pem
 
+def generate_x25519_key_pair():
+    """
+    An X25519 key (encryption) and an Ed25519 key (signing) for one user. Each side of
+    the pair is two PEM blocks back to back, the X25519 one first.
+    """
+    keys = [x25519.X25519PrivateKey.generate(), ed25519.Ed25519PrivateKey.generate()]
+    private_pem = b"".join(
+        key.private_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PrivateFormat.PKCS8,
+            encryption_algorithm=serialization.NoEncryption()
+        )
+        for key in keys
+    )
+    public_pem = b"".join(
+        key.public_key().public_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PublicFormat.SubjectPublicKeyInfo
+        )
+        for key in keys
+    )
+    return private_pem, public_pem
+
+def pem_blocks(pem):
+    """Split PEM text holding one or more keys into its blocks"""
+    if isinstance(pem, str):
+        pem = pem.encode()
+    blocks = []
+    for part in pem.strip().split(b"-----BEGIN ")[1:]:
+        blocks.append(b"-----BEGIN " + part.strip() + b"\n")
+    return blocks
+
+@lru_cache(maxsize=1024)
+def load_public_keys(public_key_pem):
+    """(suite, encryption key, verification key) of a public PEM. Cached, loading RSA keys is slow."""
+    blocks = pem_blocks(public_key_pem)
+    first = serialization.load_pem_public_key(blocks[0])
+    if isinstance(first, x25519.X25519PublicKey):
+        if len(blocks) < 2:
+            raise ValueError("X25519 public key without its Ed25519 signing key")
+        return SUITE_X25519, first, serialization.load_pem_public_key(blocks[1])
+    return SUITE_RSA, first, first
+
+def load_private_keys(private_key_pem):
+    """
+    (suite, decryption key, signing key) of a private PEM. Not cached, so private keys
+    don't outlive their owner: code that uses one key repeatedly loads it once and passes
+    the tuple instead of the PEM, which is returned as is.
+    """
+    if isinstance(private_key_pem, tuple):
+        return private_key_pem
+    blocks = pem_blocks(private_key_pem)
+    first = serialization.load_pem_private_key(blocks[0], password=None)
+    if isinstance(first, x25519.X25519PrivateKey):
+        if len(blocks) < 2:
+            raise ValueError("X25519 private key without its Ed25519 signing key")
+        return SUITE_X25519, first, serialization.load_pem_private_key(blocks[1], password=None)
+    return SUITE_RSA, first, first
+
+def key_suite(public_key_pem):
+    """Which suite a public key belongs to"""
+    if isinstance(public_key_pem, str):
+        public_key_pem = public_key_pem.encode()
+    return load_public_keys(public_key_pem)[0]
+
+def key_fingerprint(public_key):
+    """SHA-256 fingerprint (hex) of a PEM public key, computed the same way by client and server."""
+    if isinstance(public_key, str):
+        public_key = public_key.encode()
+    return hashlib.sha256(public_key.strip()).hexdigest()
+
 def save_keys_to_file(username, private_key, public_key, path="."):
     """Save a user's key pair to files (client-side)."""
     # Create directory if it doesn't exist
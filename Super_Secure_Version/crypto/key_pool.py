@@ -0,0 +1,77 @@
+import asyncio
+import os
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from .key_management import generate_key_pair, DEFAULT_SUITE
+
+# Key pairs generated ahead of demand
+DEFAULT_POOL_SIZE = 8
+
+class KeyPairPool:
+    """
+    Keeps `size` key pairs of one suite generating or ready in a process pool, so
+    taking one costs nothing when the pool has caught up. Every pair taken is
+    replaced right away, so the pool stays full while there is demand. The worker
+    processes are started on first use.
+    """
+    def __init__(self, size=DEFAULT_POOL_SIZE, workers=None, suite=DEFAULT_SUITE):
+        self.size = max(1, size)
+        self.suite = suite
+        self.workers = workers or min(self.size, os.cpu_count() or 1)
+        self.taken = 0
+        self.waited = 0
+        self._executor = None
+        self._pending = deque()
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Start the workers and begin filling the pool. Safe to call more than once."""
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+                self._fill()
+        return self
+
+    def _fill(self):
+        while len(self._pending) < self.size:
+            self._pending.append(self._executor.submit(generate_key_pair, self.suite))
+
+    def _next(self):
+        self.start()
+        with self._lock:
+            future = self._pending.popleft()
+            self._fill()
+            self.taken += 1
+            if not future.done():
+                self.waited += 1
+        return future
+
+    def take(self):
+        """A fresh (private_pem, public_pem), waiting only if none is ready yet"""
+        return self._next().result()
+
+    async def take_async(self):
+        """take() without blocking the event loop"""
+        return await asyncio.wrap_future(self._next())
+
+    def stats(self):
+        """How full the pool is and how often callers had to wait"""
+        with self._lock:
+            ready = sum(1 for future in self._pending if future.done())
+        return {"size": self.size, "workers": self.workers, "ready": ready, "taken": self.taken, "waited": self.waited}
+
+    def close(self):
+        """Stop the workers, dropping pairs nobody took"""
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+            self._pending.clear()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,197 @@
+import hashlib
+import mmap
+import os
+import struct
+
+# keys/<owner>_contacts.keys holds the records, keys/<owner>_contacts.idx says where each one starts
+STORE_MAGIC = b"CHATKEYS1\n"
+RECORD_HEADER = struct.Struct("<H32sI")   # username length, SHA-256 of the PEM, PEM length (0 = removed)
+INDEX_ENTRY = struct.Struct("<QH")        # record offset, username length
+COMPACT_RATIO = 2                          # Rewrite the file once it is this many times the live data
+
+class KeyStore:
+    """
+    Client-side store of other users' public keys that survives restarts.
+
+    Both files are append-only: storing a key or dropping one appends a record and an
+    index entry, and the last entry for a username wins. The key file is read through
+    mmap, so opening it only loads the small index and a key is read the first time it
+    is used. Every record carries the SHA-256 fingerprint of its PEM, which is checked
+    on read and compared against the fingerprints the server sends.
+    """
+    def __init__(self, owner, path="."):
+        directory = os.path.join(path, "keys")
+        os.makedirs(directory, exist_ok=True)
+        self.data_path = os.path.join(directory, f"{owner}_contacts.keys")
+        self.index_path = os.path.join(directory, f"{owner}_contacts.idx")
+        self.offsets = {}
+        self._map = None
+
+        if not os.path.exists(self.data_path) or os.path.getsize(self.data_path) < len(STORE_MAGIC):
+            with open(self.data_path, "wb") as f:
+                f.write(STORE_MAGIC)
+            open(self.index_path, "wb").close()
+
+        self._data = open(self.data_path, "ab")
+        self._index = open(self.index_path, "ab")
+        self._remap()
+        if self._map[:len(STORE_MAGIC)] != STORE_MAGIC:
+            raise ValueError(f"{self.data_path} is not a key store")
+        self._load_index()
+        if len(self._map) > COMPACT_RATIO * max(self.live_bytes(), 4096):
+            self.compact()
+
+    def _remap(self):
+        if self._map is not None:
+            self._map.close()
+        with open(self.data_path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _load_index(self):
+        """Read the index, then pick up any records written after its last entry (e.g. after a crash)"""
+        with open(self.index_path, "rb") as f:
+            index = f.read()
+
+        end = len(STORE_MAGIC)
+        pos = 0
+        while pos + INDEX_ENTRY.size <= len(index):
+            offset, name_len = INDEX_ENTRY.unpack_from(index, pos)
+            name = index[pos + INDEX_ENTRY.size:pos + INDEX_ENTRY.size + name_len]
+            record_end = self._record_end(offset)
+            if len(name) < name_len or record_end is None:
+                break
+            pos += INDEX_ENTRY.size + name_len
+            self._apply(name.decode(), offset)
+            end = max(end, record_end)
+        if pos < len(index):
+            # Torn entry at the tail, the scan below re-indexes its record if it made it to disk
+            self._index.truncate(pos)
+            self._index.seek(0, os.SEEK_END)
+
+        # Scan the key file past the last indexed record and re-index what is there
+        while True:
+            record_end = self._record_end(end)
+            if record_end is None:
+                break
+            name_len, _, _ = RECORD_HEADER.unpack_from(self._map, end)
+            name = self._map[end + RECORD_HEADER.size:end + RECORD_HEADER.size + name_len].decode()
+            self._apply(name, end)
+            self._index.write(INDEX_ENTRY.pack(end, name_len) + name.encode())
+            end = record_end
+        self._index.flush()
+
+        # Drop a torn record at the tail so later appends line up
+        if end < len(self._map):
+            self._data.truncate(end)
+            self._data.seek(0, os.SEEK_END)
+            self._remap()
+
+    def _header(self, offset):
+        """Record header at offset, remapping first if the record was appended since the last map"""
+        if offset + RECORD_HEADER.size > len(self._map):
+            self._remap()
+        return RECORD_HEADER.unpack_from(self._map, offset)
+
+    def _record_end(self, offset):
+        """Where the record at offset ends, None if it isn't all there"""
+        if offset + RECORD_HEADER.size > len(self._map):
+            return None
+        name_len, _, pem_len = RECORD_HEADER.unpack_from(self._map, offset)
+        end = offset + RECORD_HEADER.size + name_len + pem_len
+        return end if end <= len(self._map) else None
+
+    def _apply(self, username, offset):
+        pem_len = RECORD_HEADER.unpack_from(self._map, offset)[2]
+        if pem_len:
+            self.offsets[username] = offset
+        else:
+            self.offsets.pop(username, None)
+
+    def _append(self, username, pem, digest):
+        name = username.encode()
+        offset = self._data.tell()
+        self._data.write(RECORD_HEADER.pack(len(name), digest, len(pem)) + name + pem)
+        self._data.flush()
+        self._index.write(INDEX_ENTRY.pack(offset, len(name)) + name)
+        self._index.flush()
+        if pem:
+            self.offsets[username] = offset
+        else:
+            self.offsets.pop(username, None)
+
+    def __contains__(self, username):
+        return username in self.offsets
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def fingerprint(self, username):
+        """Hex fingerprint of the stored key, read from the record header only. None if not stored."""
+        offset = self.offsets.get(username)
+        if offset is None:
+            return None
+        return self._header(offset)[1].hex()
+
+    def get(self, username):
+        """The stored PEM, or None if missing or if it no longer matches its fingerprint"""
+        offset = self.offsets.get(username)
+        if offset is None:
+            return None
+        name_len, digest, pem_len = self._header(offset)
+        start = offset + RECORD_HEADER.size + name_len
+        if start + pem_len > len(self._map):
+            self._remap()
+        pem = self._map[start:start + pem_len]
+        if hashlib.sha256(pem.strip()).digest() != digest:
+            self.discard(username)
+            return None
+        return pem
+
+    def put(self, username, pem):
+        """Store a key. Writing the key that is already stored is a no-op."""
+        digest = hashlib.sha256(pem.strip()).digest()
+        if self.fingerprint(username) == digest.hex():
+            return
+        self._append(username, pem, digest)
+
+    def discard(self, username):
+        """Forget a key, e.g. when the server reports a different fingerprint"""
+        if username in self.offsets:
+            self._append(username, b"", bytes(32))
+
+    def live_bytes(self):
+        """Bytes the current keys would take in a freshly written file"""
+        total = len(STORE_MAGIC)
+        for offset in self.offsets.values():
+            name_len, _, pem_len = self._header(offset)
+            total += RECORD_HEADER.size + name_len + pem_len
+        return total
+
+    def compact(self):
+        """Rewrite both files with only the current keys"""
+        records = [(username, self.get(username)) for username in list(self.offsets)]
+        self._data.close()
+        self._index.close()
+        with open(self.data_path + ".tmp", "wb") as data, open(self.index_path + ".tmp", "wb") as index:
+            data.write(STORE_MAGIC)
+            for username, pem in records:
+                if pem is None:
+                    continue
+                name = username.encode()
+                index.write(INDEX_ENTRY.pack(data.tell(), len(name)) + name)
+                data.write(RECORD_HEADER.pack(len(name), hashlib.sha256(pem.strip()).digest(), len(pem)) + name + pem)
+        os.replace(self.data_path + ".tmp", self.data_path)
+        os.replace(self.index_path + ".tmp", self.index_path)
+
+        self._data = open(self.data_path, "ab")
+        self._index = open(self.index_path, "ab")
+        self.offsets = {}
+        self._remap()
+        self._load_index()
+
+    def close(self):
+        self._data.close()
+        self._index.close()
+        if self._map is not None:
+            self._map.close()
+            self._map = None
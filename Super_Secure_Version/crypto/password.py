@@ -1,51 +1,138 @@
 import os
 import hashlib
+import hmac
 import base64
+import time
 
-def secure_password_hash(password):
+# Stored hashes describe how they were made: $scrypt$ln=<log2 n>,r=<r>,p=<p>$<salt>$<hash>,
+# with salt and hash base64 encoded without padding. Hashes from before this format are
+# plain base64 of salt + hash with the old fixed parameters, and still verify.
+ALGORITHM = "scrypt"
+SALT_BYTES = 16
+HASH_BYTES = 32
+LEGACY_PARAMS = {"n": 2 ** 14, "r": 8, "p": 1}
+MAX_MEMORY = 256 * 1024 * 1024   # Largest scrypt working set accepted, from a stored hash or the tuner
+TUNE_TARGET = 0.05               # Seconds per verify tune_scrypt aims for by default
+
+# Parameters new hashes are made with, see set_params() and tune_scrypt()
+params = dict(LEGACY_PARAMS)
+
+def _b64(data):
+    return base64.b64encode(data).decode('utf-8').rstrip("=")
+
+def _unb64(data):
+    return base64.b64decode(data + "=" * (-len(data) % 4))
+
+def scrypt_memory(n, r, p):
+    """Bytes of memory scrypt needs for these parameters"""
+    return 128 * r * (n + p + 2)
+
+def _scrypt(password, salt, n, r, p):
+    return hashlib.scrypt(
+        password.encode(),
+        salt=salt,
+        n=n,      # CPU/memory cost parameter
+        r=r,      # Block size parameter
+        p=p,      # Parallelization parameter
+        maxmem=scrypt_memory(n, r, p) + 1024 * 1024,
+        dklen=HASH_BYTES
+    )
+
+def _check_params(n, r, p):
+    if n < 2 or n & (n - 1) or r < 1 or p < 1:
+        raise ValueError(f"Invalid scrypt parameters n={n}, r={r}, p={p}")
+    if scrypt_memory(n, r, p) > MAX_MEMORY:
+        raise ValueError(f"scrypt parameters n={n}, r={r}, p={p} need more than {MAX_MEMORY} bytes")
+
+def set_params(n, r=8, p=1):
+    """Make new hashes with these scrypt parameters. Existing hashes keep verifying."""
+    _check_params(n, r, p)
+    params.update(n=n, r=r, p=p)
+
+def parse_hash(stored_hash):
+    """(algorithm, {"n", "r", "p"}, salt, hash) of a stored hash. Raises ValueError if malformed."""
+    if not stored_hash.startswith("$"):
+        decoded = base64.b64decode(stored_hash.encode('utf-8'), validate=True)
+        if len(decoded) != SALT_BYTES + HASH_BYTES:
+            raise ValueError("Not a password hash")
+        return "scrypt-legacy", dict(LEGACY_PARAMS), decoded[:SALT_BYTES], decoded[SALT_BYTES:]
+
+    parts = stored_hash.split("$")
+    if len(parts) != 5 or parts[1] != ALGORITHM:
+        raise ValueError("Not a password hash")
+    fields = dict(field.split("=", 1) for field in parts[2].split(","))
+    log_n, r, p = int(fields["ln"]), int(fields["r"]), int(fields["p"])
+    if not 1 <= log_n <= 32:
+        raise ValueError("Not a password hash")
+    n = 2 ** log_n
+    _check_params(n, r, p)
+    return ALGORITHM, {"n": n, "r": r, "p": p}, _unb64(parts[3]), _unb64(parts[4])
+
+def secure_password_hash(password, n=None, r=None, p=None):
     """
-    Create a secure password hash using scrypt with a random salt.
-    Much stronger than the previous SHA-256 implementation.
+    Create a secure password hash using scrypt with a random salt. The cost parameters
+    default to the current params and are stored with the hash.
     """
+    n, r, p = n or params["n"], r or params["r"], p or params["p"]
+    _check_params(n, r, p)
+
     # Generate a random salt (16 bytes)
-    salt = os.urandom(16)
-    
+    salt = os.urandom(SALT_BYTES)
+
     # Hash the password with scrypt
-    password_hash = hashlib.scrypt(
-        password.encode(), 
-        salt=salt, 
-        n=16384,  # CPU/memory cost parameter
-        r=8,      # Block size parameter
-        p=1,      # Parallelization parameter
-        dklen=32  # Output length
-    )
-    
-    # Combine salt and hash for storage
-    combined = salt + password_hash
-    
-    # Base64 encode for storage as text
-    return base64.b64encode(combined).decode('utf-8')
+    password_hash = _scrypt(password, salt, n, r, p)
+    return f"${ALGORITHM}$ln={n.bit_length() - 1},r={r},p={p}${_b64(salt)}${_b64(password_hash)}"
 
 def verify_password(stored_hash, provided_password):
     """
-    Verify a password against a stored hash.
-    """
-    # Decode the stored hash
-    decoded = base64.b64decode(stored_hash.encode('utf-8'))
-    
-    # Extract salt (first 16 bytes)
-    salt = decoded[:16]
-    stored_password_hash = decoded[16:]
-    
-    # Hash the provided password with the same salt
-    calculated_hash = hashlib.scrypt(
-        provided_password.encode(),
-        salt=salt,
-        n=16384,
-        r=8,
-        p=1,
-        dklen=32
-    )
-    
+    Verify a password against a stored hash, in either format. False for a wrong
+    password or a malformed hash.
+    """
+    try:
+        _, cost, salt, stored_password_hash = parse_hash(stored_hash)
+    except (ValueError, KeyError):
+        return False
+
+    # Hash the provided password with the same salt and parameters
+    calculated_hash = _scrypt(provided_password, salt, cost["n"], cost["r"], cost["p"])
+
     # Compare in constant time to prevent timing attacks
-    return calculated_hash == stored_password_hash
\ No newline at end of file
+    return hmac.compare_digest(calculated_hash, stored_password_hash)
+
+def needs_rehash(stored_hash):
+    """
+    Whether a hash should be replaced with secure_password_hash() the next time the
+    password is at hand: it is in the old format, or made with other parameters than
+    the current params (cheaper or dearer).
+    """
+    try:
+        algorithm, cost, _, _ = parse_hash(stored_hash)
+    except (ValueError, KeyError):
+        return True
+    return algorithm != ALGORITHM or cost != params
+
+def tune_scrypt(target_seconds=TUNE_TARGET, r=8, p=1, max_memory=MAX_MEMORY):
+    """
+    Benchmark scrypt on this host and return the parameters ({"n", "r", "p", "seconds"})
+    with the largest n whose verify stays within target_seconds and max_memory. Pass
+    the result to set_params() to use it. The target is per verify and per core, so
+    logins per second per core is roughly 1 / target_seconds.
+    """
+    salt = os.urandom(SALT_BYTES)
+    best = None
+    n = 2 ** 10
+    while scrypt_memory(n, r, p) <= max_memory:
+        # Best of three, so a scheduling hiccup doesn't stop the search early
+        seconds = min(_timed(n, r, p, salt) for _ in range(3))
+        if seconds > target_seconds and best is not None:
+            break
+        best = {"n": n, "r": r, "p": p, "seconds": seconds}
+        if seconds > target_seconds:
+            break
+        n *= 2
+    return best
+
+def _timed(n, r, p, salt):
+    started = time.perf_counter()
+    _scrypt("tune", salt, n, r, p)
+    return time.perf_counter() - started
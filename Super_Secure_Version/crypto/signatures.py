@@ -1,47 +1,135 @@
 import base64
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from cryptography.hazmat.primitives.asymmetric import padding
-from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives import hashes
+from .key_management import load_public_keys, load_private_keys, SUITE_X25519
+
+VERIFIER_KEYS = 1024                              # Deserialized public keys a SignatureVerifier keeps
+VERIFIER_WORKERS = min(4, os.cpu_count() or 1)
+
+def _pss():
+    return padding.PSS(mgf=padding.MGF1(hashes.SHA256()), salt_length=padding.PSS.MAX_LENGTH)
 
 def sign_message(message, private_key_pem):
-    """Sign a message using a private key."""
+    """
+    Sign a message using a private key (PEM, or a load_private_keys tuple). Ed25519 for
+    X25519-suite keys, RSA-PSS otherwise.
+    """
     # Load the private key
-    private_key = serialization.load_pem_private_key(
-        private_key_pem,
-        password=None
-    )
-    
+    suite, _, private_key = load_private_keys(private_key_pem)
+
+    if suite == SUITE_X25519:
+        return base64.b64encode(private_key.sign(message.encode('utf-8'))).decode('utf-8')
+
     # Create a signature
-    signature = private_key.sign(
-        message.encode('utf-8'),
-        padding.PSS(
-            mgf=padding.MGF1(hashes.SHA256()),
-            salt_length=padding.PSS.MAX_LENGTH
-        ),
-        hashes.SHA256()
-    )
-    
+    signature = private_key.sign(message.encode('utf-8'), _pss(), hashes.SHA256())
+
     # Return base64 encoded signature
     return base64.b64encode(signature).decode('utf-8')
 
-def verify_signature(message, signature, public_key_pem):
-    """Verify a message signature using a public key."""
-    # Load the public key
-    public_key = serialization.load_pem_public_key(public_key_pem)
-    
-    # Decode the signature
-    signature_bytes = base64.b64decode(signature)
-    
+def _verify(suite, public_key, message, signature):
+    """Check a base64 signature against an already loaded key"""
     try:
-        # Verify the signature
-        public_key.verify(
-            signature_bytes,
-            message.encode('utf-8'),
-            padding.PSS(
-                mgf=padding.MGF1(hashes.SHA256()),
-                salt_length=padding.PSS.MAX_LENGTH
-            ),
-            hashes.SHA256()
-        )
+        signature_bytes = base64.b64decode(signature)
+        if suite == SUITE_X25519:
+            public_key.verify(signature_bytes, message.encode('utf-8'))
+        else:
+            public_key.verify(signature_bytes, message.encode('utf-8'), _pss(), hashes.SHA256())
         return True
     except Exception:
-        return False
\ No newline at end of file
+        return False
+
+def verify_signature(message, signature, public_key_pem):
+    """Verify a message signature using a public key."""
+    suite, _, public_key = load_public_keys(public_key_pem)
+    return _verify(suite, public_key, message, signature)
+
+class SignatureVerifier:
+    """
+    Verifies signatures by signer name, keeping each signer's deserialized key next to
+    the PEM it came from (LRU, VERIFIER_KEYS of them). A signer whose PEM changes is
+    loaded again. verify_many() checks a backlog on a thread pool, split into one
+    batch per worker, e.g. when a client drains a queue of signed messages.
+    """
+    def __init__(self, workers=VERIFIER_WORKERS, maxsize=VERIFIER_KEYS):
+        self.workers = max(1, workers)
+        self.maxsize = maxsize
+        self.keys = OrderedDict()    # signer -> (pem, suite, key)
+        self.verified = 0
+        self.failed = 0
+        self.loads = 0
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _key(self, signer, public_key_pem):
+        with self._lock:
+            entry = self.keys.get(signer)
+            if entry is not None and entry[0] == public_key_pem:
+                self.keys.move_to_end(signer)
+                return entry[1], entry[2]
+
+        suite, _, key = load_public_keys(public_key_pem)
+        with self._lock:
+            self.loads += 1
+            self.keys[signer] = (public_key_pem, suite, key)
+            self.keys.move_to_end(signer)
+            while len(self.keys) > self.maxsize:
+                self.keys.popitem(last=False)
+        return suite, key
+
+    def verify(self, signer, public_key_pem, message, signature):
+        """Whether signature is signer's signature of message"""
+        try:
+            suite, key = self._key(signer, public_key_pem)
+        except ValueError:
+            ok = False
+        else:
+            ok = _verify(suite, key, message, signature)
+        with self._lock:
+            if ok:
+                self.verified += 1
+            else:
+                self.failed += 1
+        return ok
+
+    def _verify_batch(self, items):
+        return [self.verify(*item) for item in items]
+
+    def verify_many(self, items):
+        """
+        Verify (signer, public_key_pem, message, signature) tuples, returns a bool for
+        each, in order. Small backlogs are checked inline.
+        """
+        items = list(items)
+        if len(items) < 2 * self.workers or self.workers == 1:
+            return self._verify_batch(items)
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="verify")
+
+        size = -(-len(items) // self.workers)
+        batches = [items[i:i + size] for i in range(0, len(items), size)]
+        results = []
+        for batch in self._executor.map(self._verify_batch, batches):
+            results.extend(batch)
+        return results
+
+    def stats(self):
+        """How many signatures passed and failed, and how often a key had to be loaded"""
+        with self._lock:
+            return {"keys": len(self.keys), "loads": self.loads, "verified": self.verified,
+                    "failed": self.failed, "workers": self.workers}
+
+    def close(self):
+        """Stop the worker threads"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
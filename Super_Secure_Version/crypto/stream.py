@@ -0,0 +1,201 @@
+import base64
+import os
+import struct
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
+from .encryption import encrypt_message, decrypt_message
+
+# Stream layout: HEADER, then one sealed chunk after another. Every chunk but the last
+# holds exactly chunk_size bytes of plaintext, so chunks need no length prefix.
+STREAM_MAGIC = b"CHST"
+STREAM_VERSION = 1
+HEADER = struct.Struct("<4sBBI7s")    # magic, version, cipher, chunk size, nonce prefix
+TAG_SIZE = 16
+DEFAULT_CHUNK_SIZE = 64 * 1024
+MAX_CHUNK_SIZE = 16 * 1024 * 1024
+MAX_CHUNKS = 2 ** 32
+
+# Ciphers by header id
+AES_GCM = 1
+CHACHA20_POLY1305 = 2
+CIPHERS = {AES_GCM: AESGCM, CHACHA20_POLY1305: ChaCha20Poly1305}
+
+def chunk_nonce(prefix, counter, last):
+    """96-bit nonce: random prefix, chunk number and a final-chunk flag (the STREAM construction)"""
+    return prefix + struct.pack(">IB", counter, 1 if last else 0)
+
+def read_chunks(source, chunk_size):
+    """Plaintext from bytes, a file object or an iterable of bytes, re-cut to chunk_size pieces"""
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        view = memoryview(source)
+        for start in range(0, len(view), chunk_size):
+            yield view[start:start + chunk_size]
+        return
+    if hasattr(source, "read"):
+        while True:
+            data = source.read(chunk_size)
+            if not data:
+                return
+            yield data
+        return
+
+    pending = bytearray()
+    for data in source:
+        pending += data
+        while len(pending) >= chunk_size:
+            yield bytes(pending[:chunk_size])
+            del pending[:chunk_size]
+    if pending:
+        yield bytes(pending)
+
+class StreamEncryptor:
+    """
+    Seals a payload chunk by chunk. Each chunk gets its own nonce and tag, and the
+    header is authenticated with every chunk, so reordered, dropped, truncated or
+    altered chunks all fail to decrypt.
+    """
+    def __init__(self, key, cipher=AES_GCM, chunk_size=DEFAULT_CHUNK_SIZE, prefix=None):
+        if cipher not in CIPHERS:
+            raise ValueError(f"Unknown stream cipher: {cipher}")
+        if not 0 < chunk_size <= MAX_CHUNK_SIZE:
+            raise ValueError(f"Chunk size must be between 1 and {MAX_CHUNK_SIZE}")
+        self.aead = CIPHERS[cipher](key)
+        self.chunk_size = chunk_size
+        self.prefix = prefix or os.urandom(7)
+        self.header = HEADER.pack(STREAM_MAGIC, STREAM_VERSION, cipher, chunk_size, self.prefix)
+        self.counter = 0
+        self.finished = False
+
+    def seal(self, data, last=False):
+        """Encrypt the next chunk. Every chunk but the last must be exactly chunk_size bytes."""
+        if self.finished:
+            raise ValueError("Stream already finished")
+        if len(data) > self.chunk_size or (not last and len(data) != self.chunk_size):
+            raise ValueError("Only the last chunk may be shorter than the chunk size")
+        if self.counter >= MAX_CHUNKS:
+            raise ValueError("Stream too long for its nonce space")
+        sealed = self.aead.encrypt(chunk_nonce(self.prefix, self.counter, last), data, self.header)
+        self.counter += 1
+        self.finished = last
+        return sealed
+
+class StreamDecryptor:
+    """
+    Opens a stream as its bytes arrive. feed() returns plaintext for every chunk that
+    is known not to be the last one and raises InvalidTag as soon as one fails;
+    finish() opens the final chunk and fails if the stream was cut short.
+    """
+    def __init__(self, key):
+        self.key = key
+        self.aead = None
+        self.header = None
+        self.chunk_size = 0
+        self.prefix = None
+        self.counter = 0
+        self.buffer = bytearray()
+        self.finished = False
+
+    def _read_header(self):
+        magic, version, cipher, chunk_size, prefix = HEADER.unpack_from(self.buffer)
+        if magic != STREAM_MAGIC or version != STREAM_VERSION:
+            raise ValueError("Not an encrypted stream, or an unsupported version")
+        if cipher not in CIPHERS or not 0 < chunk_size <= MAX_CHUNK_SIZE:
+            raise ValueError("Corrupt stream header")
+        self.header = bytes(self.buffer[:HEADER.size])
+        self.aead = CIPHERS[cipher](self.key)
+        self.chunk_size = chunk_size
+        self.prefix = prefix
+        del self.buffer[:HEADER.size]
+
+    def _open(self, sealed, last):
+        plaintext = self.aead.decrypt(chunk_nonce(self.prefix, self.counter, last), sealed, self.header)
+        self.counter += 1
+        return plaintext
+
+    def feed(self, data):
+        """Add received bytes, returns the plaintext chunks they completed"""
+        if self.finished:
+            raise ValueError("Stream already finished")
+        self.buffer += data
+        if self.header is None:
+            if len(self.buffer) < HEADER.size:
+                return []
+            self._read_header()
+
+        # A full chunk is only known not to be the last once more bytes follow it
+        sealed_size = self.chunk_size + TAG_SIZE
+        out = []
+        while len(self.buffer) > sealed_size:
+            out.append(self._open(memoryview(self.buffer)[:sealed_size], last=False))
+            del self.buffer[:sealed_size]
+        return out
+
+    def finish(self):
+        """Open the final chunk, returns its plaintext"""
+        if self.header is None or len(self.buffer) < TAG_SIZE:
+            raise ValueError("Encrypted stream is truncated")
+        plaintext = self._open(self.buffer, last=True)
+        self.buffer = bytearray()
+        self.finished = True
+        return plaintext
+
+def encrypt_stream(source, key, cipher=AES_GCM, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Encrypt bytes, a file object or an iterable of bytes. Yields the header and then
+    one sealed chunk at a time, holding at most two chunks of plaintext in memory.
+    """
+    encryptor = StreamEncryptor(key, cipher, chunk_size)
+    yield encryptor.header
+
+    previous = None
+    for chunk in read_chunks(source, chunk_size):
+        if previous is not None:
+            yield encryptor.seal(previous)
+        previous = chunk
+    yield encryptor.seal(previous if previous is not None else b"", last=True)
+
+def stream_size(size, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Length of the encrypted stream of size bytes of plaintext"""
+    return HEADER.size + max(1, -(-size // chunk_size)) * TAG_SIZE + size
+
+def encrypt_file(path, key, prefix, offset=0, cipher=AES_GCM, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Encrypted stream of a file, starting at byte offset of the stream. The same key
+    and prefix give the same bytes every time, so an interrupted upload can pick up
+    at any offset without encrypting what was already sent. That only holds while the
+    file is unchanged: resuming after it changed would reuse nonces on different
+    plaintext, so callers must check first and otherwise start a new stream.
+    """
+    encryptor = StreamEncryptor(key, cipher, chunk_size, prefix)
+    chunks = max(1, -(-os.path.getsize(path) // chunk_size))
+    if offset < HEADER.size:
+        yield encryptor.header[offset:]
+        first, skip = 0, 0
+    else:
+        first, skip = divmod(offset - HEADER.size, chunk_size + TAG_SIZE)
+
+    encryptor.counter = first
+    with open(path, "rb") as f:
+        f.seek(first * chunk_size)
+        for index in range(first, chunks):
+            sealed = encryptor.seal(f.read(chunk_size), last=index == chunks - 1)
+            yield sealed[skip:] if skip else sealed
+            skip = 0
+
+def decrypt_stream(source, key, read_size=DEFAULT_CHUNK_SIZE):
+    """Decrypt what encrypt_stream produced, from bytes, a file object or an iterable of bytes"""
+    decryptor = StreamDecryptor(key)
+    for data in read_chunks(source, read_size):
+        yield from decryptor.feed(data)
+    yield decryptor.finish()
+
+def new_stream_key():
+    """Random 256-bit key for one stream"""
+    return os.urandom(32)
+
+def seal_stream_key(key, recipient_public_key_pem):
+    """Encrypt a stream key for a recipient with their public key (any suite)"""
+    return encrypt_message(base64.b64encode(key).decode('utf-8'), recipient_public_key_pem)
+
+def open_stream_key(sealed_key, private_key_pem):
+    """Recover a stream key sealed with seal_stream_key"""
+    return base64.b64decode(decrypt_message(sealed_key, private_key_pem))
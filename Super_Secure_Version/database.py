@@ -3,6 +3,18 @@ import sqlite3
 import asyncio
 import os
 import hashlib
+from crypto.key_management import key_fingerprint
+from server_metrics import metrics, timed
+from server_logging import get_logger
+
+log = get_logger("db")
+
+# Most usernames resolved by one GETKEYS lookup (stays under SQLite's bound parameter limit)
+MAX_KEY_BATCH = 256
+
+def db_timer(op):
+    """Record the duration of a database call under db_seconds{op=...}"""
+    return timed(metrics.histogram("db_seconds", {"op": op}, "Time spent in database calls"))
 
 async def init_database():
     """Initialize the database and create necessary tables"""
@@ -28,6 +40,8 @@ async def init_database():
     CREATE TABLE IF NOT EXISTS public_keys (
         username TEXT PRIMARY KEY,
         public_key TEXT NOT NULL,
+        key_version INTEGER NOT NULL DEFAULT 1,
+        fingerprint TEXT NOT NULL DEFAULT '',
         key_creation_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
         FOREIGN KEY (username) REFERENCES members(username)
     )
@@ -49,8 +63,9 @@ async def init_database():
     cur.close()
     conn.close()
     
-    print("Database initialized successfully.")
+    log.info("database initialized")
 
+@db_timer("create_user")
 async def create_user(username, password_hash, salt):
     """Create a new user with the given username and password_hash"""
     # Check if username already exists
@@ -70,11 +85,12 @@ async def create_user(username, password_hash, salt):
         conn.commit()
         return True
     except Exception as e:
-        print(f"Error creating user: {e}")
+        log.error("create user failed", extra={"error": str(e)})
         return False
     finally:
         conn.close()
 
+@db_timer("user_exists")
 async def user_exists(username):
     """Check if a username exists in the database"""
     conn = sqlite3.connect('chat.db')
@@ -87,6 +103,7 @@ async def user_exists(username):
     finally:
         conn.close()
 
+@db_timer("get_user_data")
 async def get_user_data(username):
     """Get user data including password hash and salt"""
     conn = sqlite3.connect('chat.db')
@@ -99,11 +116,12 @@ async def get_user_data(username):
             return {"password_hash": result[0], "salt": result[1]}
         return None
     except Exception as e:
-        print(f"Error retrieving user data: {e}")
+        log.error("get user data failed", extra={"error": str(e)})
         return None
     finally:
         conn.close()
 
+@db_timer("get_user_salt")
 async def get_user_salt(username):
     """Get a user's salt"""
     conn = sqlite3.connect('chat.db')
@@ -114,29 +132,40 @@ async def get_user_salt(username):
         result = cursor.fetchone()
         return result[0] if result else None
     except Exception as e:
-        print(f"Error retrieving salt: {e}")
+        log.error("get salt failed", extra={"error": str(e)})
         return None
     finally:
         conn.close()
 
+@db_timer("store_public_key")
 async def store_public_key(username, public_key_pem):
-    """Store a user's public key in the database."""
+    """
+    Store a user's public key in the database. Uploading a different key bumps the
+    key version; re-uploading the same one leaves it alone. Returns the version.
+    """
     conn = sqlite3.connect('chat.db')
     cursor = conn.cursor()
     
     try:
         cursor.execute("""
-            INSERT OR REPLACE INTO public_keys (username, public_key)
-            VALUES (?, ?)
-        """, (username, public_key_pem))
+            INSERT INTO public_keys (username, public_key, fingerprint)
+            VALUES (?, ?, ?)
+            ON CONFLICT(username) DO UPDATE SET
+                public_key = excluded.public_key,
+                fingerprint = excluded.fingerprint,
+                key_version = key_version + 1
+            WHERE fingerprint != excluded.fingerprint
+        """, (username, public_key_pem, key_fingerprint(public_key_pem)))
         conn.commit()
-        return True
+        cursor.execute("SELECT key_version FROM public_keys WHERE username = ?", (username,))
+        return cursor.fetchone()[0]
     except Exception as e:
-        print(f"Error storing public key: {e}")
+        log.error("store public key failed", extra={"error": str(e)})
         return False
     finally:
         conn.close()
 
+@db_timer("get_public_key")
 async def get_public_key(username):
     """Retrieve a user's public key from the database."""
     conn = sqlite3.connect('chat.db')
@@ -150,11 +179,54 @@ async def get_public_key(username):
         result = cursor.fetchone()
         return result[0] if result else None
     except Exception as e:
-        print(f"Error retrieving public key: {e}")
+        log.error("get public key failed", extra={"error": str(e)})
         return None
     finally:
         conn.close()
 
+@db_timer("get_key_info")
+async def get_key_info(username):
+    """A user's (key version, fingerprint), or (0, None) if they have no key."""
+    conn = sqlite3.connect('chat.db')
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute("""
+            SELECT key_version, fingerprint FROM public_keys
+            WHERE username = ?
+        """, (username,))
+        result = cursor.fetchone()
+        return (result[0], result[1]) if result else (0, None)
+    except Exception as e:
+        log.error("get key info failed", extra={"error": str(e)})
+        return (0, None)
+    finally:
+        conn.close()
+
+@db_timer("get_public_keys")
+async def get_public_keys(usernames):
+    """Retrieve several users' public keys with one query. Users without a key are left out."""
+    usernames = list(dict.fromkeys(usernames))[:MAX_KEY_BATCH]
+    if not usernames:
+        return {}
+
+    conn = sqlite3.connect('chat.db')
+    cursor = conn.cursor()
+    
+    try:
+        placeholders = ",".join("?" * len(usernames))
+        cursor.execute(f"""
+            SELECT username, public_key FROM public_keys
+            WHERE username IN ({placeholders})
+        """, usernames)
+        return dict(cursor.fetchall())
+    except Exception as e:
+        log.error("get public keys failed", extra={"error": str(e)})
+        return {}
+    finally:
+        conn.close()
+
+@db_timer("store_challenge")
 async def store_challenge(username, challenge):
     """Store an authentication challenge for a user"""
     conn = sqlite3.connect('chat.db')
@@ -168,11 +240,12 @@ async def store_challenge(username, challenge):
         conn.commit()
         return True
     except Exception as e:
-        print(f"Error storing challenge: {e}")
+        log.error("store challenge failed", extra={"error": str(e)})
         return False
     finally:
         conn.close()
 
+@db_timer("get_challenge")
 async def get_challenge(username):
     """Get stored authentication challenge for a user"""
     conn = sqlite3.connect('chat.db')
@@ -186,7 +259,7 @@ async def get_challenge(username):
         result = cursor.fetchone()
         return result[0] if result else None
     except Exception as e:
-        print(f"Error retrieving challenge: {e}")
+        log.error("get challenge failed", extra={"error": str(e)})
         return None
     finally:
         conn.close()
\ No newline at end of file
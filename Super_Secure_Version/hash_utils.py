@@ -8,17 +8,19 @@ def generate_salt():
     """Generate a random salt for password hashing"""
     return os.urandom(16).hex()
 
-def hash_password(password, salt):
+def hash_password(password, salt, n=16384, r=8, p=1):
     """
     Create a secure password hash using scrypt with the provided salt.
-    Returns the hash as a hex string.
+    Returns the hash as a hex string. The cost parameters default to the
+    values every stored hash uses; only override them for benchmarking.
     """
     password_hash = hashlib.scrypt(
         password.encode(), 
         salt=bytes.fromhex(salt), 
-        n=16384,  # CPU/memory cost parameter
-        r=8,      # Block size parameter
-        p=1,      # Parallelization parameter
+        n=n,      # CPU/memory cost parameter
+        r=r,      # Block size parameter
+        p=p,      # Parallelization parameter
+        maxmem=128 * n * r * p + 1024 * 1024,
         dklen=32  # Output length
     )
     
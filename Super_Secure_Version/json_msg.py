@@ -10,25 +10,32 @@ class CODES(Enum):
     ERROR = "ERROR"
     SALT = "SALT"  # New code for salt exchange
     CHALLENGE = "CHALLENGE"  # New code for challenge exchange
+    KEEPALIVE = "KEEPALIVE"  # Server ping to quiet clients
+    TICKET = "TICKET"  # Resume ticket handed out on login
+    FILE = "FILE"  # File offered to this user, sent by the server itself
 
 """
 This class holds a CODE and a string. It can be created from a json dict
 or two strings. It can create a json representation of msg to send.
+A msg answering a tagged command also carries the command's request id. The
+msg field is always JSON escaped, so text relayed from other users can't close
+the frame early and pass for a frame of its own.
 """
 class msg:
-    def __init__(self, code: str, msg: str):
+    def __init__(self, code: str, msg: str, request_id: str | None = None):
         """
-        Initialize a Msg object with code and msg.
+        Initialize a Msg object with code, msg and an optional request id.
         """
         self.code = code
         self.msg = msg
+        self.request_id = request_id
 
     @classmethod
     def from_json_dict(cls, json_dict):
         """
         Create a Msg object from a JSON dictionary.
         """
-        return cls(json_dict.get("code"), json_dict.get("msg"))
+        return cls(json_dict.get("code"), json_dict.get("msg"), json_dict.get("id"))
 
     def to_json_str(self) -> str:
         """
@@ -46,4 +53,6 @@ class msg:
         """
         Return a string representation of the Msg object.
         """
-        return f'{{"code": "{self.code}", "msg": "{self.msg}"}}'
\ No newline at end of file
+        if self.request_id is not None:
+            return json.dumps({"code": self.code, "id": self.request_id, "msg": self.msg})
+        return json.dumps({"code": self.code, "msg": self.msg})
\ No newline at end of file
@@ -0,0 +1,332 @@
+# loadgen.py - Headless load generator for the JSON protocol server
+"""
+Drives many simulated clients against `server.py --json`. Each client registers,
+logs in through the real authenticate_user exchange (challenge, GET_SALT, scrypt,
+challenge response) and then sends SEND traffic encrypted with crypto.encryption
+to random other clients at a configurable rate and message size.
+
+Delivery latency is measured from the moment a message was *scheduled* to be sent,
+not from when it actually went out, so a server that falls behind shows up in the
+numbers instead of silently slowing the generator down.
+
+Examples:
+    python loadgen.py --spawn --users 200 --rate 0.5 --duration 30
+    python loadgen.py --host 10.0.0.5 --port 8888 --users 1000 --size uniform:50-400
+
+A server not started with --load-test will rate limit and cap connections from a
+single address, so point this at one that was, or use --spawn.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from crypto.key_management import generate_key_pair, load_private_keys
+from crypto.encryption import encrypt_message, decrypt_message
+from hash_utils import hash_password, compute_challenge_response
+from json_msg import CODES
+from secure_client import FrameReader
+
+# Server reads commands in BUFFER sized chunks, so keep SEND frames under that
+MAX_PLAINTEXT = 900
+"""
+Parses a size spec: fixed:N, uniform:A-B or exp:MEAN. Sizes are capped at MAX_PLAINTEXT.
+"""
+def size_sampler(spec: str):
+    kind, _, arg = spec.partition(":")
+    if kind == "fixed":
+        size = int(arg)
+        sample = lambda: size
+    elif kind == "uniform":
+        low, high = (int(x) for x in arg.split("-"))
+        sample = lambda: random.randint(low, high)
+    elif kind == "exp":
+        mean = float(arg)
+        sample = lambda: int(random.expovariate(1 / mean)) + 1
+    else:
+        raise ValueError(f"Unknown size distribution: {spec}")
+    return lambda: max(1, min(MAX_PLAINTEXT, sample()))
+
+def percentile(sorted_values: list, pct: float) -> float:
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return float("nan")
+    rank = max(0, min(len(sorted_values) - 1, int(round(pct / 100 * len(sorted_values))) - 1))
+    return sorted_values[rank]
+
+"""
+Shared results for a run.
+"""
+class Stats:
+    def __init__(self) -> None:
+        self.login_latencies = []
+        self.delivery_latencies = []
+        self.sent = 0
+        self.acked = 0
+        self.delivered = 0
+        self.errors = 0
+        self.bytes_out = 0
+        self.bytes_in = 0
+        # ciphertext -> scheduled send time, to time deliveries without decrypting
+        self.in_flight: dict[str, float] = {}
+
+"""
+One simulated user.
+"""
+class SimClient:
+    def __init__(self, username: str, password: str, private_key: bytes, public_key: bytes, stats: Stats) -> None:
+        self.username = username
+        self.password = password
+        self.private_key = load_private_keys(private_key)   # Loaded once, decrypted with per message
+        self.public_key = public_key
+        self.stats = stats
+        self.reader = None
+        self.writer = None
+        self.frames = None
+        self.ack = None
+
+    async def send(self, text: str) -> None:
+        """Write one command to the server"""
+        data = text.encode()
+        self.stats.bytes_out += len(data)
+        self.writer.write(data)
+        await self.writer.drain()
+
+    async def connect(self, host: str, port: int) -> None:
+        """Open the connection"""
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        self.frames = FrameReader(self.reader)
+
+    async def register_and_login(self) -> None:
+        """Register, then log in through the challenge/response exchange"""
+        await self.frames.expect(CODES.WRITE_BACK)          # login or register
+        await self.send("2")
+        await self.frames.expect(CODES.WRITE_BACK)          # username
+        await self.send(self.username)
+        await self.frames.expect(CODES.WRITE_BACK)          # password
+        await self.send(self.password)
+        await self.frames.expect(CODES.WRITE_BACK)          # public key
+        await self.send(self.public_key.decode())
+        await self.frames.expect(CODES.NO_WRITE_BACK)       # created
+
+        started = time.perf_counter()
+        await self.frames.expect(CODES.WRITE_BACK)          # username
+        await self.send(self.username)
+        challenge_msg = await self.frames.expect(CODES.WRITE_BACK)
+        if not challenge_msg.startswith("CHALLENGE "):
+            raise ConnectionError(f"Expected challenge, got: {challenge_msg[:80]}")
+
+        challenge = await asyncio.to_thread(decrypt_message, challenge_msg[len("CHALLENGE "):], self.private_key)
+        await self.send("GET_SALT")
+        salt = await self.frames.expect(CODES.SALT)
+        password_hash = await asyncio.to_thread(hash_password, self.password, salt)
+        await self.send(compute_challenge_response(password_hash, challenge))
+
+        await self.frames.expect(CODES.TICKET)
+        await self.frames.expect(CODES.AUTHENTICATED)
+        self.stats.login_latencies.append(time.perf_counter() - started)
+
+    async def receive(self, verify: bool) -> None:
+        """Read frames until the connection closes, timing deliveries and releasing acks"""
+        while True:
+            code, text = await self.frames.next()
+            if code == CODES.SUCCESS.value and text.startswith("Message sent to"):
+                self.stats.acked += 1
+                if self.ack is not None and not self.ack.done():
+                    self.ack.set_result(True)
+            elif code == CODES.SUCCESS.value and "{" in text:
+                ciphertext = text[text.index("{"):]
+                scheduled = self.stats.in_flight.pop(ciphertext, None)
+                if scheduled is not None:
+                    self.stats.delivery_latencies.append(time.perf_counter() - scheduled)
+                    self.stats.delivered += 1
+                if verify:
+                    await asyncio.to_thread(decrypt_message, ciphertext, self.private_key)
+            elif code == CODES.ERROR.value:
+                self.stats.errors += 1
+                if self.ack is not None and not self.ack.done():
+                    self.ack.set_result(False)
+
+    async def traffic(self, peers: list, rate: float, sizes, deadline: float) -> None:
+        """
+        Send to random peers with exponential inter-arrival times. Only one SEND is in
+        flight per connection, since the server can't split commands that arrive together.
+        """
+        loop = asyncio.get_running_loop()
+        next_send = time.perf_counter() + random.expovariate(rate)
+        while next_send < deadline:
+            await asyncio.sleep(max(0, next_send - time.perf_counter()))
+
+            peer = random.choice(peers)
+            body = f"{self.username}|{next_send}|".ljust(sizes(), "x")
+            ciphertext = encrypt_message(body, peer.public_key)
+            self.stats.in_flight[ciphertext] = next_send
+
+            self.ack = loop.create_future()
+            await self.send(f"SEND {ciphertext} TO {peer.username}")
+            self.stats.sent += 1
+            try:
+                await asyncio.wait_for(self.ack, timeout=max(1, deadline - time.perf_counter()))
+            except asyncio.TimeoutError:
+                break
+
+            next_send += random.expovariate(rate)
+
+    async def close(self) -> None:
+        """Say goodbye and close"""
+        try:
+            await self.send("EXIT")
+            self.writer.close()
+            await self.writer.wait_closed()
+        except ConnectionError:
+            pass
+
+def free_port() -> int:
+    """Ask the OS for an unused TCP port"""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+async def wait_for_port(host: str, port: int, timeout: float = 10) -> None:
+    """Poll until a server accepts connections"""
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            _, writer = await asyncio.open_connection(host, port)
+            writer.close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.1)
+
+def spawn_server(port: int, workdir: str) -> subprocess.Popen:
+    """Start server.py --json --load-test in a scratch directory so it gets its own chat.db"""
+    server_py = os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py")
+    return subprocess.Popen(
+        [sys.executable, server_py, "--json", "--load-test", "--host", "127.0.0.1", "--port", str(port)],
+        cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+
+async def run(args) -> dict:
+    """Run one load test and return the summary"""
+    stats = Stats()
+    sizes = size_sampler(args.size)
+
+    # One key pair shared by every simulated user, RSA keygen per user would dominate setup
+    private_key, public_key = generate_key_pair()
+    run_id = os.urandom(3).hex()
+    sim = [SimClient(f"load{run_id}u{i}", "loadtest-password", private_key, public_key, stats)
+           for i in range(args.users)]
+
+    # Log everyone in, a bounded number at a time
+    gate = asyncio.Semaphore(args.login_concurrency)
+    async def login(client: SimClient) -> bool:
+        async with gate:
+            try:
+                await client.connect(args.host, args.port)
+                await client.register_and_login()
+                return True
+            except Exception as e:
+                stats.errors += 1
+                print(f"{client.username} failed to log in: {e}", file=sys.stderr)
+                return False
+
+    login_started = time.perf_counter()
+    results = await asyncio.gather(*(login(c) for c in sim))
+    login_elapsed = time.perf_counter() - login_started
+    online = [c for c, ok in zip(sim, results) if ok]
+    if len(online) < 2:
+        raise RuntimeError("Need at least two logged in clients to send traffic")
+
+    # Drive traffic
+    receivers = [asyncio.create_task(c.receive(args.verify)) for c in online]
+    started = time.perf_counter()
+    deadline = started + args.duration
+    await asyncio.gather(*(c.traffic([p for p in online if p is not c], args.rate, sizes, deadline)
+                           for c in online))
+    # Give the last deliveries a moment to land
+    await asyncio.sleep(args.drain)
+    elapsed = time.perf_counter() - started
+
+    for task in receivers:
+        task.cancel()
+    await asyncio.gather(*(c.close() for c in online), return_exceptions=True)
+    stats.bytes_in = sum(c.frames.bytes_in for c in online)
+
+    logins = sorted(stats.login_latencies)
+    deliveries = sorted(stats.delivery_latencies)
+    return {
+        "users": args.users,
+        "online": len(online),
+        "login_seconds": round(login_elapsed, 3),
+        "login_p50_ms": percentile(logins, 50) * 1000,
+        "login_p95_ms": percentile(logins, 95) * 1000,
+        "login_p99_ms": percentile(logins, 99) * 1000,
+        "sent": stats.sent,
+        "acked": stats.acked,
+        "delivered": stats.delivered,
+        "errors": stats.errors,
+        "duration_seconds": round(elapsed, 3),
+        "throughput_msgs_per_s": stats.delivered / elapsed,
+        "bytes_out": stats.bytes_out,
+        "bytes_in": stats.bytes_in,
+        "delivery_p50_ms": percentile(deliveries, 50) * 1000,
+        "delivery_p95_ms": percentile(deliveries, 95) * 1000,
+        "delivery_p99_ms": percentile(deliveries, 99) * 1000,
+    }
+
+def print_report(summary: dict) -> None:
+    """Human readable summary"""
+    print(f"Clients online:   {summary['online']}/{summary['users']} (logins took {summary['login_seconds']}s)")
+    print(f"Login latency:    p50 {summary['login_p50_ms']:.1f} ms  p95 {summary['login_p95_ms']:.1f} ms  p99 {summary['login_p99_ms']:.1f} ms")
+    print(f"Messages:         sent {summary['sent']}  acked {summary['acked']}  delivered {summary['delivered']}  errors {summary['errors']}")
+    print(f"Throughput:       {summary['throughput_msgs_per_s']:.1f} msg/s over {summary['duration_seconds']}s")
+    print(f"Delivery latency: p50 {summary['delivery_p50_ms']:.1f} ms  p95 {summary['delivery_p95_ms']:.1f} ms  p99 {summary['delivery_p99_ms']:.1f} ms")
+    print(f"Bytes:            out {summary['bytes_out']}  in {summary['bytes_in']}")
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Load generator for the Super Secure chat server (JSON protocol)")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8888)
+    parser.add_argument("--spawn", action="store_true", help="start a throwaway server.py --json on a free port")
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--rate", type=float, default=1.0, help="messages per second per user")
+    parser.add_argument("--size", default="uniform:20-200", help="fixed:N, uniform:A-B or exp:MEAN plaintext bytes")
+    parser.add_argument("--duration", type=float, default=20.0, help="seconds of traffic")
+    parser.add_argument("--drain", type=float, default=2.0, help="seconds to wait for stragglers after traffic stops")
+    parser.add_argument("--login-concurrency", type=int, default=32)
+    parser.add_argument("--verify", action="store_true", help="decrypt every delivered message")
+    parser.add_argument("--json-out", help="also write the summary as JSON to this file")
+    args = parser.parse_args()
+
+    server = None
+    workdir = None
+    if args.spawn:
+        workdir = tempfile.TemporaryDirectory()
+        args.host, args.port = "127.0.0.1", free_port()
+        server = spawn_server(args.port, workdir.name)
+
+    try:
+        if server is not None:
+            asyncio.run(wait_for_port(args.host, args.port))
+        summary = asyncio.run(run(args))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+            workdir.cleanup()
+
+    print_report(summary)
+    if args.json_out:
+        with open(args.json_out, "w") as f:
+            json.dump(summary, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+# provision.py - Bulk account registration for bots and test fleets
+"""
+Registers many accounts against `server.py --json` in parallel. Key pairs come
+from a KeyPairPool, so RSA generation runs in worker processes ahead of the
+registrations that need them instead of inline, one account at a time (this
+matters most for --suite rsa2048, X25519 keys are cheap to make).
+
+Each account's keys are saved with save_keys_to_file (keys/<user>_*.pem under
+--keys-dir), and a CSV of username, password and key fingerprint is written to
+--out so the accounts can be logged in later with SecureClient.
+
+Examples:
+    python provision.py --count 1000 --prefix bot --out bots.csv
+    python provision.py --count 5000 --pool-size 64 --workers 8 --concurrency 128 --port 8888
+
+A server not started with --load-test will rate limit registrations from a single
+address, so point this at one that was, or use --spawn to try it out.
+"""
+import argparse
+import asyncio
+import csv
+import os
+import secrets
+import sys
+import tempfile
+import time
+
+from crypto.key_management import save_keys_to_file, key_fingerprint, SUITES, DEFAULT_SUITE
+from crypto.key_pool import KeyPairPool, DEFAULT_POOL_SIZE
+from loadgen import free_port, wait_for_port, spawn_server, percentile
+from secure_client import SecureClient
+
+async def register(args, pool: KeyPairPool, username: str, password: str) -> tuple[str, str]:
+    """Register one account and save its keys, returns its key fingerprint"""
+    private_key, public_key = await pool.take_async()
+    client = await SecureClient.connect(args.host, args.port)
+    try:
+        await client.register(username, password, public_key)
+    finally:
+        await client.close()
+    await asyncio.to_thread(save_keys_to_file, username, private_key, public_key, args.keys_dir)
+    return key_fingerprint(public_key)
+
+async def run(args) -> dict:
+    """Register args.count accounts and return the summary"""
+    accounts = [(f"{args.prefix}{i}", args.password or secrets.token_urlsafe(12))
+                for i in range(args.start, args.start + args.count)]
+    limit = asyncio.Semaphore(args.concurrency)
+    latencies = []
+    rows = []
+    failures = 0
+
+    async def provision(username: str, password: str) -> None:
+        nonlocal failures
+        async with limit:
+            started = time.perf_counter()
+            try:
+                fingerprint = await register(args, pool, username, password)
+            except Exception as e:
+                failures += 1
+                print(f"{username}: {e}", file=sys.stderr)
+                return
+            latencies.append(time.perf_counter() - started)
+            rows.append((username, password, fingerprint))
+
+    with KeyPairPool(size=args.pool_size, workers=args.workers, suite=args.suite) as pool:
+        start = time.perf_counter()
+        await asyncio.gather(*(provision(u, p) for u, p in accounts))
+        elapsed = time.perf_counter() - start
+        pool_stats = pool.stats()
+
+    if args.out:
+        with open(os.open(args.out, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["username", "password", "fingerprint"])
+            writer.writerows(sorted(rows))
+
+    latencies.sort()
+    return {
+        "requested": len(accounts),
+        "registered": len(rows),
+        "failed": failures,
+        "seconds": round(elapsed, 3),
+        "accounts_per_second": len(rows) / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "pool": pool_stats,
+    }
+
+def print_report(summary: dict) -> None:
+    """Human readable summary"""
+    pool = summary["pool"]
+    print(f"Registered:   {summary['registered']}/{summary['requested']} ({summary['failed']} failed)")
+    print(f"Throughput:   {summary['accounts_per_second']:.1f} accounts/s over {summary['seconds']}s")
+    print(f"Latency:      p50 {summary['p50_ms']:.1f} ms  p95 {summary['p95_ms']:.1f} ms")
+    print(f"Key pool:     {pool['taken']} pairs from {pool['workers']} workers, {pool['waited']} waited for generation")
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Register many accounts on the Super Secure chat server (JSON protocol)")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8888)
+    parser.add_argument("--spawn", action="store_true", help="start a throwaway server.py --json on a free port")
+    parser.add_argument("--count", type=int, default=100, help="accounts to register")
+    parser.add_argument("--prefix", default="user", help="usernames are PREFIX0, PREFIX1, ...")
+    parser.add_argument("--start", type=int, default=0, help="first account number")
+    parser.add_argument("--password", help="password for every account (default: a random one each)")
+    parser.add_argument("--concurrency", type=int, default=64, help="registrations in flight at once")
+    parser.add_argument("--suite", choices=SUITES, default=DEFAULT_SUITE, help="key algorithm suite")
+    parser.add_argument("--pool-size", type=int, default=DEFAULT_POOL_SIZE * 4, help="key pairs generated ahead")
+    parser.add_argument("--workers", type=int, help="key generation processes (default: CPU count)")
+    parser.add_argument("--keys-dir", default=".", help="keys are saved to KEYS_DIR/keys/")
+    parser.add_argument("--out", default="accounts.csv", help="CSV of username, password, fingerprint")
+    args = parser.parse_args()
+    args.workers = args.workers or os.cpu_count()
+
+    server = None
+    workdir = None
+    if args.spawn:
+        workdir = tempfile.TemporaryDirectory()
+        args.host, args.port = "127.0.0.1", free_port()
+        server = spawn_server(args.port, workdir.name)
+
+    try:
+        if server is not None:
+            asyncio.run(wait_for_port(args.host, args.port))
+        summary = asyncio.run(run(args))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+            workdir.cleanup()
+
+    print_report(summary)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,249 @@
+# replay.py - Replays a recorded traffic shape against a server
+"""
+Reads a trace written by `server.py --json --trace FILE` and drives a server with
+the same arrival pattern: connections open at the recorded offsets, log in for
+real, and then send each recorded command at its recorded time with the same
+frame size. Traces hold no message contents, so SEND bodies are filler of the
+original length addressed to a random other replayed user.
+
+Commands are sent in order per connection and one at a time (the server can't
+split commands that arrive together), so a slower build shows up as lateness
+against the recorded schedule as well as in the response latencies.
+
+Examples:
+    python server.py --json --trace prod.trace
+    python replay.py prod.trace --spawn
+    python replay.py prod.trace --port 8888 --speed 4 --json-out replay.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+from crypto.key_management import generate_key_pair
+from json_msg import CODES
+from loadgen import SimClient, Stats, free_port, wait_for_port, spawn_server, percentile
+from server_trace import load_trace, OPEN, IN, CLOSE
+
+"""
+One recorded connection: when it opened and closed, whether it logged in, and the
+(time, command, size) of every command it sent after logging in.
+"""
+class Session:
+    def __init__(self, conn: int, opened: float) -> None:
+        self.conn = conn
+        self.opened = opened
+        self.closed = None
+        self.authenticated = False
+        self.commands: list[tuple[float, str, int]] = []
+
+def sessions_from_trace(records: list) -> list[Session]:
+    """Group trace records into sessions, in the order they opened"""
+    sessions: dict[int, Session] = {}
+    for t, conn, event, tag, size in records:
+        if event == OPEN:
+            sessions[conn] = Session(conn, t)
+            continue
+        session = sessions.get(conn)
+        if session is None:
+            continue
+        if event == CLOSE:
+            session.closed = t
+        elif event == IN and tag != "LOGIN":
+            session.authenticated = True
+            session.commands.append((t, tag, size))
+        elif tag == CODES.AUTHENTICATED.value:
+            session.authenticated = True
+    return sorted(sessions.values(), key=lambda s: s.opened)
+
+"""
+A SimClient that replays one session's commands and times the responses.
+"""
+class ReplayClient(SimClient):
+    def __init__(self, session: Session, *args) -> None:
+        super().__init__(*args)
+        self.session = session
+        self.pending = None
+        self.delivered = 0
+
+    async def receive(self) -> None:
+        """Route replies to the pending command, count deliveries, ignore keepalives"""
+        while True:
+            code, text = await self.frames.next()
+            if code == CODES.KEEPALIVE.value:
+                continue
+            if code == CODES.SUCCESS.value and "{" in text and not text.startswith("Message sent to"):
+                self.delivered += 1
+            elif self.pending is not None and not self.pending.done():
+                self.pending.set_result(code)
+
+    def frame_for(self, tag: str, size: int, peers: list) -> str | None:
+        """Rebuild a command of the recorded size, or None if it can't be replayed"""
+        if tag == "SEND" and peers:
+            head = f"SEND {{\"replay\": \""
+            tail = f"\"}} TO {random.choice(peers).username}"
+            return head + "x" * max(0, size - len(head) - len(tail)) + tail
+        if tag == "GETKEY" and peers:
+            return f"GETKEY {random.choice(peers).username}"
+        if tag == "GETKEYS" and peers:
+            return "GETKEYS " + " ".join(p.username for p in peers)
+        if tag == "PUBKEY":
+            return f"PUBKEY {self.public_key.decode()}"
+        if tag in ("GETUSERS", "PRESENCE", "HELP", "GET_SALT"):
+            return tag
+        return None
+
+    async def replay(self, start: float, speed: float, peers: list, results: dict) -> None:
+        """Send every recorded command at its scheduled time and wait for its reply"""
+        loop = asyncio.get_running_loop()
+        for t, tag, size in self.session.commands:
+            scheduled = start + t / speed
+            await asyncio.sleep(max(0, scheduled - time.perf_counter()))
+            if tag == "EXIT":
+                break
+
+            frame = self.frame_for(tag, size, [p for p in peers if p is not self])
+            row = results.setdefault(tag, {"sent": 0, "skipped": 0, "errors": 0, "latencies": [], "lateness": []})
+            if frame is None:
+                row["skipped"] += 1
+                continue
+
+            row["lateness"].append(max(0.0, time.perf_counter() - scheduled))
+            self.pending = loop.create_future()
+            await self.send(frame)
+            row["sent"] += 1
+            try:
+                code = await asyncio.wait_for(self.pending, timeout=30)
+                row["latencies"].append(time.perf_counter() - scheduled)
+                if code == CODES.ERROR.value:
+                    row["errors"] += 1
+            except asyncio.TimeoutError:
+                row["errors"] += 1
+
+async def run(args) -> dict:
+    """Replay a trace and return the summary"""
+    header, records = load_trace(args.trace)
+    if header.get("protocol") != "json":
+        raise SystemExit("Only traces of server.py --json can be replayed")
+
+    sessions = sessions_from_trace(records)
+    if args.limit:
+        sessions = sessions[:args.limit]
+
+    stats = Stats()
+    private_key, public_key = generate_key_pair()
+    run_id = os.urandom(3).hex()
+    clients = [ReplayClient(s, f"replay{run_id}c{s.conn}", "replay-password", private_key, public_key, stats)
+               for s in sessions]
+    online = []
+    results: dict[str, dict] = {}
+    failures = 0
+    start = time.perf_counter()
+
+    async def play(client: ReplayClient) -> None:
+        nonlocal failures
+        session = client.session
+        await asyncio.sleep(max(0, start + session.opened / args.speed - time.perf_counter()))
+        try:
+            await client.connect(args.host, args.port)
+            if not session.authenticated:
+                # Connections that never logged in only contribute their arrival and lifetime
+                if session.closed is not None:
+                    await asyncio.sleep((session.closed - session.opened) / args.speed)
+                return
+
+            await client.register_and_login()
+            online.append(client)
+            receiver = asyncio.create_task(client.receive())
+            await client.replay(start, args.speed, online, results)
+            receiver.cancel()
+        except Exception as e:
+            failures += 1
+            print(f"Session {session.conn} failed: {e}", file=sys.stderr)
+        finally:
+            if client in online:
+                online.remove(client)
+            if client.writer is not None:
+                await client.close()
+
+    await asyncio.gather(*(play(c) for c in clients))
+    elapsed = time.perf_counter() - start
+    recorded = max((r[0] for r in records), default=0.0)
+
+    commands = {}
+    for tag, row in sorted(results.items()):
+        latencies, lateness = sorted(row["latencies"]), sorted(row["lateness"])
+        commands[tag] = {
+            "sent": row["sent"],
+            "skipped": row["skipped"],
+            "errors": row["errors"],
+            "p50_ms": percentile(latencies, 50) * 1000,
+            "p95_ms": percentile(latencies, 95) * 1000,
+            "p99_ms": percentile(latencies, 99) * 1000,
+            "late_p95_ms": percentile(lateness, 95) * 1000,
+        }
+
+    logins = sorted(stats.login_latencies)
+    return {
+        "trace": args.trace,
+        "sessions": len(sessions),
+        "logged_in": len(stats.login_latencies),
+        "failed": failures,
+        "recorded_seconds": round(recorded, 3),
+        "replay_seconds": round(elapsed, 3),
+        "speed": args.speed,
+        "login_p50_ms": percentile(logins, 50) * 1000,
+        "login_p95_ms": percentile(logins, 95) * 1000,
+        "delivered": sum(c.delivered for c in clients),
+        "commands": commands,
+    }
+
+def print_report(summary: dict) -> None:
+    """Human readable summary"""
+    print(f"Sessions:     {summary['sessions']} ({summary['logged_in']} logged in, {summary['failed']} failed)")
+    print(f"Duration:     recorded {summary['recorded_seconds']}s, replayed in {summary['replay_seconds']}s at {summary['speed']}x")
+    print(f"Login:        p50 {summary['login_p50_ms']:.1f} ms  p95 {summary['login_p95_ms']:.1f} ms")
+    print(f"{'command':<10} {'sent':>6} {'skip':>5} {'err':>5} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'late p95':>9}")
+    for tag, row in summary["commands"].items():
+        print(f"{tag:<10} {row['sent']:>6} {row['skipped']:>5} {row['errors']:>5} {row['p50_ms']:>9.1f} "
+              f"{row['p95_ms']:>9.1f} {row['p99_ms']:>9.1f} {row['late_p95_ms']:>9.1f}")
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Replay a recorded traffic shape against the chat server")
+    parser.add_argument("trace", help="file written by server.py --json --trace")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8888)
+    parser.add_argument("--spawn", action="store_true", help="start a throwaway server.py --json on a free port")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay this many times faster than recorded")
+    parser.add_argument("--limit", type=int, help="only replay the first N sessions")
+    parser.add_argument("--json-out", help="also write the summary as JSON to this file")
+    args = parser.parse_args()
+
+    server = None
+    workdir = None
+    if args.spawn:
+        workdir = tempfile.TemporaryDirectory()
+        args.host, args.port = "127.0.0.1", free_port()
+        server = spawn_server(args.port, workdir.name)
+
+    try:
+        if server is not None:
+            asyncio.run(wait_for_port(args.host, args.port))
+        summary = asyncio.run(run(args))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+            workdir.cleanup()
+
+    print_report(summary)
+    if args.json_out:
+        with open(args.json_out, "w") as f:
+            json.dump(summary, f, indent=2)
+
+if __name__ == "__main__":
+    main()
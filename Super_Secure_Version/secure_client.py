@@ -0,0 +1,738 @@
+# secure_client.py - Async headless client for the JSON protocol server
+"""
+Importable client for bots and integrations, built on SecureMessaging for keys
+and encryption. One reader task owns the socket and sorts incoming frames into
+replies to our commands and chat messages from other users, so sending never
+has to stop and wait on a raw read.
+
+    client = await SecureClient.connect("127.0.0.1", 8888)
+    await client.login("alice", "password")
+    await client.send("bob", "hi")
+    async for message in client:
+        print(message.sender, message.text)
+
+Files go through the server as encrypted chunks (crypto.stream), with the stream
+key sealed for the recipient:
+
+    sent = await client.send_file("bob", "photo.jpg")
+    offer = await client.next_offer()          # on bob's side
+    received = await client.recv_file(offer, "downloads/photo.jpg")
+"""
+import asyncio
+import base64
+import itertools
+import json
+import os
+import re
+import sys
+import time
+from collections import deque
+
+from crypto.encryption import decrypt_message
+from crypto.key_management import load_private_key, load_public_key
+from crypto.stream import StreamDecryptor, encrypt_file, new_stream_key, open_stream_key, read_chunks, seal_stream_key, stream_size
+from hash_utils import hash_password, compute_challenge_response
+from json_msg import CODES
+
+# client_utils.py is a directory, so it can't be imported as a package by name
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "client_utils.py"))
+from secure_messaging import SecureMessaging
+
+# Frames of servers that don't escape the msg field (the older versions)
+FRAME_START = '{"code": "'
+FRAME_RE = re.compile(r'\{"code": "([A-Z_]+)", "msg": "(.*)"\}\Z', re.S)
+MAX_FRAME = 1024 * 1024        # Largest frame waited for before the stream counts as garbage
+# "[01/01/2026, 12:00:00] alice: {...}" as relayed by check_send
+DELIVERY_RE = re.compile(r'\[([^\]]*)\] (\S+): (\{.*\})\Z', re.S)
+# SEND acknowledgement, carrying the fingerprint of the recipient's current key
+ACK_RE = re.compile(r'Message sent to (\S+) key=(\S+)\Z')
+
+REPLY_TIMEOUT = 30             # Seconds to wait for the server to answer a command
+PIPELINE_DEPTH = 256           # Tagged commands in flight at once per connection
+KEY_BATCH = 256                # Usernames per GETKEYS (the server's limit)
+FILE_PIECE = 32 * 1024         # Encrypted bytes per SENDFILE chunk
+FILE_WINDOW = 16               # SENDFILE chunks in flight at once
+FILE_POLL = 0.01               # First wait when the sender is behind, doubling up to FILE_POLL_MAX
+FILE_POLL_MAX = 0.5
+BUSY_BACKOFF = 1.0             # Seconds to wait when the server's spool is full
+
+"""
+Raised when the server refuses or fails a request.
+"""
+class ClientError(Exception):
+    pass
+
+def frame_complete(frame: str) -> bool:
+    """Whether the last unescaped frame in the buffer has fully arrived"""
+    return frame.endswith('"}') and frame.count("{") == frame.count("}")
+
+def parse_frame(frame: str) -> tuple[str, str, str | None] | None:
+    """(code, msg, request id) of one unescaped frame, None if it isn't one"""
+    match = FRAME_RE.match(frame)
+    return (match.group(1), match.group(2), None) if match else None
+
+def parse_offer(text: str) -> dict | None:
+    """The offer in a FILE frame, None if it isn't a well formed one"""
+    try:
+        offer = json.loads(text)
+    except ValueError:
+        return None
+    if (not isinstance(offer, dict) or not all(isinstance(offer.get(f), str) for f in ("id", "from", "name", "key"))
+            or not isinstance(offer.get("size"), int)):
+        return None
+    return offer
+
+"""
+Splits the server's byte stream into (code, msg) frames. Every frame is a JSON
+object, so a frame is only taken once it decodes whole, and the next one starts
+where it ends. Text relayed from other users is escaped inside the msg field and
+can't pass for a frame. legacy=True reads the older versions' unescaped frames
+instead, found by where the next one starts.
+"""
+class FrameReader:
+    def __init__(self, reader: asyncio.StreamReader, legacy: bool = False) -> None:
+        self.reader = reader
+        self.legacy = legacy
+        self.buffer = ""
+        self.frames = deque()
+        self.bytes_in = 0
+        self._decoder = json.JSONDecoder()
+
+    def split(self) -> None:
+        """Move every complete frame from the buffer to the frame queue"""
+        if self.legacy:
+            self._split_legacy()
+            return
+        pos = 0
+        while pos < len(self.buffer):
+            try:
+                fields, end = self._decoder.raw_decode(self.buffer, pos)
+            except ValueError:
+                # Not all here yet
+                if len(self.buffer) - pos > MAX_FRAME:
+                    raise ConnectionError("Malformed frame from server")
+                break
+            if (not isinstance(fields, dict) or not isinstance(fields.get("code"), str)
+                    or not isinstance(fields.get("msg"), str)):
+                raise ConnectionError("Malformed frame from server")
+            self.frames.append((fields["code"], fields["msg"], fields.get("id")))
+            pos = end
+        self.buffer = self.buffer[pos:]
+
+    def _split_legacy(self) -> None:
+        while True:
+            nxt = self.buffer.find(FRAME_START, 1)
+            if nxt == -1:
+                frame = self.buffer
+                if not frame_complete(frame):
+                    return
+                self.buffer = ""
+            else:
+                frame, self.buffer = self.buffer[:nxt], self.buffer[nxt:]
+
+            parsed = parse_frame(frame)
+            if parsed:
+                self.frames.append(parsed)
+            if not self.buffer:
+                return
+
+    async def next(self) -> tuple[str, str]:
+        """Wait for the next frame"""
+        code, text, _ = await self.next_frame()
+        return code, text
+
+    async def next_frame(self) -> tuple[str, str, str | None]:
+        """Wait for the next frame, with the request id it answers (None if untagged)"""
+        while not self.frames:
+            data = await self.reader.read(65536)
+            if not data:
+                raise ConnectionError("Server closed the connection")
+            self.bytes_in += len(data)
+            self.buffer += data.decode()
+            self.split()
+        return self.frames.popleft()
+
+    async def expect(self, *codes: CODES) -> str:
+        """Wait for the next frame with one of the given codes, skipping keepalives"""
+        while True:
+            code, text = await self.next()
+            if code == CODES.KEEPALIVE.value:
+                continue
+            if code in {c.value for c in codes}:
+                return text
+            raise ConnectionError(f"Expected {[c.value for c in codes]}, got {code}: {text[:80]}")
+
+"""
+A chat message received from another user, already decrypted. verified is None for
+an unsigned message, otherwise whether its signature checked out against the
+sender's key.
+"""
+class Message:
+    __slots__ = ("sender", "text", "timestamp", "verified")
+
+    def __init__(self, sender: str, text: str, timestamp: str, verified: bool | None = None) -> None:
+        self.sender = sender
+        self.text = text
+        self.timestamp = timestamp
+        self.verified = verified
+
+    def __repr__(self) -> str:
+        return (f"Message(sender={self.sender!r}, text={self.text!r}, timestamp={self.timestamp!r}, "
+                f"verified={self.verified!r})")
+
+"""
+One file being sent or received. It holds everything needed to carry on after a
+dropped connection: pass it to upload() or download() on a new client. size and
+offset count encrypted bytes, and bytes / seconds cover the last upload or download.
+"""
+class FileTransfer:
+    def __init__(self, transfer_id: str, peer: str, name: str, path: str, size: int, key: bytes) -> None:
+        self.id = transfer_id
+        self.peer = peer
+        self.name = name
+        self.path = path
+        self.size = size
+        self.key = key
+        self.offset = 0
+        self.prefix = None        # Sender: stream nonce prefix, so resumed chunks encrypt the same
+        self.source = None        # Sender: (size, mtime, inode) of the file when it was offered
+        self.decryptor = None     # Recipient: stream decryptor and the .part file it writes to
+        self.out = None
+        self.bytes = 0
+        self.seconds = 0.0
+
+    @property
+    def mb_per_s(self) -> float:
+        return self.bytes / self.seconds / 1e6 if self.seconds else 0.0
+
+    def source_changed(self) -> bool:
+        """
+        Whether the file to send differs from when it was offered. Resuming then would seal
+        different bytes under nonces already used, so the upload has to start over.
+        """
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return True
+        return (st.st_size, st.st_mtime_ns, st.st_ino) != self.source
+
+    def _store(self, data: bytes) -> None:
+        for chunk in self.decryptor.feed(data):
+            self.out.write(chunk)
+
+    def _finish(self) -> None:
+        """Check the last chunk and move the .part file into place"""
+        self.out.write(self.decryptor.finish())
+        self.out.close()
+        os.replace(self.path + ".part", self.path)
+
+    def __repr__(self) -> str:
+        return f"FileTransfer(id={self.id!r}, peer={self.peer!r}, name={self.name!r}, offset={self.offset}/{self.size})"
+
+"""
+Async client. After login every command is sent tagged with a request id
+("#<id>:<length> <command>") and its reply is matched through a table of pending
+futures, so many GETKEYs and SENDs can be in flight on one connection.
+"""
+class SecureClient:
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.reader = reader
+        self.writer = writer
+        self.frames = FrameReader(reader)
+        self.username = None
+        self.ticket = None
+        self._sealed_ticket = None
+        self.secure = None
+
+        # Frames that answer us, and chat messages for the inbound iterator
+        self.replies: asyncio.Queue = asyncio.Queue()
+        self.inbox: asyncio.Queue = asyncio.Queue()
+        self.offers: asyncio.Queue = asyncio.Queue()
+        # request id -> future resolved with (code, msg) of its reply
+        self.pending: dict[str, asyncio.Future] = {}
+        self._ids = itertools.count(1)
+        self._window = asyncio.Semaphore(PIPELINE_DEPTH)
+        self._key_requests: dict[str, asyncio.Task] = {}
+        self._reader_task = None
+        self._closed = asyncio.Event()
+        self._registered = False       # register() leaves the server at the login username prompt
+
+    @classmethod
+    async def connect(cls, host: str, port: int) -> "SecureClient":
+        """Open a connection and start the reader task"""
+        reader, writer = await asyncio.open_connection(host, port)
+        client = cls(reader, writer)
+        client._reader_task = asyncio.get_running_loop().create_task(client._read_frames())
+        return client
+
+    async def _read_frames(self) -> None:
+        """The only reader of the socket. Sorts frames into replies and inbound messages."""
+        try:
+            while True:
+                code, text, request_id = await self.frames.next_frame()
+                if request_id is not None:
+                    future = self.pending.pop(request_id, None)
+                    if future is not None and not future.done():
+                        future.set_result((code, text))
+                    continue
+                if code == CODES.KEEPALIVE.value:
+                    continue
+                if code == CODES.SUCCESS.value and self.secure is not None:
+                    delivery = DELIVERY_RE.match(text)
+                    if delivery:
+                        self.inbox.put_nowait(delivery.groups())
+                        continue
+                if code == CODES.FILE.value:
+                    offer = parse_offer(text)
+                    if offer is not None:
+                        self.offers.put_nowait(offer)
+                    continue
+                if code == CODES.TICKET.value:
+                    self._sealed_ticket = text
+                    continue
+                self.replies.put_nowait((code, text))
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self._closed.set()
+            # Wake anyone waiting on a reply or a message
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("Connection closed"))
+            self.pending.clear()
+            self.replies.put_nowait((CODES.EXIT.value, "Connection closed"))
+            self.inbox.put_nowait(None)
+            self.offers.put_nowait(None)
+
+    async def _reply(self, *codes: CODES) -> str:
+        """Next reply frame, which must have one of the given codes"""
+        code, text = await asyncio.wait_for(self.replies.get(), REPLY_TIMEOUT)
+        if code not in {c.value for c in codes}:
+            raise ClientError(text)
+        return text
+
+    async def _write(self, text: str) -> None:
+        self.writer.write(text.encode())
+        await self.writer.drain()
+
+    async def _command(self, text: str, *codes: CODES) -> str:
+        """Send one tagged command and wait for the reply carrying its id"""
+        async with self._window:
+            request_id = str(next(self._ids))
+            future = self.pending[request_id] = asyncio.get_running_loop().create_future()
+            payload = text.encode()
+            self.writer.write(f"#{request_id}:{len(payload)} ".encode() + payload)
+            try:
+                await self.writer.drain()
+                code, reply = await asyncio.wait_for(future, REPLY_TIMEOUT)
+            finally:
+                self.pending.pop(request_id, None)
+        if code not in {c.value for c in codes}:
+            raise ClientError(reply)
+        return reply
+
+    async def register(self, username: str, password: str, public_key: bytes) -> None:
+        """Create an account. The server then expects a login on the same connection."""
+        await self._reply(CODES.WRITE_BACK)
+        await self._write("2")
+        await self._reply(CODES.WRITE_BACK)
+        await self._write(username)
+        await self._reply(CODES.WRITE_BACK)
+        await self._write(password)
+        await self._reply(CODES.WRITE_BACK)
+        await self._write(public_key.decode())
+        result = await self._reply(CODES.NO_WRITE_BACK)
+        if "created successfully" not in result:
+            raise ClientError(result)
+        self._registered = True
+
+    async def login(self, username: str, password: str, private_key: bytes | None = None,
+                    public_key: bytes | None = None, ticket: str | None = None, key_store: bool = True,
+                    sign: bool = False) -> None:
+        """
+        Log in with the challenge/response exchange, or with a resume ticket if one is
+        given and still valid. Keys default to the ones saved under keys/. Other users'
+        keys are kept in keys/<username>_contacts.keys unless key_store is False. With
+        sign, every message sent is signed so recipients can tell it came from us.
+        """
+        private_key = private_key or load_private_key(username)
+        public_key = public_key or load_public_key(username)
+        if private_key is None:
+            raise ClientError(f"No private key for {username}")
+
+        secure = SecureMessaging(username, self.reader, self.writer, sign_messages=sign)
+        secure.private_key = private_key
+        secure.public_key = public_key
+
+        if not self._registered:
+            await self._reply(CODES.WRITE_BACK)
+            if ticket:
+                await self._write(f"RESUME {ticket}")
+                code, _ = await asyncio.wait_for(self.replies.get(), REPLY_TIMEOUT)
+                if code == CODES.AUTHENTICATED.value:
+                    await self._open_ticket(secure.private_keys)
+                    self._logged_in(username, secure, key_store)
+                    return
+                # Ticket rejected, the server falls through to the username prompt
+            else:
+                await self._write("1")
+        self._registered = False
+
+        await self._reply(CODES.WRITE_BACK)
+        await self._write(username)
+        challenge_msg = await self._reply(CODES.WRITE_BACK)
+        if not challenge_msg.startswith("CHALLENGE "):
+            raise ClientError(challenge_msg)
+
+        challenge = await asyncio.to_thread(secure.decrypt_received_message, challenge_msg[len("CHALLENGE "):])
+        await self._write("GET_SALT")
+        salt = await self._reply(CODES.SALT)
+        password_hash = await asyncio.to_thread(hash_password, password, salt)
+        await self._write(compute_challenge_response(password_hash, challenge))
+        await self._reply(CODES.AUTHENTICATED)
+        await self._open_ticket(secure.private_keys)
+        self._logged_in(username, secure, key_store)
+
+    async def _open_ticket(self, private_key: tuple) -> None:
+        """Decrypt the resume ticket the server sealed to our key during login"""
+        sealed, self._sealed_ticket = self._sealed_ticket, None
+        if sealed is None:
+            return
+        try:
+            self.ticket = await asyncio.to_thread(decrypt_message, sealed, private_key)
+        except Exception:
+            self.ticket = None
+
+    def _logged_in(self, username: str, secure: SecureMessaging, key_store: bool) -> None:
+        if key_store:
+            secure.use_key_store()
+        # Our reader task owns the socket, so SecureMessaging's requests go through it
+        secure.command = lambda text: self._command(text, CODES.SUCCESS)
+        self.username, self.secure = username, secure
+
+    async def get_key(self, username: str) -> bytes:
+        """A user's public key, from the cache or the server. Concurrent lookups share one GETKEY."""
+        cache = self.secure.public_keys_cache
+        if username in cache:
+            return cache[username]
+
+        request = self._key_requests.get(username)
+        if request is None:
+            request = self._key_requests[username] = asyncio.ensure_future(self._fetch_key(username))
+            request.add_done_callback(lambda _: self._key_requests.pop(username, None))
+        return await asyncio.shield(request)
+
+    async def _fetch_key(self, username: str) -> bytes:
+        reply = await self._command(f"GETKEY {username}", CODES.SUCCESS)
+        parts = reply.split(" ", 2)
+        if len(parts) != 3 or parts[0] != "KEY" or parts[1] != username:
+            raise ClientError(f"Unexpected GETKEY reply: {reply[:80]}")
+        key = self.secure.public_keys_cache[username] = parts[2].encode()
+        return key
+
+    async def get_keys(self, usernames) -> dict[str, bytes]:
+        """
+        Public keys of several users, fetching every one not yet cached with GETKEYS
+        (one round trip per KEY_BATCH names). Users without a key are left out.
+        """
+        cache = self.secure.public_keys_cache
+        usernames = list(dict.fromkeys(usernames))
+        missing = [u for u in usernames if u not in cache]
+        batches = [missing[i:i + KEY_BATCH] for i in range(0, len(missing), KEY_BATCH)]
+        for reply in await asyncio.gather(*(self._command("GETKEYS " + " ".join(b), CODES.SUCCESS) for b in batches)):
+            if not reply.startswith("KEYS "):
+                raise ClientError(f"Unexpected GETKEYS reply: {reply[:80]}")
+            for username, key in json.loads(reply[len("KEYS "):]).items():
+                if key is not None:
+                    cache[username] = key.encode()
+        return {u: cache[u] for u in usernames if u in cache}
+
+    async def presence(self) -> dict[str, str | None]:
+        """Online users and their key fingerprints. Cached keys that changed are dropped."""
+        reply = await self._command("PRESENCE", CODES.SUCCESS)
+        if not reply.startswith("PRESENCE "):
+            raise ClientError(f"Unexpected PRESENCE reply: {reply[:80]}")
+        fingerprints = json.loads(reply[len("PRESENCE "):])
+        for username, fingerprint in fingerprints.items():
+            self.secure.public_keys_cache.validate(username, fingerprint)
+        return fingerprints
+
+    async def roster(self) -> list[str]:
+        """Usernames currently online"""
+        return list(await self.presence())
+
+    async def warm_keys(self, usernames=None) -> int:
+        """Fill the key cache for these users (everyone online by default), returns how many are cached"""
+        if usernames is None:
+            usernames = [u for u in await self.roster() if u != self.username]
+        return len(await self.get_keys(usernames))
+
+    async def _encrypt(self, recipient: str, text: str) -> str:
+        key = await self.get_key(recipient)
+        return await asyncio.to_thread(self.secure.seal_message, text, recipient, key)
+
+    def _check_ack(self, reply: str) -> bool:
+        """
+        Compare the recipient's key fingerprint in a SEND ack with the cached key.
+        On a mismatch the key is dropped, so the next send fetches the new one.
+        """
+        ack = ACK_RE.match(reply)
+        if ack is None or ack.group(2) == "None":
+            return True
+        return self.secure.public_keys_cache.validate(ack.group(1), ack.group(2))
+
+    async def send(self, recipient: str, text: str) -> bool:
+        """
+        Encrypt and send one message, returns once the server confirmed it. False if
+        the recipient's key had changed, so the message went out under the old key.
+        """
+        ciphertext = await self._encrypt(recipient, text)
+        return self._check_ack(await self._command(f"SEND {ciphertext} TO {recipient}", CODES.SUCCESS))
+
+    async def send_many(self, messages) -> int:
+        """
+        Send (recipient, text) pairs, pipelined. Missing keys are fetched with one
+        GETKEYS, the batch is encrypted in one worker thread hop, then every SEND goes
+        out in order without waiting for the one before. Returns the number the server
+        confirmed.
+        """
+        messages = list(messages)
+        keys = await self.get_keys(recipient for recipient, _ in messages)
+        for recipient, _ in messages:
+            if recipient not in keys:
+                raise ClientError(f"No public key found for {recipient}")
+        ciphertexts = await asyncio.to_thread(
+            lambda: [self.secure.seal_message(text, recipient, keys[recipient]) for recipient, text in messages]
+        )
+        results = await asyncio.gather(
+            *(self._command(f"SEND {ciphertext} TO {recipient}", CODES.SUCCESS)
+              for (recipient, _), ciphertext in zip(messages, ciphertexts)),
+            return_exceptions=True,
+        )
+        replies = [result for result in results if not isinstance(result, Exception)]
+        for reply in replies:
+            self._check_ack(reply)
+        return len(replies)
+
+    async def offer_file(self, recipient: str, path: str) -> FileTransfer:
+        """Tell the server about a file for recipient, with a fresh stream key sealed for them"""
+        key = new_stream_key()
+        sealed_key = await asyncio.to_thread(seal_stream_key, key, await self.get_key(recipient))
+        name = re.sub(r"[^\w .\-]", "_", os.path.basename(path))[:255] or "file"
+        st = os.stat(path)
+        size = stream_size(st.st_size)
+        offer = {"to": recipient, "name": name, "size": size, "key": sealed_key}
+        reply = await self._command("SENDFILE " + json.dumps(offer, separators=(',', ':')), CODES.SUCCESS)
+        transfer = FileTransfer(reply.split(" ")[1], recipient, name, path, size, key)
+        transfer.prefix = os.urandom(7)
+        transfer.source = (st.st_size, st.st_mtime_ns, st.st_ino)
+        return transfer
+
+    async def upload(self, transfer: FileTransfer) -> FileTransfer:
+        """
+        Send a file offered with offer_file, starting from wherever the server says the
+        transfer got to, so it also resumes an upload cut short on another connection.
+        """
+        started = time.perf_counter()
+        first = None
+        while True:
+            reply = await self._command("SENDFILE " + json.dumps({"id": transfer.id}), CODES.SUCCESS)
+            transfer.offset = int(reply.split(" ")[2])
+            if first is None:
+                first = transfer.offset
+            if transfer.offset >= transfer.size:
+                break
+            if not await self._upload_from(transfer):
+                await asyncio.sleep(BUSY_BACKOFF)
+        transfer.bytes, transfer.seconds = transfer.size - first, time.perf_counter() - started
+        return transfer
+
+    async def _upload_from(self, transfer: FileTransfer) -> bool:
+        """
+        Encrypt and send chunks from transfer.offset on, FILE_WINDOW at a time, reading
+        the file one piece at a time. False if the server pushed back (BUSY). Refuses to
+        go on if the file changed since it was offered.
+        """
+        if transfer.source_changed():
+            raise ClientError(f"{transfer.path} changed since it was offered, send it again as a new file")
+        pieces = read_chunks(encrypt_file(transfer.path, transfer.key, transfer.prefix, transfer.offset), FILE_PIECE)
+        window = asyncio.Semaphore(FILE_WINDOW)
+        in_flight = set()
+        busy = False
+        error = None
+
+        async def put(offset: int, piece: bytes) -> None:
+            nonlocal busy, error
+            try:
+                reply = await self._command(f"SENDFILE {transfer.id} {offset} {base64.b64encode(piece).decode()}", CODES.SUCCESS)
+                transfer.offset = max(transfer.offset, int(reply.split(" ")[2]))
+            except ClientError as e:
+                if str(e).startswith("BUSY "):
+                    busy = True
+                else:
+                    error = e
+            except Exception as e:
+                error = e
+            finally:
+                window.release()
+
+        offset = transfer.offset
+        while not busy and error is None:
+            piece = await asyncio.to_thread(next, pieces, None)
+            if piece is None:
+                break
+            await window.acquire()
+            task = asyncio.ensure_future(put(offset, piece))
+            in_flight.add(task)
+            task.add_done_callback(in_flight.discard)
+            offset += len(piece)
+        await asyncio.gather(*in_flight)
+        if error is not None:
+            raise error
+        return not busy
+
+    async def send_file(self, recipient: str, path: str) -> FileTransfer:
+        """Offer and upload a file, returns the finished transfer (see mb_per_s)"""
+        return await self.upload(await self.offer_file(recipient, path))
+
+    async def next_offer(self) -> dict | None:
+        """Wait for the next file offered to us while connected, None once the connection closes"""
+        offer = await self.offers.get()
+        if offer is None:
+            self.offers.put_nowait(None)
+        return offer
+
+    async def files(self) -> list[dict]:
+        """Every file waiting for us, including ones offered while we were offline"""
+        reply = await self._command("RECVFILE", CODES.SUCCESS)
+        if not reply.startswith("FILES "):
+            raise ClientError(f"Unexpected RECVFILE reply: {reply[:80]}")
+        return json.loads(reply[len("FILES "):])
+
+    async def accept_file(self, offer: dict, path: str) -> FileTransfer:
+        """Open the stream key of an offer, ready to download it to path"""
+        key = await asyncio.to_thread(open_stream_key, offer["key"], self.secure.private_keys)
+        transfer = FileTransfer(offer["id"], offer["from"], offer["name"], path, offer["size"], key)
+        transfer.decryptor = StreamDecryptor(key)
+        transfer.out = open(path + ".part", "wb")
+        return transfer
+
+    async def download(self, transfer: FileTransfer) -> FileTransfer:
+        """
+        Fetch, decrypt and write a file from transfer.offset on, waiting for the sender
+        when it is behind. Each chunk is decrypted and written as it arrives, and the
+        file only appears at its path once every chunk has checked out.
+        """
+        started = time.perf_counter()
+        first = transfer.offset
+        delay = FILE_POLL
+        while True:
+            reply = await self._command(f"RECVFILE {transfer.id} {transfer.offset}", CODES.SUCCESS)
+            if reply.startswith("FILEEND "):
+                break
+            parts = reply.split(" ", 3)
+            if len(parts) != 4 or parts[0] != "FILEDATA":
+                raise ClientError(f"Unexpected RECVFILE reply: {reply[:80]}")
+            data = base64.b64decode(parts[3])
+            if not data:
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, FILE_POLL_MAX)
+                continue
+            delay = FILE_POLL
+            await asyncio.to_thread(transfer._store, data)
+            transfer.offset += len(data)
+        await asyncio.to_thread(transfer._finish)
+        transfer.bytes, transfer.seconds = transfer.offset - first, time.perf_counter() - started
+        return transfer
+
+    async def recv_file(self, offer: dict, path: str) -> FileTransfer:
+        """Accept and download an offered file, returns the finished transfer (see mb_per_s)"""
+        return await self.download(await self.accept_file(offer, path))
+
+    async def users(self) -> str:
+        """The server's list of online users"""
+        return await self._command("GETUSERS", CODES.SUCCESS)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> Message:
+        """Next chat message, decrypted. Stops when the connection closes."""
+        item = await self.inbox.get()
+        if item is None:
+            self.inbox.put_nowait(None)
+            raise StopAsyncIteration
+        return (await self._open([item]))[0]
+
+    async def receive_many(self, limit: int | None = None) -> list[Message]:
+        """
+        Every message already waiting (up to limit), waiting for one if none are.
+        The batch is decrypted in one worker thread hop and signatures are checked
+        together, so draining a backlog costs far less than iterating. Empty once the
+        connection has closed.
+        """
+        items = [await self.inbox.get()]
+        while not self.inbox.empty() and (limit is None or len(items) < limit):
+            items.append(self.inbox.get_nowait())
+        if items[-1] is None:
+            items.pop()
+            self.inbox.put_nowait(None)
+        return await self._open(items) if items else []
+
+    async def _open(self, items: list) -> list[Message]:
+        """Decrypt (timestamp, sender, ciphertext) deliveries and check the signed ones"""
+        opened = await asyncio.to_thread(lambda: [self.secure.open_message(ciphertext) for _, _, ciphertext in items])
+        messages = [Message(sender, text, timestamp) for (timestamp, sender, _), (text, _) in zip(items, opened)]
+        signed = [(message, signature) for message, (_, signature) in zip(messages, opened) if signature is not None]
+        if signed:
+            await self._verify(signed)
+        return messages
+
+    async def _verify(self, signed: list) -> None:
+        """
+        Set verified on (message, signature) pairs. Signatures that fail against a
+        cached key are tried once more with a freshly fetched one, in case the sender
+        changed keys since.
+        """
+        cache = self.secure.public_keys_cache
+        for attempt in range(2):
+            try:
+                keys = await self.get_keys({message.sender for message, _ in signed})
+            except (ClientError, ConnectionError):
+                keys = {}
+            checked = [(message, signature) for message, signature in signed if message.sender in keys]
+            results = await asyncio.to_thread(self.secure.verify_opened,
+                                              [(m.sender, keys[m.sender], m.text, sig) for m, sig in checked])
+            for (message, _), ok in zip(checked, results):
+                message.verified = ok
+            signed = [(message, signature) for message, signature in signed if not message.verified]
+            if not signed or attempt:
+                break
+            for sender in {message.sender for message, _ in signed}:
+                if sender in cache:
+                    del cache[sender]
+        for message, _ in signed:
+            message.verified = False
+
+    async def close(self) -> None:
+        """Say goodbye and close the connection"""
+        if not self._closed.is_set():
+            try:
+                await self._write("EXIT")
+            except ConnectionError:
+                pass
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except ConnectionError:
+            pass
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+        if self.secure is not None:
+            self.secure.close()
+
+    async def __aenter__(self) -> "SecureClient":
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        await self.close()
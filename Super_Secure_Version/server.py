@@ -1,12 +1,40 @@
+import argparse
 import asyncio
 import json
 import os
+import signal
 import base64
 import sqlite3
 import hashlib
 import hmac
+import time
 from crypto.encryption import encrypt_message
+from crypto.key_management import key_fingerprint
 from hash_utils import generate_salt, hash_password, compute_challenge_response
+from server_timers import connections
+from server_admission import admission, AdmissionRejected
+from server_ratelimit import login_limiter
+from server_challenges import challenges
+from server_tickets import tickets
+from server_transfers import transfers
+from server_auth import authenticate_user, FailedAuth
+from server_interclient_comms import client_to_client_comms
+from server_utils import send_user_msg
+from json_msg import CODES
+from server_metrics import metrics
+from server_admin import admin
+from server_watchdog import watchdog
+from server_logging import get_logger, setup_logging, logging_stats
+from server_profiler import profiler
+from server_trace import tracer
+
+log = get_logger("server")
+command_log = get_logger("commands")     # Sampled, one record per command
+
+# Plain text protocol metrics, looked up once so recording is just an increment
+chat_command_seconds = {cmd: metrics.histogram("command_seconds", {"cmd": cmd}, "Time to handle a client command")
+                        for cmd in ("GETUSERS", "HELP", "SEND", "UNKNOWN")}
+login_seconds = metrics.histogram("auth_seconds", {"protocol": "text"}, "Whole login exchange")
 
 # Constants
 HOST = '127.0.0.1'
@@ -15,6 +43,12 @@ PORT = 8888
 # Active clients
 clients = {}
 
+# Active clients on the JSON msg protocol (server_auth / server_interclient_comms)
+json_clients = {}
+
+metrics.gauge("clients", {"protocol": "text"}, "Logged in clients", fn=lambda: len(clients))
+metrics.gauge("clients", {"protocol": "json"}, "Logged in clients", fn=lambda: len(json_clients))
+
 def init_database():
     """Initialize the database"""
     conn = sqlite3.connect("chat.db")
@@ -33,13 +67,34 @@ def init_database():
     CREATE TABLE IF NOT EXISTS public_keys (
         username TEXT PRIMARY KEY,
         public_key TEXT NOT NULL,
+        key_version INTEGER NOT NULL DEFAULT 1,
+        fingerprint TEXT NOT NULL DEFAULT '',
         FOREIGN KEY (username) REFERENCES members(username)
     )
     ''')
     
+    # Databases from before key versioning: add the columns and fingerprint existing keys
+    columns = {row[1] for row in cur.execute("PRAGMA table_info(public_keys)")}
+    if "key_version" not in columns:
+        cur.execute("ALTER TABLE public_keys ADD COLUMN key_version INTEGER NOT NULL DEFAULT 1")
+    if "fingerprint" not in columns:
+        cur.execute("ALTER TABLE public_keys ADD COLUMN fingerprint TEXT NOT NULL DEFAULT ''")
+    rows = cur.execute("SELECT username, public_key FROM public_keys WHERE fingerprint = ''").fetchall()
+    cur.executemany("UPDATE public_keys SET fingerprint = ? WHERE username = ?",
+                    [(key_fingerprint(key), username) for username, key in rows])
+    
+    # Used by the JSON protocol login in server_auth
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS auth_challenges (
+        username TEXT PRIMARY KEY,
+        challenge TEXT NOT NULL,
+        timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''')
+    
     conn.commit()
     conn.close()
-    print("Database initialized.")
+    log.info("database initialized")
 
 def user_exists(username):
     """Check if a user exists"""
@@ -64,14 +119,14 @@ def create_user(username, password_hash, salt, public_key):
         
         # Insert into public_keys table
         cur.execute(
-            "INSERT INTO public_keys (username, public_key) VALUES (?, ?)",
-            (username, public_key)
+            "INSERT INTO public_keys (username, public_key, fingerprint) VALUES (?, ?, ?)",
+            (username, public_key, key_fingerprint(public_key))
         )
         
         conn.commit()
         return True
     except Exception as e:
-        print(f"Error creating user: {e}")
+        log.error("create user failed", extra={"user": username, "error": str(e)})
         return False
     finally:
         conn.close()
@@ -96,15 +151,234 @@ def get_user_data(username):
             }
         return None
     except Exception as e:
-        print(f"Error getting user data: {e}")
+        log.error("get user data failed", extra={"user": username, "error": str(e)})
         return None
     finally:
         conn.close()
 
+async def read_client(reader, writer, n=1024):
+    """Read from a client and record the activity for timeout tracking"""
+    data = await reader.read(n)
+    connections.touch(writer)
+    return data
+
+async def register_client(reader, writer):
+    """Run the registration exchange with a client"""
+    # Hashing the new password costs an scrypt run, so rate limit it
+    addr = writer.get_extra_info('peername')
+    if not login_limiter.allow_ip(addr[0] if addr else "unknown"):
+        writer.write("Too many attempts. Try again later.".encode())
+        await writer.drain()
+        return
+    
+    # Send username prompt
+    writer.write("Enter username:".encode())
+    await writer.drain()
+    
+    # Get username
+    username_data = await read_client(reader, writer, 1024)
+    if not username_data:
+        return
+    
+    username = username_data.decode().strip()
+    
+    # Check if username exists
+    if user_exists(username):
+        writer.write(f"Username {username} already exists".encode())
+        await writer.drain()
+        return
+    
+    # Send password prompt
+    writer.write("Enter password:".encode())
+    await writer.drain()
+    
+    # Get password
+    password_data = await read_client(reader, writer, 1024)
+    if not password_data:
+        return
+    
+    password = password_data.decode().strip()
+    
+    # Generate salt
+    salt = generate_salt()
+    
+    # Hash password, in an auth slot
+    password_hash = await admission.auth_work(hash_password, password, salt)
+    
+    # Prompt for public key
+    writer.write("Send public key:".encode())
+    await writer.drain()
+    
+    # Get public key
+    public_key_data = await read_client(reader, writer, 2048)
+    if not public_key_data:
+        return
+    
+    public_key = public_key_data.decode().strip()
+    
+    # Create user
+    if create_user(username, password_hash, salt, public_key):
+        writer.write(f"User {username} created successfully!".encode())
+        await writer.drain()
+    else:
+        writer.write("Error creating user".encode())
+        await writer.drain()
+
+async def login_client(reader, writer):
+    """Run the challenge/response login with a client. Returns the username on success."""
+    # Send username prompt
+    writer.write("Enter username:".encode())
+    await writer.drain()
+    
+    # Get username
+    username_data = await read_client(reader, writer, 1024)
+    if not username_data:
+        return None
+    
+    username = username_data.decode().strip()
+    log.info("login attempt", extra={"user": username})
+    
+    # Rate limit before touching the DB or doing any crypto. The username only pays for failures.
+    addr = writer.get_extra_info('peername')
+    ip = addr[0] if addr else "unknown"
+    if not login_limiter.allow_ip(ip) or not login_limiter.allow_user(username):
+        writer.write("Too many login attempts. Try again later.".encode())
+        await writer.drain()
+        return None
+    
+    # Check if user exists
+    if not user_exists(username):
+        writer.write(f"Username {username} not found".encode())
+        await writer.drain()
+        login_limiter.fail_user(username)
+        return None
+    
+    # Get user data
+    user_data = get_user_data(username)
+    if not user_data or not user_data["public_key"]:
+        writer.write("Error retrieving user data".encode())
+        await writer.drain()
+        return None
+    
+    # Pick a challenge from the pool, already encrypted with the user's key if we have one
+    try:
+        challenge_b64, encrypted_challenge = challenges.take_for(username, user_data["public_key"])
+        if encrypted_challenge is None:
+            encrypted_challenge = await admission.auth_work(challenges.encrypt, challenge_b64, user_data["public_key"])
+        
+        # Send challenge
+        writer.write(f"CHALLENGE {encrypted_challenge}".encode())
+        await writer.drain()
+        
+        # Wait for salt request
+        salt_request = await read_client(reader, writer, 1024)
+        if not salt_request or salt_request.decode().strip() != "GET_SALT":
+            writer.write("Invalid salt request".encode())
+            await writer.drain()
+            login_limiter.fail_user(username)
+            return None
+        
+        # Send salt
+        salt_msg = json.dumps({"code": "SALT", "msg": user_data["salt"]})
+        writer.write(salt_msg.encode())
+        await writer.drain()
+        
+        # Get response
+        response_data = await read_client(reader, writer, 1024)
+        if not response_data:
+            return None
+        
+        response = response_data.decode().strip()
+        
+        # Compute expected response
+        expected = await admission.auth_work(compute_challenge_response, user_data["password_hash"], challenge_b64)
+        
+        # Verify
+        if hmac.compare_digest(expected, response):
+            # Authentication successful
+            login_limiter.clear_user(username)
+            writer.write(f"Hello {username}! Login successful.".encode())
+            await writer.drain()
+            return username
+        
+        writer.write("Authentication failed".encode())
+        await writer.drain()
+        login_limiter.fail_user(username)
+    except AdmissionRejected:
+        raise
+    except Exception as e:
+        log.error("login failed", extra={"error": str(e)})
+        login_limiter.fail_user(username)
+        writer.write(f"Login error: {str(e)}".encode())
+        await writer.drain()
+    return None
+
+async def chat_loop(reader, writer, username):
+    """Relay commands for an authenticated client until it leaves"""
+    clients[username] = writer
+    connections.mark_authenticated(writer)
+    
+    try:
+        while True:
+            cmd_data = await read_client(reader, writer, 1024)
+            if not cmd_data:
+                break
+            
+            started = time.perf_counter_ns()
+            cmd = cmd_data.decode().strip()
+            
+            command_log.info("command", extra={"user": username, "cmd": cmd.split(" ", 1)[0].upper(), "bytes": len(cmd_data)})
+
+            if cmd.upper() == "EXIT":
+                break
+            elif cmd.upper() == "GETUSERS":
+                name = "GETUSERS"
+                writer.write(f"Active users: {list(clients.keys())}".encode())
+                await writer.drain()
+            elif cmd.upper() == "HELP":
+                name = "HELP"
+                help_text = "Commands: GETUSERS, HELP, SEND message TO username, EXIT"
+                writer.write(help_text.encode())
+                await writer.drain()
+            elif cmd.upper().startswith("SEND ") and " TO " in cmd:
+                name = "SEND"
+                parts = cmd.split(" TO ", 1)
+                message = parts[0][5:]  # Skip "SEND "
+                recipient = parts[1]
+                
+                if recipient in clients:
+                    clients[recipient].write(f"[{username}]: {message}".encode())
+                    await clients[recipient].drain()
+                    writer.write(f"Message sent to {recipient}".encode())
+                    await writer.drain()
+                else:
+                    writer.write(f"User {recipient} not online".encode())
+                    await writer.drain()
+            else:
+                name = "UNKNOWN"
+                writer.write("Unknown command. Type HELP for commands.".encode())
+                await writer.drain()
+            
+            chat_command_seconds[name].record(time.perf_counter_ns() - started)
+    finally:
+        if username in clients:
+            del clients[username]
+
 async def handle_client(reader, writer):
     """Handle a client connection"""
     addr = writer.get_extra_info('peername')
-    print(f"New connection from {addr}")
+    ip = addr[0] if addr else "unknown"
+    
+    # Refuse the connection outright if we are at capacity
+    if not admission.admit(ip):
+        log.warning("connection rejected", extra={"addr": addr})
+        writer.write("Server busy, try again later".encode())
+        writer.close()
+        return
+    
+    log.info("connection opened", extra={"addr": addr})
+    connections.register(writer, "text")
+    tracer.attach(reader, writer)
     
     try:
         # Send welcome message
@@ -112,207 +386,187 @@ async def handle_client(reader, writer):
         await writer.drain()
         
         # Get choice
-        choice_data = await reader.read(1024)
+        choice_data = await read_client(reader, writer, 1024)
         if not choice_data:
             return
         
         choice = choice_data.decode().strip()
         
+        # Only the crypto calls of these exchanges hold an auth slot, not the reads
         if choice == "2":  # REGISTER
-            # Send username prompt
-            writer.write("Enter username:".encode())
-            await writer.drain()
-            
-            # Get username
-            username_data = await reader.read(1024)
-            if not username_data:
-                return
-            
-            username = username_data.decode().strip()
-            
-            # Check if username exists
-            if user_exists(username):
-                writer.write(f"Username {username} already exists".encode())
-                await writer.drain()
-                return
-            
-            # Send password prompt
-            writer.write("Enter password:".encode())
-            await writer.drain()
-            
-            # Get password
-            password_data = await reader.read(1024)
-            if not password_data:
-                return
-            
-            password = password_data.decode().strip()
-            
-            # Generate salt
-            salt = generate_salt()
-            
-            # Hash password
-            password_hash = hash_password(password, salt)
-            
-            # Prompt for public key
-            writer.write("Send public key:".encode())
-            await writer.drain()
-            
-            # Get public key
-            public_key_data = await reader.read(2048)
-            if not public_key_data:
-                return
-            
-            public_key = public_key_data.decode().strip()
-            
-            # Create user
-            if create_user(username, password_hash, salt, public_key):
-                writer.write(f"User {username} created successfully!".encode())
-                await writer.drain()
-            else:
-                writer.write("Error creating user".encode())
-                await writer.drain()
+            await register_client(reader, writer)
         
         elif choice == "1":  # LOGIN
-            # Send username prompt
-            writer.write("Enter username:".encode())
-            await writer.drain()
-            
-            # Get username
-            username_data = await reader.read(1024)
-            if not username_data:
-                return
-            
-            username = username_data.decode().strip()
-            print(f"Login attempt: {username}")
-            
-            # Check if user exists
-            if not user_exists(username):
-                writer.write(f"Username {username} not found".encode())
-                await writer.drain()
-                return
-            
-            # Get user data
-            user_data = get_user_data(username)
-            if not user_data or not user_data["public_key"]:
-                writer.write("Error retrieving user data".encode())
-                await writer.drain()
-                return
+            with login_seconds.timer():
+                username = await login_client(reader, writer)
             
-            # Generate challenge
-            challenge = os.urandom(32)
-            challenge_b64 = base64.b64encode(challenge).decode()
-            
-            # Encrypt challenge
-            try:
-                encrypted_challenge = encrypt_message(challenge_b64, user_data["public_key"].encode())
-                
-                # Send challenge
-                writer.write(f"CHALLENGE {encrypted_challenge}".encode())
-                await writer.drain()
-                
-                # Wait for salt request
-                salt_request = await reader.read(1024)
-                if not salt_request or salt_request.decode().strip() != "GET_SALT":
-                    writer.write("Invalid salt request".encode())
-                    await writer.drain()
-                    return
-                
-                # Send salt
-                salt_msg = json.dumps({"code": "SALT", "msg": user_data["salt"]})
-                writer.write(salt_msg.encode())
-                await writer.drain()
-                
-                # Get response
-                response_data = await reader.read(1024)
-                if not response_data:
-                    return
-                
-                response = response_data.decode().strip()
-                
-                # Compute expected response
-                expected = compute_challenge_response(user_data["password_hash"], challenge_b64)
-                
-                # Verify
-                if hmac.compare_digest(expected, response):
-                    # Authentication successful
-                    writer.write(f"Hello {username}! Login successful.".encode())
-                    await writer.drain()
-                    
-                    # Chat loop
-                    clients[username] = writer
-                    
-                    try:
-                        while True:
-                            cmd_data = await reader.read(1024)
-                            if not cmd_data:
-                                break
-                            
-                            cmd = cmd_data.decode().strip()
-                            
-                            print(cmd, cmd.upper())
-
-                            if cmd.upper() == "EXIT":
-                                break
-                            elif cmd.upper() == "GETUSERS":
-                                writer.write(f"Active users: {list(clients.keys())}".encode())
-                                await writer.drain()
-                            elif cmd.upper() == "HELP":
-                                help_text = "Commands: GETUSERS, HELP, SEND message TO username, EXIT"
-                                writer.write(help_text.encode())
-                                await writer.drain()
-                            elif cmd.upper().startswith("SEND ") and " TO " in cmd:
-                                parts = cmd.split(" TO ", 1)
-                                message = parts[0][5:]  # Skip "SEND "
-                                recipient = parts[1]
-                                
-                                if recipient in clients:
-                                    clients[recipient].write(f"[{username}]: {message}".encode())
-                                    await clients[recipient].drain()
-                                    writer.write(f"Message sent to {recipient}".encode())
-                                    await writer.drain()
-                                else:
-                                    writer.write(f"User {recipient} not online".encode())
-                                    await writer.drain()
-                            else:
-                                writer.write("Unknown command. Type HELP for commands.".encode())
-                                await writer.drain()
-                    finally:
-                        if username in clients:
-                            del clients[username]
-                else:
-                    writer.write("Authentication failed".encode())
-                    await writer.drain()
-            except Exception as e:
-                print(f"Error during login: {e}")
-                writer.write(f"Login error: {str(e)}".encode())
-                await writer.drain()
+            if username:
+                await chat_loop(reader, writer, username)
         else:
             writer.write("Invalid choice".encode())
             await writer.drain()
     
+    except AdmissionRejected as e:
+        writer.write(str(e).encode())
+        await writer.drain()
+    
     except Exception as e:
-        print(f"Error handling client: {e}")
+        log.error("client handler failed", extra={"addr": addr, "error": str(e)})
     
     finally:
+        connections.unregister(writer)
+        tracer.detach(writer)
+        admission.release(ip)
         writer.close()
         await writer.wait_closed()
-        print(f"Connection closed with {addr}")
+        log.info("connection closed", extra={"addr": addr})
+
+async def handle_json_client(reader, writer):
+    """Handle a client speaking the JSON msg protocol (authenticate_user, then client_to_client_comms)"""
+    addr = writer.get_extra_info('peername')
+    ip = addr[0] if addr else "unknown"
+    
+    # Refuse the connection outright if we are at capacity
+    if not admission.admit(ip):
+        log.warning("connection rejected", extra={"addr": addr})
+        writer.write(f'{{"code": "{CODES.EXIT.value}", "msg": "Server busy, try again later"}}'.encode())
+        writer.close()
+        return
+    
+    log.info("connection opened", extra={"addr": addr})
+    connections.register(writer)
+    tracer.attach(reader, writer)
+    username = ""
+    
+    try:
+        client = await authenticate_user(reader, writer)
+        
+        if client.username not in json_clients:
+            username = client.username
+            json_clients[username] = client
+            await client_to_client_comms(client, json_clients)
+        else:
+            await send_user_msg(f"User {client.username} already logged in. Closing connection", CODES.NO_WRITE_BACK, writer)
+        
+        await send_user_msg("Server is closing connection with you", CODES.EXIT, writer)
+    
+    except FailedAuth:
+        await send_user_msg("Authentication failed. Closing connection", CODES.EXIT, writer)
+    
+    except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+        log.info("connection lost", extra={"addr": addr})
+    
+    except Exception as e:
+        log.error("client handler failed", extra={"addr": addr, "error": str(e)})
+    
+    finally:
+        if username:
+            json_clients.pop(username, None)
+        connections.unregister(writer)
+        tracer.detach(writer)
+        admission.release(ip)
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except ConnectionError:
+            pass
+        log.info("connection closed", extra={"addr": addr})
+
+def relax_limits():
+    """Lift the per-IP and login rate limits, for load tests driven from a single host"""
+    admission.max_per_ip = admission.max_connections
+    for table in (login_limiter.by_ip, login_limiter.by_user):
+        table.rate = table.burst = float("inf")
+
+def start_background_tasks():
+    """Start the loop watchdog, timeout sweep, rate limit compaction, challenge producer, ticket key rotation and transfer expiry"""
+    watchdog.start()
+    connections.start()
+    login_limiter.start()
+    challenges.start()
+    tickets.start()
+    transfers.start()
+
+def toggle_profiler():
+    """Start a default profiling window, or stop the one that is running"""
+    if not profiler.start():
+        profiler.stop()
 
-async def main():
+async def start_admin(port=None, socket_path=None):
+    """Serve /metrics and /stats on a local port and/or Unix socket, if either is given"""
+    if port is None and socket_path is None:
+        return
+    
+    admin.register("loop", watchdog.stats)
+    admin.register("admission", admission.stats)
+    admin.register("connections", connections.stats)
+    admin.register("rate_limits", login_limiter.stats)
+    admin.register("challenges", challenges.stats)
+    admin.register("tickets", tickets.stats)
+    admin.register("transfers", transfers.stats)
+    admin.register("logging", logging_stats)
+    admin.register("profiler", profiler.stats)
+    admin.register("trace", tracer.stats)
+    await admin.start(port, socket_path=socket_path)
+
+async def main(host=HOST, port=PORT, json_protocol=False, admin_port=None, admin_socket=None, trace_path=None):
     # Initialize database
     init_database()
     
     # Start server
-    server = await asyncio.start_server(handle_client, HOST, PORT)
+    handler = handle_json_client if json_protocol else handle_client
+    server = await asyncio.start_server(handler, host, port)
     
     addr = server.sockets[0].getsockname()
-    print(f"Server running on {addr}")
+    log.info("server running", extra={"addr": addr})
+    
+    start_background_tasks()
+    if trace_path:
+        tracer.start(trace_path, "json" if json_protocol else "text")
+    await start_admin(admin_port, admin_socket)
     
-    async with server:
-        await server.serve_forever()
+    # kill -USR2 <pid> toggles a cProfile window, same as POST /profile on the admin socket
+    if hasattr(signal, "SIGUSR2"):
+        asyncio.get_running_loop().add_signal_handler(signal.SIGUSR2, toggle_profiler)
+    
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        transfers.stop()
+        await tracer.stop()
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Super Secure chat server")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--json", action="store_true",
+                        help="speak the JSON msg protocol (server_auth) instead of the plain text one")
+    parser.add_argument("--load-test", action="store_true",
+                        help="lift per-IP and login rate limits so one host can drive many clients")
+    parser.add_argument("--admin-port", type=int,
+                        help="serve Prometheus metrics and stats on this localhost port")
+    parser.add_argument("--admin-socket",
+                        help="serve metrics and stats, plus the /loglevel and /profile controls, on this Unix socket")
+    parser.add_argument("--slow-callback-ms", type=float,
+                        help="log a stack sample when the event loop is blocked this long (default 100)")
+    parser.add_argument("--trace",
+                        help="record frame timings and sizes (never contents) to this file for replay.py")
+    parser.add_argument("--log-level", default="INFO", help="DEBUG, INFO, WARNING or ERROR")
+    parser.add_argument("--log-json", action="store_true", help="write logs as JSON lines")
+    parser.add_argument("--log-file", help="write logs here instead of stdout")
+    parser.add_argument("--log-sample", type=int, default=100,
+                        help="log one in this many client commands")
+    args = parser.parse_args()
+    
+    setup_logging(args.log_level, args.log_json, args.log_file, args.log_sample)
+    
+    if args.load_test:
+        relax_limits()
+    if args.slow_callback_ms is not None:
+        watchdog.threshold = args.slow_callback_ms / 1000
+    
     try:
-        asyncio.run(main())
+        asyncio.run(main(args.host, args.port, args.json, args.admin_port, args.admin_socket, args.trace))
     except KeyboardInterrupt:
-        print("Server shutdown by user")
\ No newline at end of file
+        log.info("server shutdown by user")
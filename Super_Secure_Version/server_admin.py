@@ -0,0 +1,169 @@
+# server_admin.py - Local admin listener serving metrics and live server state
+import asyncio
+import functools
+import json
+import os
+import resource
+import threading
+import time
+from server_metrics import metrics
+from urllib.parse import parse_qs
+from server_logging import get_logger, set_level
+from server_profiler import profiler, DEFAULT_SECONDS as DEFAULT_PROFILE_SECONDS
+
+log = get_logger("admin")
+
+# Listener defaults. The admin port is off unless a port or socket path is given.
+ADMIN_HOST = '127.0.0.1'
+MAX_REQUEST_HEAD = 8192        # Bytes of request line + headers we accept
+REQUEST_TIMEOUT = 5            # Seconds a scraper has to send its request
+CONTROL_PATHS = ("/loglevel", "/profile")   # Routes that change server state
+
+"""
+Admin endpoint that shares the chat server's event loop. It speaks just enough
+HTTP/1.0 for curl and Prometheus: GET /metrics returns the text exposition format,
+GET /stats returns the same data plus component snapshots as JSON, and
+POST /loglevel?level=DEBUG[&logger=chat.auth] changes log levels at runtime and
+POST /profile?seconds=30[&mode=sample] runs a profiling window (see server_profiler). Nothing is
+computed until a scrape arrives, and components are registered as stats() callables
+so the chat path never does any extra work for the admin endpoint.
+
+The routes that change state are only served on the Unix socket, which only the
+server's user can open. The TCP port is read only, so a web page that gets a browser
+to request 127.0.0.1 can't change anything.
+"""
+class AdminServer:
+    def __init__(self) -> None:
+        # component name -> function returning a dict of numbers (or nested dicts)
+        self.components: dict[str, object] = {}
+        self.started = time.monotonic()
+        self.servers: list[asyncio.AbstractServer] = []
+
+        self.requests = metrics.counter("admin_requests_total", help="Requests served by the admin endpoint")
+
+    def register(self, name: str, stats_fn) -> None:
+        """Expose a component's stats() under name"""
+        self.components[name] = stats_fn
+
+    async def start(self, port: int | None = None, host: str = ADMIN_HOST, socket_path: str | None = None) -> None:
+        """Open the TCP port and/or Unix socket"""
+        if port is not None:
+            server = await asyncio.start_server(self.handle, host, port, limit=MAX_REQUEST_HEAD)
+            self.servers.append(server)
+            log.info("admin endpoint listening", extra={"url": f"http://{host}:{server.sockets[0].getsockname()[1]}/metrics"})
+
+        if socket_path is not None:
+            if os.path.exists(socket_path):
+                os.unlink(socket_path)
+            server = await asyncio.start_unix_server(functools.partial(self.handle, control=True), socket_path,
+                                                     limit=MAX_REQUEST_HEAD)
+            os.chmod(socket_path, 0o600)
+            self.servers.append(server)
+            log.info("admin endpoint listening", extra={"socket": socket_path})
+
+    def stop(self) -> None:
+        """Close the listeners"""
+        for server in self.servers:
+            server.close()
+        self.servers.clear()
+
+    def worker_stats(self) -> dict:
+        """Resource usage of this server process"""
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        return {
+            "pid": os.getpid(),
+            "uptime_seconds": time.monotonic() - self.started,
+            "cpu_user_seconds": usage.ru_utime,
+            "cpu_system_seconds": usage.ru_stime,
+            "max_rss_kb": usage.ru_maxrss,
+            "threads": threading.active_count(),
+            "tasks": len(asyncio.all_tasks()),
+        }
+
+    def collect(self) -> dict:
+        """Snapshot of every registered component plus worker stats"""
+        result = {"worker": self.worker_stats()}
+        for name, stats_fn in self.components.items():
+            try:
+                result[name] = stats_fn()
+            except Exception as e:
+                result[name] = {"error": str(e)}
+        return result
+
+    def render_prometheus(self) -> str:
+        """Registry metrics followed by component stats flattened into gauges"""
+        lines = [metrics.render_prometheus().rstrip("\n")]
+        pid = os.getpid()
+        for name, value in flatten(self.collect()):
+            lines.append(f'chat_{name}{{pid="{pid}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, control: bool = False) -> None:
+        """Serve one HTTP request and close. control is set for the Unix socket, the only place state can change."""
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), REQUEST_TIMEOUT)
+            request_line = head.split(b"\r\n", 1)[0].decode("latin-1").split()
+            method, path = (request_line + ["", ""])[:2]
+            path, _, query = path.partition("?")
+
+            if path in CONTROL_PATHS and not control:
+                status, content_type, body = "403 Forbidden", "text/plain", f"{path} is only served on --admin-socket\n"
+            elif method != ("POST" if path in CONTROL_PATHS else "GET"):
+                allowed = "POST" if path in CONTROL_PATHS else "GET"
+                status, content_type, body = "405 Method Not Allowed", "text/plain", f"{allowed} only\n"
+            elif path == "/metrics":
+                status, content_type, body = "200 OK", "text/plain; version=0.0.4", self.render_prometheus()
+            elif path == "/loglevel":
+                params = parse_qs(query)
+                if "level" in params:
+                    name = params.get("logger", ["chat"])[0]
+                    try:
+                        level = set_level(params["level"][0], name)
+                        log.warning("log level changed", extra={"logger": name, "level": level})
+                        status, content_type, body = "200 OK", "text/plain", f"{name} {level}\n"
+                    except ValueError as e:
+                        status, content_type, body = "400 Bad Request", "text/plain", f"{e}\n"
+                else:
+                    status, content_type, body = "400 Bad Request", "text/plain", "Usage: /loglevel?level=DEBUG[&logger=chat.auth]\n"
+            elif path == "/profile":
+                params = parse_qs(query)
+                if "stop" in params:
+                    output = profiler.stop()
+                    status, content_type, body = "200 OK", "text/plain", f"{output or 'not running'}\n"
+                else:
+                    try:
+                        seconds = float(params.get("seconds", [DEFAULT_PROFILE_SECONDS])[0])
+                        if profiler.start(seconds, params.get("mode", ["cprofile"])[0]):
+                            status, content_type, body = "200 OK", "text/plain", f"profiling for {profiler.seconds}s\n"
+                        else:
+                            status, content_type, body = "409 Conflict", "text/plain", "already profiling\n"
+                    except ValueError as e:
+                        status, content_type, body = "400 Bad Request", "text/plain", f"{e}\n"
+            elif path == "/stats":
+                status, content_type, body = "200 OK", "application/json", json.dumps({**self.collect(), "metrics": metrics.snapshot()}, indent=2) + "\n"
+            else:
+                status, content_type, body = "404 Not Found", "text/plain", "Try /metrics or /stats\n"
+
+            self.requests.inc()
+            payload = body.encode()
+            writer.write(f"HTTP/1.0 {status}\r\nContent-Type: {content_type}\r\n"
+                         f"Content-Length: {len(payload)}\r\nConnection: close\r\n\r\n".encode() + payload)
+            await writer.drain()
+
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ConnectionError):
+            pass
+
+        finally:
+            writer.close()
+
+def flatten(stats: dict, prefix: str = ""):
+    """Yield (name, value) for every number in a nested stats dict"""
+    for key, value in stats.items():
+        name = f"{prefix}_{key}" if prefix else key
+        if isinstance(value, dict):
+            yield from flatten(value, name)
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield name, value
+
+# Shared admin endpoint used by the server
+admin = AdminServer()
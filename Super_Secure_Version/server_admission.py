@@ -0,0 +1,112 @@
+# server_admission.py - Connection caps and login admission control
+import asyncio
+import contextlib
+
+# Admission limits
+MAX_CONNECTIONS = 10000       # Open connections across the whole server
+MAX_CONNECTIONS_PER_IP = 50   # Open connections from a single address
+MAX_CONCURRENT_AUTH = 64      # Logins/registrations allowed to run at once
+MAX_PENDING_AUTH = 256        # Logins allowed to wait for a slot before we reject
+AUTH_QUEUE_TIMEOUT = 10       # Seconds a login may wait for a slot
+
+class AdmissionRejected(Exception):
+    pass
+
+"""
+Decides whether the server takes on more work. Connections are capped globally and
+per source address at accept time. The expensive part of authentication, the RSA,
+X25519 and scrypt calls, runs behind a semaphore with a bounded waiting line, so a
+reconnect storm gets fast rejections instead of piling up CPU and memory. Only the
+crypto holds a slot, not the reads in between, so idle connections can't sit on one.
+"""
+class AdmissionController:
+    def __init__(self, max_connections: int = MAX_CONNECTIONS, max_per_ip: int = MAX_CONNECTIONS_PER_IP,
+                 max_concurrent_auth: int = MAX_CONCURRENT_AUTH, max_pending_auth: int = MAX_PENDING_AUTH,
+                 auth_queue_timeout: float = AUTH_QUEUE_TIMEOUT) -> None:
+        self.max_connections = max_connections
+        self.max_per_ip = max_per_ip
+        self.max_pending_auth = max_pending_auth
+        self.auth_queue_timeout = auth_queue_timeout
+        self.auth_semaphore = asyncio.Semaphore(max_concurrent_auth)
+
+        # Live state
+        self.open_connections = 0
+        self.per_ip: dict[str, int] = {}
+        self.active_auth = 0
+        self.pending_auth = 0
+
+        # Counters
+        self.admitted = 0
+        self.rejected = 0
+        self.queued = 0
+        self.auth_rejected = 0
+
+    def admit(self, ip: str) -> bool:
+        """Take a slot for a new connection, or refuse it if a cap is reached"""
+        if self.open_connections >= self.max_connections or self.per_ip.get(ip, 0) >= self.max_per_ip:
+            self.rejected += 1
+            return False
+
+        self.open_connections += 1
+        self.per_ip[ip] = self.per_ip.get(ip, 0) + 1
+        self.admitted += 1
+        return True
+
+    def release(self, ip: str) -> None:
+        """Give back the slot taken by admit"""
+        self.open_connections -= 1
+        remaining = self.per_ip.get(ip, 0) - 1
+        if remaining > 0:
+            self.per_ip[ip] = remaining
+        else:
+            self.per_ip.pop(ip, None)
+
+    @contextlib.asynccontextmanager
+    async def auth_slot(self):
+        """
+        Hold one of the concurrent authentication slots for the duration of the block.
+        Raises AdmissionRejected straight away if the waiting line is full, or if the
+        wait for a slot runs longer than auth_queue_timeout.
+        """
+        if self.auth_semaphore.locked():
+            if self.pending_auth >= self.max_pending_auth:
+                self.auth_rejected += 1
+                raise AdmissionRejected("Server busy, too many pending logins")
+            self.queued += 1
+
+        self.pending_auth += 1
+        try:
+            await asyncio.wait_for(self.auth_semaphore.acquire(), timeout=self.auth_queue_timeout)
+        except asyncio.TimeoutError:
+            self.auth_rejected += 1
+            raise AdmissionRejected("Server busy, timed out waiting to log in")
+        finally:
+            self.pending_auth -= 1
+
+        self.active_auth += 1
+        try:
+            yield
+        finally:
+            self.active_auth -= 1
+            self.auth_semaphore.release()
+
+    async def auth_work(self, func, *args):
+        """Run one authentication crypto call in a worker thread while holding an auth slot"""
+        async with self.auth_slot():
+            return await asyncio.to_thread(func, *args)
+
+    def stats(self) -> dict:
+        """Snapshot of the admission counters"""
+        return {
+            "open_connections": self.open_connections,
+            "distinct_ips": len(self.per_ip),
+            "active_auth": self.active_auth,
+            "pending_auth": self.pending_auth,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "queued": self.queued,
+            "auth_rejected": self.auth_rejected,
+        }
+
+# Shared controller used by the server modules
+admission = AdmissionController()
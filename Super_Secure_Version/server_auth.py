@@ -5,6 +5,7 @@ import base64
 import json
 import hashlib
 import hmac
+import time
 
 from database import get_user_data, create_user, user_exists, store_public_key, get_public_key, store_challenge, get_user_salt
 from server_utils import get_user_input, client, send_user_msg
@@ -14,6 +15,23 @@ from hash_utils import generate_salt, hash_password, compute_challenge_response
 
 from crypto.encryption import encrypt_message
 from crypto.key_management import load_public_key
+from server_admission import admission, AdmissionRejected
+from server_ratelimit import login_limiter
+from server_tickets import tickets
+from server_challenges import challenges
+from server_metrics import metrics
+from server_logging import get_logger
+
+log = get_logger("auth")
+
+# Metrics, looked up once so recording is just an increment
+auth_seconds = metrics.histogram("auth_seconds", {"protocol": "json"}, "Whole login exchange")
+auth_phase_seconds = {phase: metrics.histogram("auth_phase_seconds", {"phase": phase}, "Time per login phase")
+                      for phase in ("register", "resume", "lookup", "challenge", "salt", "verify")}
+crypto_seconds = {op: metrics.histogram("crypto_seconds", {"op": op}, "Time in crypto calls on the server")
+                  for op in ("hash_password", "encrypt_challenge", "challenge_response", "seal_ticket")}
+auth_results = {result: metrics.counter("auth_total", {"result": result}, "Authentication outcomes")
+                for result in ("login", "resumed", "failed", "rejected")}
 
 class FailedAuth(Exception):
     pass
@@ -21,20 +39,79 @@ class FailedAuth(Exception):
 """
 Attempts to gather input from connected client. It then attempts to authenticate 3
 times for the client. If it fails, the connection is ended. It sends the user json msg
-objects and returns a client to the server
+objects and returns a client to the server. Each crypto call of the exchange runs in
+one of the admission controller's auth slots (see auth_crypto), so only a bounded
+number of them run at once while waiting on the client holds no slot.
 """
 async def authenticate_user(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> client:
+    started = time.perf_counter_ns()
+    try:
+        authed = await login_or_register(reader, writer)
+        auth_seconds.record(time.perf_counter_ns() - started)
+        return authed
+    except AdmissionRejected as e:
+        auth_results["rejected"].inc()
+        await send_user_msg(str(e), CODES.ERROR, writer)
+        raise FailedAuth()
+    except FailedAuth:
+        auth_results["failed"].inc()
+        raise
+
+"""
+Run one crypto call of the exchange in an auth slot, off the event loop, timed as
+crypto_seconds[op]. func must not touch shared state: it runs on a worker thread, so
+anything it needs from the pools and authorities is looked up on the loop first.
+"""
+async def auth_crypto(op: str, func, *args):
+    def timed():
+        started = time.perf_counter_ns()
+        return func(*args), time.perf_counter_ns() - started
+    result, elapsed_ns = await admission.auth_work(timed)
+    crypto_seconds[op].record(elapsed_ns)
+    return result
+
+"""
+The login/registration exchange itself. Use authenticate_user rather than calling this directly.
+"""
+async def login_or_register(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> client:
     # Init vars
     attempts = 0
     username = ""
+    addr = writer.get_extra_info('peername')
+    ip = addr[0] if addr else "unknown"
 
     try:
         # First ask if user wants to login or register
         auth_option = await get_user_input("Enter '1' to login or '2' to register: ", reader, writer)
         
+        # Reconnecting clients can skip the whole exchange with a resume ticket
+        if auth_option.startswith("RESUME "):
+            phase_started = time.perf_counter_ns()
+            resumed_user = tickets.redeem(auth_option[len("RESUME "):].strip())
+            if resumed_user is not None:
+                log.info("session resumed", extra={"user": resumed_user})
+                login_limiter.clear_user(resumed_user)
+                public_key_pem = await get_public_key(resumed_user)
+                if public_key_pem:
+                    sealed = await auth_crypto("seal_ticket", tickets.seal, tickets.issue(resumed_user), public_key_pem)
+                    await send_user_msg(sealed, CODES.TICKET, writer)
+                send_str = f"Welcome back {resumed_user}!!! Session resumed on {datetime.now().strftime('%m/%d/%Y, %H:%M:%S')}"
+                await send_user_msg(send_str, CODES.AUTHENTICATED, writer)
+                auth_phase_seconds["resume"].record(time.perf_counter_ns() - phase_started)
+                auth_results["resumed"].inc()
+                return client(reader, writer, resumed_user)
+
+            # Bad or expired ticket, fall back to a normal login
+            await send_user_msg("Resume ticket rejected. Please log in.", CODES.NO_WRITE_BACK, writer)
+
         if auth_option == "2":
-            # Registration flow
+            # Registration flow. Hashing the new password costs an scrypt run, so rate limit it
+            if not login_limiter.allow_ip(ip):
+                await send_user_msg("Too many attempts. Try again later.", CODES.ERROR, writer)
+                raise FailedAuth()
+
             username = await get_user_input("Create a username: ", reader, writer)
+            phase_started = time.perf_counter_ns()
             
             # Check if username already exists
             if await user_exists(username):
@@ -49,7 +126,7 @@ async def authenticate_user(reader: asyncio.StreamReader, writer: asyncio.Stream
             salt = generate_salt()
             
             # Hash the password server-side
-            password_hash = hash_password(password, salt)
+            password_hash = await auth_crypto("hash_password", hash_password, password, salt)
             
             # Now prompt client to generate and send their public key
             public_key_pem = await get_user_input("Please generate and send your public key: ", reader, writer)
@@ -63,6 +140,7 @@ async def authenticate_user(reader: asyncio.StreamReader, writer: asyncio.Stream
             if await create_user(username, password_hash, salt):
                 send_str = f"User {username} created successfully! Please login now."
                 await send_user_msg(send_str, CODES.NO_WRITE_BACK, writer)
+                auth_phase_seconds["register"].record(time.perf_counter_ns() - phase_started)
                 # Set username to empty to force re-entering username for login
                 username = ""
                 # Continue to login flow
@@ -77,12 +155,20 @@ async def authenticate_user(reader: asyncio.StreamReader, writer: asyncio.Stream
             if username == "":  # If we're not continuing from registration
                 username = await get_user_input("Type in your username: ", reader, writer)
             
-            print(f"Login attempt: {username}")
+            log.info("login attempt", extra={"user": username})
+            
+            # Rate limit before touching the DB or doing any crypto. The username only pays for failures.
+            if not login_limiter.allow_ip(ip) or not login_limiter.allow_user(username):
+                await send_user_msg("Too many login attempts. Try again later.", CODES.ERROR, writer)
+                raise FailedAuth()
+            
+            phase_started = time.perf_counter_ns()
             
             # First, check if the username exists
             if not await user_exists(username):
                 send_str = f"Username '{username}' not found. Please try again."
                 await send_user_msg(send_str, CODES.NO_WRITE_BACK, writer)
+                login_limiter.fail_user(username)
                 username = ""  # Reset username for next attempt
                 attempts += 1
                 continue
@@ -92,6 +178,7 @@ async def authenticate_user(reader: asyncio.StreamReader, writer: asyncio.Stream
             if not user_data:
                 send_str = f"Error retrieving user data. Please try again."
                 await send_user_msg(send_str, CODES.NO_WRITE_BACK, writer)
+                login_limiter.fail_user(username)
                 username = ""  # Reset username for next attempt
                 attempts += 1
                 continue
@@ -101,22 +188,27 @@ async def authenticate_user(reader: asyncio.StreamReader, writer: asyncio.Stream
             if not public_key_pem:
                 send_str = f"No public key found for user. Please register again."
                 await send_user_msg(send_str, CODES.NO_WRITE_BACK, writer)
+                login_limiter.fail_user(username)
                 username = ""  # Reset username for next attempt
                 attempts += 1
                 continue
             
-            # Generate random challenge
-            challenge = os.urandom(32)
-            challenge_b64 = base64.b64encode(challenge).decode()
+            auth_phase_seconds["lookup"].record(time.perf_counter_ns() - phase_started)
+            phase_started = time.perf_counter_ns()
+            
+            # Pick a challenge from the pool, already encrypted with the user's key if we have one
+            challenge_b64, encrypted_challenge = challenges.take_for(username, public_key_pem)
+            if encrypted_challenge is None:
+                encrypted_challenge = await auth_crypto("encrypt_challenge", challenges.encrypt,
+                                                        challenge_b64, public_key_pem)
             
             # Store challenge for verification
             await store_challenge(username, challenge_b64)
             
-            # Encrypt challenge using user's public key
-            encrypted_challenge = encrypt_message(challenge_b64, public_key_pem.encode())
-            
             # Send encrypted challenge to client
             await send_user_msg(f"CHALLENGE {encrypted_challenge}", CODES.WRITE_BACK, writer)
+            auth_phase_seconds["challenge"].record(time.perf_counter_ns() - phase_started)
+            phase_started = time.perf_counter_ns()
             
             # Wait for GET_SALT request
             try:
@@ -133,19 +225,30 @@ async def authenticate_user(reader: asyncio.StreamReader, writer: asyncio.Stream
                     # Client reported an error
                     send_str = f"Authentication error: {salt_request_str}"
                     await send_user_msg(send_str, CODES.NO_WRITE_BACK, writer)
+                    login_limiter.fail_user(username)
                     username = ""  # Reset username for next attempt
                     attempts += 1
                     continue
                 
+                auth_phase_seconds["salt"].record(time.perf_counter_ns() - phase_started)
+                phase_started = time.perf_counter_ns()
+                
                 # Receive response from client
                 response_data = await reader.read(1024)
                 response = response_data.decode().strip()
                 
                 # Compute expected response
-                expected_response = compute_challenge_response(user_data["password_hash"], challenge_b64)
+                expected_response = await auth_crypto("challenge_response", compute_challenge_response,
+                                                      user_data["password_hash"], challenge_b64)
+                auth_phase_seconds["verify"].record(time.perf_counter_ns() - phase_started)
                 
                 # Verify response
                 if hmac.compare_digest(expected_response, response):
+                    auth_results["login"].inc()
+                    login_limiter.clear_user(username)
+                    # Hand out a resume ticket before the AUTH message so it arrives during login
+                    sealed = await auth_crypto("seal_ticket", tickets.seal, tickets.issue(username), public_key_pem)
+                    await send_user_msg(sealed, CODES.TICKET, writer)
                     send_str = f"Hello {username}!!! Login Successful on {datetime.now().strftime('%m/%d/%Y, %H:%M:%S')}"
                     await send_user_msg(send_str, CODES.AUTHENTICATED, writer)
                     break
@@ -153,9 +256,13 @@ async def authenticate_user(reader: asyncio.StreamReader, writer: asyncio.Stream
                     send_str = f"Authentication failed for {username}. Attempt {attempts + 1}!"
                     await send_user_msg(send_str, CODES.NO_WRITE_BACK, writer)
                     attempts += 1
+                    login_limiter.fail_user(username)
                     username = ""  # Reset username for next attempt
+            except AdmissionRejected:
+                raise
             except Exception as e:
-                print(f"Error during authentication: {e}")
+                log.warning("authentication attempt failed", extra={"user": username, "error": str(e)})
+                login_limiter.fail_user(username)
                 attempts += 1
                 continue
 
@@ -163,8 +270,10 @@ async def authenticate_user(reader: asyncio.StreamReader, writer: asyncio.Stream
         if attempts == 3:
             raise FailedAuth()
 
+    except AdmissionRejected:
+        raise
     except Exception as e:
-        print(f"Authentication error: {str(e)}")
+        log.warning("authentication error", extra={"error": str(e)})
         raise FailedAuth()
 
     return client(reader, writer, username)
\ No newline at end of file
@@ -0,0 +1,176 @@
+# server_challenges.py - Pool of login challenges prepared ahead of time
+import asyncio
+import base64
+import os
+import time
+from collections import OrderedDict, deque
+from crypto.encryption import encrypt_message
+from server_logging import get_logger
+
+log = get_logger("challenges")
+
+# Pool sizing
+CHALLENGE_SIZE = 32            # Bytes of randomness per challenge
+POOL_SIZE = 1024               # Plain challenges kept ready
+REFILL_INTERVAL = 0.5          # Seconds between producer rounds
+
+# Pre-encryption for users who logged in recently
+RECENT_USERS = 1000            # Users whose public key we remember
+PRECOMPUTED_PER_USER = 2       # Encrypted challenges kept per recent user
+PRECOMPUTE_BATCH = 16          # RSA encryptions per producer round at most
+IDLE_LAG_THRESHOLD = 0.05      # Producer only pre-encrypts if the loop is this responsive
+
+"""
+Keeps login challenges ready so the login path only has to pick one. A background
+producer tops up a pool of random challenges (with their base64 form) using one
+os.urandom call per round. When the event loop is quiet it also encrypts challenges
+for recently active users with their cached public key, on a worker thread, so a
+returning user's login skips the RSA encryption entirely.
+
+The pool state is only touched on the event loop thread. Logins pick their challenge
+with take_for() there, and only the encryption itself (encrypt()) goes to a thread.
+"""
+class ChallengePool:
+    def __init__(self, pool_size: int = POOL_SIZE, refill_interval: float = REFILL_INTERVAL,
+                 recent_users: int = RECENT_USERS, per_user: int = PRECOMPUTED_PER_USER,
+                 batch: int = PRECOMPUTE_BATCH, idle_lag: float = IDLE_LAG_THRESHOLD) -> None:
+        self.pool_size = pool_size
+        self.refill_interval = refill_interval
+        self.recent_users = recent_users
+        self.per_user = per_user
+        self.batch = batch
+        self.idle_lag = idle_lag
+
+        self.pool: deque[tuple[bytes, str]] = deque()
+        # username -> public key PEM, most recently seen last
+        self.recent_keys: OrderedDict[str, str] = OrderedDict()
+        # username -> deque of (public key PEM, challenge b64, encrypted challenge)
+        self.encrypted: dict[str, deque] = {}
+        self._task = None
+
+        # Counters
+        self.pool_hits = 0
+        self.pool_misses = 0
+        self.precomputed_hits = 0
+
+    def refill(self) -> None:
+        """Top the plain pool up to pool_size"""
+        missing = self.pool_size - len(self.pool)
+        if missing <= 0:
+            return
+
+        randomness = os.urandom(CHALLENGE_SIZE * missing)
+        for i in range(missing):
+            challenge = randomness[i * CHALLENGE_SIZE:(i + 1) * CHALLENGE_SIZE]
+            self.pool.append((challenge, base64.b64encode(challenge).decode()))
+
+    def draw(self) -> tuple[bytes, str]:
+        """Pop a challenge from the pool, making one inline if it ran dry"""
+        if self.pool:
+            return self.pool.popleft()
+
+        challenge = os.urandom(CHALLENGE_SIZE)
+        return challenge, base64.b64encode(challenge).decode()
+
+    def take(self) -> tuple[bytes, str]:
+        """Get a fresh challenge and its base64 form for the login path"""
+        if self.pool:
+            self.pool_hits += 1
+        else:
+            self.pool_misses += 1
+        return self.draw()
+
+    def take_for(self, username: str, public_key_pem: str) -> tuple[str, str | None]:
+        """
+        Get a challenge for a user as (challenge b64, encrypted challenge). The encrypted
+        challenge is a pre-encrypted one made with this exact key, or None if there is
+        none and the caller has to encrypt() it. Call on the event loop thread.
+        """
+        self.remember(username, public_key_pem)
+
+        ready = self.encrypted.get(username)
+        while ready:
+            key_pem, challenge_b64, encrypted_challenge = ready.popleft()
+            if key_pem == public_key_pem:
+                self.precomputed_hits += 1
+                return challenge_b64, encrypted_challenge
+
+        _, challenge_b64 = self.take()
+        return challenge_b64, None
+
+    @staticmethod
+    def encrypt(challenge_b64: str, public_key_pem: str) -> str:
+        """Encrypt a challenge for a user. Touches no pool state, so safe on any thread."""
+        return encrypt_message(challenge_b64, public_key_pem.encode())
+
+    def remember(self, username: str, public_key_pem: str) -> None:
+        """Note a user as recently active so the producer prepares challenges for them"""
+        self.recent_keys[username] = public_key_pem
+        self.recent_keys.move_to_end(username)
+        while len(self.recent_keys) > self.recent_users:
+            old_user, _ = self.recent_keys.popitem(last=False)
+            self.encrypted.pop(old_user, None)
+
+    def precompute_jobs(self) -> list[tuple[str, str, str]]:
+        """Pick up to batch (username, key, challenge b64) jobs, most recent users first"""
+        jobs = []
+        for username in reversed(self.recent_keys):
+            have = len(self.encrypted.get(username, ()))
+            for _ in range(self.per_user - have):
+                if len(jobs) >= self.batch:
+                    return jobs
+                jobs.append((username, self.recent_keys[username], self.draw()[1]))
+        return jobs
+
+    async def precompute(self) -> None:
+        """Encrypt one batch of challenges on a worker thread"""
+        jobs = self.precompute_jobs()
+        if not jobs:
+            return
+
+        results = await asyncio.to_thread(
+            lambda: [self.encrypt(challenge_b64, key_pem) for _, key_pem, challenge_b64 in jobs]
+        )
+        for (username, key_pem, challenge_b64), encrypted_challenge in zip(jobs, results):
+            # Skip users that dropped out of the recent list or changed keys meanwhile
+            if self.recent_keys.get(username) == key_pem:
+                self.encrypted.setdefault(username, deque()).append((key_pem, challenge_b64, encrypted_challenge))
+
+    def start(self) -> None:
+        """Start the producer on the running loop"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self.run())
+
+    def stop(self) -> None:
+        """Cancel the producer"""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def run(self) -> None:
+        """Producer loop. The sleep overshoot tells us whether the loop is busy."""
+        while True:
+            self.refill()
+            started = time.monotonic()
+            await asyncio.sleep(self.refill_interval)
+            lag = time.monotonic() - started - self.refill_interval
+
+            if lag < self.idle_lag:
+                try:
+                    await self.precompute()
+                except Exception as e:
+                    log.warning("challenge precompute failed", extra={"error": str(e)})
+
+    def stats(self) -> dict:
+        """Snapshot of the pool counters"""
+        return {
+            "pool": len(self.pool),
+            "recent_users": len(self.recent_keys),
+            "precomputed": sum(len(ready) for ready in self.encrypted.values()),
+            "pool_hits": self.pool_hits,
+            "pool_misses": self.pool_misses,
+            "precomputed_hits": self.precomputed_hits,
+        }
+
+# Shared pool used by the server modules
+challenges = ChallengePool()
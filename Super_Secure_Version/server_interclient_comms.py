@@ -1,11 +1,24 @@
 # server_interclient_comms.py - Updated for secure messaging
 import asyncio
-from server_utils import get_user_input, client, send_user_msg, BUFFER, MAX_WAIT_TIME
+import base64
+import binascii
+import json
+import re
+import time
+from server_utils import get_user_input, client, send_user_msg, CommandReader
+from server_timers import connections
 from json_msg import CODES
 from enum import Enum
 from queue import LifoQueue
 from datetime import datetime
-from database import get_user_data, get_public_key, store_public_key, get_user_salt
+from database import get_user_data, get_public_key, get_public_keys, get_key_info, store_public_key, get_user_salt, MAX_KEY_BATCH
+from crypto.key_management import key_fingerprint
+from server_transfers import transfers, TransferBusy
+from server_metrics import metrics
+from server_logging import get_logger
+
+log = get_logger("comms")
+command_log = get_logger("commands")     # Sampled, one record per command
 
 # Valid chars only ascii chars from A to Z, a to z, 0 to 9, space ' ', and quotaions "
 valid_chars = {chr(i) for i in range(65, 91)} | {chr(j) for j in range(97, 123)}
@@ -20,7 +33,20 @@ class CLIENT_CMDS(Enum):
     HELP = "HELP"
     PUBKEY = "PUBKEY"     # For uploading public key
     GETKEY = "GETKEY"     # For getting public key
+    GETKEYS = "GETKEYS"   # For getting several public keys at once
+    PRESENCE = "PRESENCE" # Online users with their key fingerprints
     GET_SALT = "GET_SALT"  # For getting salt during authentication
+    SENDFILE = "SENDFILE" # For offering a file and uploading its chunks
+    RECVFILE = "RECVFILE" # For listing offered files and downloading their chunks
+
+# Files can only have plain names, so an offer never breaks up a frame
+FILE_NAME_RE = re.compile(r"[\w .\-]{1,255}\Z")
+
+# Per-command latency, looked up once so recording is just a list increment
+command_seconds = {cmd.value: metrics.histogram("command_seconds", {"cmd": cmd.value}, "Time to handle a client command")
+                   for cmd in CLIENT_CMDS}
+command_seconds["UNKNOWN"] = metrics.histogram("command_seconds", {"cmd": "UNKNOWN"}, "Time to handle a client command")
+command_errors = metrics.counter("command_errors_total", help="Commands that failed to parse or raised")
 
 """
 Client can type any of these commands to the server to communicate directly with server
@@ -28,13 +54,28 @@ or to send message to another user on server. Once the CODES.AUTH is sent to cli
 this will handle the client until the connection is terminated
 """
 async def client_to_client_comms(client: client, clients: dict[str, client]):
+    # Switch the connection over to the idle timeout and keepalive policy
+    connections.mark_authenticated(client.writer)
+    commands = CommandReader(client.reader, client.writer)
+    client.key_version, client.key_fingerprint = await get_key_info(client.username)
+
     while True:
         try:
-            # Await User Command and timeout if too long
-            user_cmd = await asyncio.wait_for(client.reader.read(BUFFER), timeout=MAX_WAIT_TIME)
+            # Await User Command. Idle connections are expired by the connection manager
+            request_id = None
+            request_id, user_cmd = await commands.next()
+            if request_id is not None and not client.tagged:
+                # Clients that tag commands read whole frames and skip keepalives
+                client.tagged = True
+                connections.enable_keepalive(client.writer)
 
+            started = time.perf_counter_ns()
+            
             # If user connection breaks or something
             if not user_cmd:  
+                if connections.is_expired(client.writer):
+                    log.info("client timed out", extra={"user": client.username})
+                    break
                 raise asyncio.IncompleteReadError(bytes(0), 256) 
             
             # Convert bytes into list[str] of args
@@ -53,15 +94,22 @@ async def client_to_client_comms(client: client, clients: dict[str, client]):
                     user_args = ["SEND", encrypted_message, "TO", recipient]
                 else:
                     user_args = godly_parser(user_cmd_str)
+            elif user_cmd_str.upper().startswith(CLIENT_CMDS.PUBKEY.value + " "):
+                # A PEM key has dashes, spaces and newlines, so it is taken whole
+                user_args = [CLIENT_CMDS.PUBKEY.value, user_cmd_str[len(CLIENT_CMDS.PUBKEY.value):].strip()]
+            elif user_cmd_str.split(" ", 1)[0].upper() in (CLIENT_CMDS.SENDFILE.value, CLIENT_CMDS.RECVFILE.value):
+                # Base64 chunks and JSON offers are parsed by the file handlers
+                file_cmd, _, file_args = user_cmd_str.partition(" ")
+                user_args = [file_cmd, file_args.strip()]
             else:
                 user_args = godly_parser(user_cmd_str)
             
             # Ensure list has 1 arg or more
             if len(user_args) == 0:
-                await send_user_msg(f"No cmd sent. Invalid Input!", CODES.ERROR, client.writer)
+                await send_user_msg(f"No cmd sent. Invalid Input!", CODES.ERROR, client.writer, request_id)
                 continue
            
-            print(f"Command from {client.username}: {user_args[0]}")
+            command_log.info("command", extra={"user": client.username, "cmd": user_args[0].upper(), "bytes": len(user_cmd)})
 
             # Check the first arg cmd
             arg = user_args[0].upper()
@@ -70,68 +118,79 @@ async def client_to_client_comms(client: client, clients: dict[str, client]):
                 break
             elif arg == CLIENT_CMDS.GET_USER.value:
                 users = [client for client in clients] 
-                await send_user_msg(f"Active Users: {users}", CODES.SUCCESS, client.writer)
+                await send_user_msg(f"Active Users: {users}", CODES.SUCCESS, client.writer, request_id)
             elif arg == CLIENT_CMDS.SEND.value:
-                await check_send(user_args, client, clients)
+                await check_send(user_args, client, clients, request_id)
             elif arg == CLIENT_CMDS.TO.value:
-                await send_user_msg("Invalid command format. Use: SEND message TO username", CODES.ERROR, client.writer)
+                await send_user_msg("Invalid command format. Use: SEND message TO username", CODES.ERROR, client.writer, request_id)
             elif arg == CLIENT_CMDS.HELP.value:
-                help_msg = "Commands:\n- GETUSERS: List all active users\n- SEND message TO username: Send a message\n- PUBKEY key: Upload your public key\n- GETKEY username: Get a user's public key\n- HELP: Show this help message\n- EXIT: Disconnect from server"
-                await send_user_msg(help_msg, CODES.SUCCESS, client.writer)
+                help_msg = "Commands:\n- GETUSERS: List all active users\n- SEND message TO username: Send a message\n- PUBKEY key: Upload your public key\n- GETKEY username: Get a user's public key\n- GETKEYS user1 user2 ...: Get several public keys at once\n- PRESENCE: List active users with their key fingerprints\n- SENDFILE / RECVFILE: Send and receive files (tagged commands only)\n- HELP: Show this help message\n- EXIT: Disconnect from server"
+                await send_user_msg(help_msg, CODES.SUCCESS, client.writer, request_id)
             elif arg == CLIENT_CMDS.PUBKEY.value:
                 if len(user_args) > 1:
                     public_key = user_args[1]
-                    if await store_public_key(client.username, public_key):
-                        await send_user_msg("Public key stored", CODES.SUCCESS, client.writer)
+                    version = await store_public_key(client.username, public_key)
+                    if version:
+                        client.key_version, client.key_fingerprint = version, key_fingerprint(public_key)
+                        await send_user_msg(f"Public key stored (version {version})", CODES.SUCCESS, client.writer, request_id)
                     else:
-                        await send_user_msg("Failed to store public key", CODES.ERROR, client.writer)
+                        await send_user_msg("Failed to store public key", CODES.ERROR, client.writer, request_id)
                 else:
-                    await send_user_msg("PUBKEY command requires a key", CODES.ERROR, client.writer)
+                    await send_user_msg("PUBKEY command requires a key", CODES.ERROR, client.writer, request_id)
             elif arg == CLIENT_CMDS.GETKEY.value:
                 if len(user_args) > 1:
                     target_username = user_args[1]
                     public_key = await get_public_key(target_username)
                     if public_key:
-                        await send_user_msg(f"KEY {target_username} {public_key}", CODES.SUCCESS, client.writer)
+                        await send_user_msg(f"KEY {target_username} {public_key}", CODES.SUCCESS, client.writer, request_id)
                     else:
-                        await send_user_msg(f"No public key found for {target_username}", CODES.ERROR, client.writer)
+                        await send_user_msg(f"No public key found for {target_username}", CODES.ERROR, client.writer, request_id)
                 else:
-                    await send_user_msg("GETKEY command requires a username", CODES.ERROR, client.writer)
+                    await send_user_msg("GETKEY command requires a username", CODES.ERROR, client.writer, request_id)
+            elif arg == CLIENT_CMDS.GETKEYS.value:
+                await check_getkeys(user_args, client, request_id)
+            elif arg == CLIENT_CMDS.PRESENCE.value:
+                presence = {name: peer.key_fingerprint for name, peer in clients.items()}
+                await send_user_msg(f"PRESENCE {json.dumps(presence, separators=(',', ':'))}", CODES.SUCCESS, client.writer, request_id)
+            elif arg == CLIENT_CMDS.SENDFILE.value:
+                await check_sendfile(user_args[1], client, clients, request_id)
+            elif arg == CLIENT_CMDS.RECVFILE.value:
+                await check_recvfile(user_args[1], client, request_id)
             elif arg == CLIENT_CMDS.GET_SALT.value:
                 # Get user's salt for authentication
                 salt = await get_user_salt(client.username)
                 if salt:
-                    await send_user_msg(salt, CODES.SALT, client.writer)
+                    await send_user_msg(salt, CODES.SALT, client.writer, request_id)
                 else:
-                    await send_user_msg("Error retrieving salt", CODES.ERROR, client.writer)
+                    await send_user_msg("Error retrieving salt", CODES.ERROR, client.writer, request_id)
             else:
-                await send_user_msg(f"Unknown command: {arg}. Type HELP for available commands.", CODES.ERROR, client.writer)
-        except asyncio.IncompleteReadError:
-            # Client disconnected
-            print(f"Client {client.username} disconnected unexpectedly")
+                await send_user_msg(f"Unknown command: {arg}. Type HELP for available commands.", CODES.ERROR, client.writer, request_id)
+            
+            command_seconds.get(arg, command_seconds["UNKNOWN"]).record(time.perf_counter_ns() - started)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            # Client disconnected, or the socket broke while we were writing to it
+            log.info("client disconnected unexpectedly", extra={"user": client.username})
             break
-        except asyncio.TimeoutError:
-            # Timeout waiting for command
-            await send_user_msg("Timeout waiting for command", CODES.ERROR, client.writer)
-            continue
         except ValueError as e:
-            await send_user_msg(f"Command error: {str(e)}", CODES.ERROR, client.writer)
+            command_errors.inc()
+            await send_user_msg(f"Command error: {str(e)}", CODES.ERROR, client.writer, request_id)
         except Exception as e:
-            print(f"Error handling command: {str(e)}")
-            await send_user_msg(f"Server error processing command", CODES.ERROR, client.writer)
+            command_errors.inc()
+            log.error("command failed", extra={"user": client.username, "error": str(e)})
+            await send_user_msg(f"Server error processing command", CODES.ERROR, client.writer, request_id)
             continue
 
-async def check_send(user_args: list[str], client: client, clients: dict[str, client]):
+async def check_send(user_args: list[str], client: client, clients: dict[str, client], request_id: str | None = None):
     # Must contain at least 4 args: SEND "message" TO username
     if len(user_args) < 4:
-        await send_user_msg(f"Invalid command format. Use: SEND message TO username", CODES.ERROR, client.writer)
+        await send_user_msg(f"Invalid command format. Use: SEND message TO username", CODES.ERROR, client.writer, request_id)
         return
     
     # If cmd is "SEND ... ... ..."
     if user_args[0].upper() == CLIENT_CMDS.SEND.value and user_args[2].upper() == CLIENT_CMDS.TO.value:
         user_to_receive_msg = user_args[3]
         if user_to_receive_msg not in clients:
-            await send_user_msg(f"User ({user_to_receive_msg}) does not exist or is offline", CODES.ERROR, client.writer)
+            await send_user_msg(f"User ({user_to_receive_msg}) does not exist or is offline", CODES.ERROR, client.writer, request_id)
         else:
             timestamp = datetime.now().strftime('%m/%d/%Y, %H:%M:%S')
             
@@ -143,13 +202,118 @@ async def check_send(user_args: list[str], client: client, clients: dict[str, cl
             send_msg = f"[{timestamp}] {client.username}: {message_content}"
             
             # Send message to recipient
-            await send_user_msg(send_msg, CODES.SUCCESS, clients[user_to_receive_msg].writer)
-            # Confirm to sender
-            await send_user_msg(f"Message sent to {user_to_receive_msg}", CODES.SUCCESS, client.writer)
+            recipient = clients[user_to_receive_msg]
+            await send_user_msg(send_msg, CODES.SUCCESS, recipient.writer, pace=not recipient.tagged)
+            # Confirm to sender, with the fingerprint of the key the recipient has now
+            await send_user_msg(f"Message sent to {user_to_receive_msg} key={recipient.key_fingerprint}",
+                                CODES.SUCCESS, client.writer, request_id)
     else:
-        await send_user_msg(f"Invalid command format. Use: SEND message TO username", CODES.ERROR, client.writer)
+        await send_user_msg(f"Invalid command format. Use: SEND message TO username", CODES.ERROR, client.writer, request_id)
+        return
+
+"""
+Answer GETKEYS with a single frame: KEYS followed by a JSON object mapping every
+requested username to its public key PEM, or null when it has none.
+"""
+async def check_getkeys(user_args: list[str], client: client, request_id: str | None = None):
+    usernames = list(dict.fromkeys(user_args[1:]))
+    if not usernames:
+        await send_user_msg("GETKEYS command requires at least one username", CODES.ERROR, client.writer, request_id)
+        return
+    if len(usernames) > MAX_KEY_BATCH:
+        await send_user_msg(f"GETKEYS takes at most {MAX_KEY_BATCH} usernames", CODES.ERROR, client.writer, request_id)
         return
 
+    found = await get_public_keys(usernames)
+    keys = {username: found.get(username) for username in usernames}
+    await send_user_msg(f"KEYS {json.dumps(keys, separators=(',', ':'))}", CODES.SUCCESS, client.writer, request_id)
+
+"""
+SENDFILE {"to": ..., "name": ..., "size": ..., "key": ...} offers a file of size
+encrypted bytes (a crypto.stream stream) with its stream key sealed for the
+recipient, and answers FILE <id> 0. SENDFILE {"id": ...} answers FILE <id> <offset>
+with how far an earlier upload got, so it can be resumed, and
+SENDFILE <id> <offset> <base64 chunk> appends the next chunk and answers with the
+new offset. When the server can't take a chunk it answers BUSY <id> <offset> and
+the sender carries on from that offset after backing off.
+
+An online recipient is told about the offer in a FILE frame holding the offer
+JSON, which only the server sends, so a chat message can't pass for one. An
+offline recipient finds it with RECVFILE later.
+Chunks are big, so file commands must be tagged (whole frames) rather than raw reads.
+"""
+async def check_sendfile(args: str, client: client, clients: dict[str, client], request_id: str | None = None):
+    if request_id is None:
+        await send_user_msg("SENDFILE only works with tagged commands", CODES.ERROR, client.writer)
+        return
+
+    if args.startswith("{"):
+        offer = json.loads(args)
+        if "id" in offer:
+            transfer = transfers.get(str(offer["id"]), client.username)
+        else:
+            recipient, name, size, key = offer.get("to"), offer.get("name"), offer.get("size"), offer.get("key")
+            if not isinstance(name, str) or not FILE_NAME_RE.match(name) or not isinstance(size, int) or not isinstance(key, str):
+                raise ValueError("SENDFILE offer needs to, name (letters, digits, spaces, . _ -), size and key")
+            if not isinstance(recipient, str) or await get_user_data(recipient) is None:
+                await send_user_msg(f"User ({recipient}) does not exist", CODES.ERROR, client.writer, request_id)
+                return
+            transfer = transfers.open(client.username, recipient, name, size, key)
+            if recipient in clients:
+                peer = clients[recipient]
+                await send_user_msg(json.dumps(transfer.offer(), separators=(',', ':')), CODES.FILE,
+                                    peer.writer, pace=not peer.tagged)
+        await send_user_msg(f"FILE {transfer.id} {transfer.received}", CODES.SUCCESS, client.writer, request_id)
+        return
+
+    parts = args.split(" ")
+    if len(parts) != 3 or not parts[1].isdigit():
+        raise ValueError("Use: SENDFILE <id> <offset> <base64 chunk>")
+    transfer = transfers.get(parts[0], client.username)
+    if transfer.sender != client.username:
+        raise ValueError(f"No transfer {parts[0]}")
+    try:
+        offset = transfers.write(transfer, int(parts[1]), base64.b64decode(parts[2], validate=True),
+                                 transfer.recipient in clients)
+    except binascii.Error:
+        raise ValueError("Chunk is not valid base64")
+    except TransferBusy as e:
+        await send_user_msg(f"BUSY {transfer.id} {e.offset} {e}", CODES.ERROR, client.writer, request_id)
+        return
+    await send_user_msg(f"FILE {transfer.id} {offset}", CODES.SUCCESS, client.writer, request_id)
+
+"""
+RECVFILE answers FILES with a JSON list of the offers waiting for this user.
+RECVFILE <id> <offset> answers FILEDATA <id> <offset> <base64 bytes> with what is
+available at offset (nothing yet if the sender is behind), and FILEEND <id> once
+offset is the end of the file, which also lets the server drop the transfer.
+Asking for an offset releases every byte before it, so the recipient acknowledges
+what it has stored just by asking for the next part.
+"""
+async def check_recvfile(args: str, client: client, request_id: str | None = None):
+    if request_id is None:
+        await send_user_msg("RECVFILE only works with tagged commands", CODES.ERROR, client.writer)
+        return
+
+    if not args:
+        offers = transfers.pending_for(client.username)
+        await send_user_msg(f"FILES {json.dumps(offers, separators=(',', ':'))}", CODES.SUCCESS, client.writer, request_id)
+        return
+
+    parts = args.split(" ")
+    if len(parts) != 2 or not parts[1].isdigit():
+        raise ValueError("Use: RECVFILE [<id> <offset>]")
+    transfer = transfers.get(parts[0], client.username)
+    if transfer.recipient != client.username:
+        raise ValueError(f"No transfer {parts[0]}")
+    offset = int(parts[1])
+    data = transfers.read(transfer, offset)
+    if offset == transfer.size:
+        await send_user_msg(f"FILEEND {transfer.id}", CODES.SUCCESS, client.writer, request_id)
+    else:
+        await send_user_msg(f"FILEDATA {transfer.id} {offset} {base64.b64encode(data).decode()}",
+                            CODES.SUCCESS, client.writer, request_id)
+
 """
 Parse input and give it out as a list of strings
 """
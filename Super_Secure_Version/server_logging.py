@@ -0,0 +1,143 @@
+# server_logging.py - Buffered structured logging for the server
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import time
+
+# Logging defaults
+ROOT_LOGGER = "chat"
+LOG_QUEUE_SIZE = 10000         # Records buffered before new ones are dropped
+COMMAND_LOG_SAMPLE = 100       # Keep one in this many per-command records
+
+# Attributes every LogRecord has. Anything else came in through extra= and is a field.
+STANDARD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+def fields(record: logging.LogRecord) -> dict:
+    """The extra= fields attached to a record"""
+    return {k: v for k, v in vars(record).items() if k not in STANDARD_ATTRS}
+
+"""
+Renders a record as one line of key=value pairs after the message:
+2026-01-01T12:00:00 INFO chat.server connection opened addr=127.0.0.1:5000
+"""
+class KeyValueFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        stamp = time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(record.created))
+        line = f"{stamp} {record.levelname} {record.name} {record.getMessage()}"
+        extra = " ".join(f"{k}={quote(v)}" for k, v in fields(record).items())
+        if extra:
+            line += " " + extra
+        if record.exc_info:
+            line += "\n" + self.formatException(record.exc_info)
+        return line
+
+def quote(value) -> str:
+    """Quote values with spaces so key=value lines stay splittable"""
+    text = str(value)
+    return json.dumps(text) if " " in text or not text else text
+
+"""
+Renders a record as one JSON object per line, for log shippers.
+"""
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {"ts": record.created, "level": record.levelname, "logger": record.name, "msg": record.getMessage()}
+        entry.update(fields(record))
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+"""
+Queue handler that never blocks the event loop. Records are handed to the writer
+thread as they are (formatting happens there, not on the loop) and are dropped
+with a count instead of waiting when the queue is full.
+"""
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, log_queue: queue.Queue) -> None:
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+"""
+Keeps one record in every N. Meant for loggers that fire once per message or
+command; kept records carry sample=N so counts can be scaled back up.
+"""
+class SamplingFilter(logging.Filter):
+    def __init__(self, every: int) -> None:
+        super().__init__()
+        self.every = max(1, every)
+        self.seen = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        self.seen += 1
+        if self.seen % self.every:
+            return False
+        record.sample = self.every
+        return True
+
+# Set up by setup_logging
+_handler: DroppingQueueHandler | None = None
+_listener: logging.handlers.QueueListener | None = None
+_sampler = SamplingFilter(COMMAND_LOG_SAMPLE)
+
+def get_logger(name: str) -> logging.Logger:
+    """Logger under the server's namespace, e.g. get_logger("auth") -> chat.auth"""
+    return logging.getLogger(f"{ROOT_LOGGER}.{name}")
+
+def setup_logging(level: str = "INFO", json_lines: bool = False, path: str | None = None,
+                  command_sample: int = COMMAND_LOG_SAMPLE) -> None:
+    """Route every chat.* logger through a bounded queue to a background writer thread"""
+    global _handler, _listener
+    if _listener is not None:
+        return
+
+    output = logging.FileHandler(path) if path else logging.StreamHandler(sys.stdout)
+    output.setFormatter(JsonFormatter() if json_lines else KeyValueFormatter())
+
+    log_queue = queue.Queue(LOG_QUEUE_SIZE)
+    _handler = DroppingQueueHandler(log_queue)
+    _listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=False)
+
+    root = logging.getLogger(ROOT_LOGGER)
+    root.addHandler(_handler)
+    root.setLevel(level.upper())
+    root.propagate = False
+
+    _sampler.every = max(1, command_sample)
+    get_logger("commands").addFilter(_sampler)
+
+    _listener.start()
+    atexit.register(shutdown_logging)
+
+def shutdown_logging() -> None:
+    """Flush whatever is still queued and stop the writer thread"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+def set_level(level: str, name: str = ROOT_LOGGER) -> str:
+    """Change a logger's level at runtime, returns the level now in effect"""
+    logger = logging.getLogger(name)
+    logger.setLevel(level.upper())
+    return logging.getLevelName(logger.getEffectiveLevel())
+
+def logging_stats() -> dict:
+    """Queue depth and drop counts, for the admin endpoint"""
+    return {
+        "level": logging.getLevelName(logging.getLogger(ROOT_LOGGER).getEffectiveLevel()),
+        "queued": _handler.queue.qsize() if _handler else 0,
+        "dropped": _handler.dropped if _handler else 0,
+        "command_sample": _sampler.every,
+    }
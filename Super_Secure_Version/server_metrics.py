@@ -0,0 +1,226 @@
+# server_metrics.py - Lightweight counters, gauges and histograms for the server
+import bisect
+import functools
+import itertools
+import time
+
+# Histogram resolution. Each power of two is split into 2**SUB_BITS buckets,
+# so any recorded value lands in a bucket within ~3% of it.
+SUB_BITS = 5
+SUB_COUNT = 1 << SUB_BITS
+MAX_EXPONENT = 42          # Values up to 2**42 ns (~73 minutes)
+
+# Fixed bucket bounds (seconds) used when exporting histograms in Prometheus format
+EXPORT_BUCKETS = [0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                  0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0]
+
+"""
+Monotonic counter.
+"""
+class Counter:
+    __slots__ = ("name", "labels", "help", "value")
+    kind = "counter"
+
+    def __init__(self, name: str, labels: tuple, help: str) -> None:
+        self.name = name
+        self.labels = labels
+        self.help = help
+        self.value = 0
+
+    def inc(self, amount: int = 1) -> None:
+        self.value += amount
+
+"""
+Value that goes up and down. If a function is given, it is called at read time
+instead, which suits things that already keep their own count (like len(clients)).
+"""
+class Gauge:
+    __slots__ = ("name", "labels", "help", "_value", "fn")
+    kind = "gauge"
+
+    def __init__(self, name: str, labels: tuple, help: str, fn=None) -> None:
+        self.name = name
+        self.labels = labels
+        self.help = help
+        self._value = 0
+        self.fn = fn
+
+    def set(self, value: float) -> None:
+        self._value = value
+
+    def inc(self, amount: float = 1) -> None:
+        self._value += amount
+
+    def dec(self, amount: float = 1) -> None:
+        self._value -= amount
+
+    @property
+    def value(self) -> float:
+        return self.fn() if self.fn is not None else self._value
+
+"""
+HDR-style log-linear histogram of durations in nanoseconds. Recording is a bit_length,
+a shift and a list increment, well under a microsecond. Values below SUB_COUNT ns get
+exact buckets; above that each power of two has SUB_COUNT equal-width buckets.
+"""
+class Histogram:
+    __slots__ = ("name", "labels", "help", "counts", "count", "total")
+    kind = "histogram"
+
+    def __init__(self, name: str, labels: tuple, help: str) -> None:
+        self.name = name
+        self.labels = labels
+        self.help = help
+        self.counts = [0] * (SUB_COUNT * (MAX_EXPONENT - SUB_BITS + 1))
+        self.count = 0
+        self.total = 0
+
+    def record(self, value_ns: int) -> None:
+        """Add one sample, in nanoseconds"""
+        if value_ns < SUB_COUNT:
+            index = value_ns if value_ns > 0 else 0
+        else:
+            shift = value_ns.bit_length() - SUB_BITS - 1
+            index = (shift + 1) * SUB_COUNT + (value_ns >> shift) - SUB_COUNT
+            if index >= len(self.counts):
+                index = len(self.counts) - 1
+        self.counts[index] += 1
+        self.count += 1
+        self.total += value_ns
+
+    @staticmethod
+    def bucket_bounds(index: int) -> tuple[int, int]:
+        """Lowest value and one past the highest value (ns) a bucket covers"""
+        if index < SUB_COUNT:
+            return index, index + 1
+        shift, sub = divmod(index - SUB_COUNT, SUB_COUNT)
+        return (SUB_COUNT + sub) << shift, (SUB_COUNT + sub + 1) << shift
+
+    def percentile(self, pct: float) -> float:
+        """Approximate percentile in seconds (upper edge of the bucket it falls in)"""
+        if self.count == 0:
+            return 0.0
+        target = max(1, int(self.count * pct / 100 + 0.5))
+        seen = 0
+        for index, n in enumerate(self.counts):
+            seen += n
+            if seen >= target:
+                return self.bucket_bounds(index)[1] / 1e9
+        return self.bucket_bounds(len(self.counts) - 1)[1] / 1e9
+
+    def cumulative(self, bounds_seconds: list) -> list[int]:
+        """Number of samples in buckets that end at or below each bound, for exporting fixed buckets"""
+        if self.count == 0:
+            return [0] * len(bounds_seconds)
+        running = list(itertools.accumulate(self.counts))
+        result = []
+        for bound in bounds_seconds:
+            index = bisect.bisect_right(BUCKET_UPPER_NS, bound * 1e9)
+            result.append(running[index - 1] if index else 0)
+        return result
+
+    def timer(self):
+        """Context manager that records how long its block took"""
+        return _Timer(self)
+
+# Upper edge (ns) of every histogram bucket, in index order
+BUCKET_UPPER_NS = [Histogram.bucket_bounds(i)[1] for i in range(SUB_COUNT * (MAX_EXPONENT - SUB_BITS + 1))]
+
+class _Timer:
+    __slots__ = ("histogram", "started")
+
+    def __init__(self, histogram: Histogram) -> None:
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.started = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.histogram.record(time.perf_counter_ns() - self.started)
+
+"""
+Holds every metric by (name, labels). Call sites should look their metric up once
+and keep the object, so the hot path is only the record/inc call.
+"""
+class MetricsRegistry:
+    def __init__(self) -> None:
+        self.metrics: dict[tuple, object] = {}
+
+    def _get(self, cls, name: str, labels: dict | None, help: str, **kwargs):
+        key = (name, tuple(sorted((labels or {}).items())))
+        metric = self.metrics.get(key)
+        if metric is None:
+            metric = self.metrics[key] = cls(name, key[1], help, **kwargs)
+        return metric
+
+    def counter(self, name: str, labels: dict | None = None, help: str = "") -> Counter:
+        return self._get(Counter, name, labels, help)
+
+    def gauge(self, name: str, labels: dict | None = None, help: str = "", fn=None) -> Gauge:
+        return self._get(Gauge, name, labels, help, fn=fn)
+
+    def histogram(self, name: str, labels: dict | None = None, help: str = "") -> Histogram:
+        return self._get(Histogram, name, labels, help)
+
+    def snapshot(self) -> dict:
+        """Plain dict of every metric, with p50/p95/p99 for histograms"""
+        result = {}
+        for metric in self.metrics.values():
+            label_str = ",".join(f"{k}={v}" for k, v in metric.labels)
+            key = f"{metric.name}{{{label_str}}}" if label_str else metric.name
+            if isinstance(metric, Histogram):
+                result[key] = {
+                    "count": metric.count,
+                    "sum_seconds": metric.total / 1e9,
+                    "p50": metric.percentile(50),
+                    "p95": metric.percentile(95),
+                    "p99": metric.percentile(99),
+                }
+            else:
+                result[key] = metric.value
+        return result
+
+    def render_prometheus(self) -> str:
+        """Every metric in the Prometheus text exposition format"""
+        lines = []
+        described = set()
+        for metric in sorted(self.metrics.values(), key=lambda m: (m.name, m.labels)):
+            if metric.name not in described:
+                described.add(metric.name)
+                if metric.help:
+                    lines.append(f"# HELP {metric.name} {metric.help}")
+                lines.append(f"# TYPE {metric.name} {metric.kind}")
+
+            if isinstance(metric, Histogram):
+                for bound, seen in zip(EXPORT_BUCKETS, metric.cumulative(EXPORT_BUCKETS)):
+                    lines.append(f"{metric.name}_bucket{format_labels(metric.labels + (('le', repr(bound)),))} {seen}")
+                lines.append(f"{metric.name}_bucket{format_labels(metric.labels + (('le', '+Inf'),))} {metric.count}")
+                lines.append(f"{metric.name}_sum{format_labels(metric.labels)} {metric.total / 1e9}")
+                lines.append(f"{metric.name}_count{format_labels(metric.labels)} {metric.count}")
+            else:
+                lines.append(f"{metric.name}{format_labels(metric.labels)} {metric.value}")
+        return "\n".join(lines) + "\n"
+
+def format_labels(labels: tuple) -> str:
+    """Render a label tuple as {k="v",...}"""
+    if not labels:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in labels)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(labels, escaped)) + "}"
+
+# Shared registry used by the server modules
+metrics = MetricsRegistry()
+
+def timed(histogram: Histogram):
+    """Decorator recording the duration of an async function into histogram"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter_ns()
+            try:
+                return await fn(*args, **kwargs)
+            finally:
+                histogram.record(time.perf_counter_ns() - started)
+        return wrapper
+    return decorator
@@ -0,0 +1,175 @@
+# server_profiler.py - Bounded profiling windows on a running server
+import asyncio
+import cProfile
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter as Tally
+from server_metrics import metrics, Histogram
+from server_logging import get_logger
+
+log = get_logger("profiler")
+
+# Profiling defaults
+PROFILE_DIR = "profiles"
+DEFAULT_SECONDS = 30
+MAX_SECONDS = 300
+SAMPLE_INTERVAL = 0.005        # Seconds between stack samples in "sample" mode
+TOP_FUNCTIONS = 50             # Rows in the cProfile text summary
+
+# Histograms whose per-label wall time is reported for the window
+ATTRIBUTED = ("command_seconds", "auth_phase_seconds", "auth_seconds", "crypto_seconds", "db_seconds")
+
+"""
+Runs one profiling window at a time on this server process (one worker), started
+from the admin endpoint or SIGUSR2 and stopped by a timer. Two modes:
+
+- "cprofile" enables cProfile on the event loop thread. Exact call counts, but it
+  slows every Python call while on.
+- "sample" has a thread read the loop thread's stack every SAMPLE_INTERVAL and
+  count collapsed stacks, cheap enough to leave on under real load.
+
+Either way, the window's wall time per CLIENT_CMDS handler and per auth phase is
+taken from the metric histograms (difference between start and end), and
+everything is written under PROFILE_DIR with the pid in the file names.
+"""
+class Profiler:
+    def __init__(self, directory: str = PROFILE_DIR, sample_interval: float = SAMPLE_INTERVAL) -> None:
+        self.directory = directory
+        self.sample_interval = sample_interval
+
+        self.mode = None
+        self.started = 0.0
+        self.seconds = 0.0
+        self.last_output = None
+        self._profile = None
+        self._stacks: Tally = Tally()
+        self._sampler = None
+        self._stopping = threading.Event()
+        self._timer = None
+        self._baseline = {}
+
+    @property
+    def running(self) -> bool:
+        return self.mode is not None
+
+    def start(self, seconds: float = DEFAULT_SECONDS, mode: str = "cprofile") -> bool:
+        """Begin a window on the running loop. False if one is already running."""
+        if self.running:
+            return False
+        if mode not in ("cprofile", "sample"):
+            raise ValueError(f"Unknown profile mode: {mode}")
+
+        self.seconds = min(max(seconds, 0.1), MAX_SECONDS)
+        self.mode = mode
+        self.started = time.time()
+        self._baseline = attribution_snapshot()
+
+        if mode == "cprofile":
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        else:
+            self._stacks.clear()
+            self._stopping.clear()
+            loop_thread = threading.get_ident()
+            self._sampler = threading.Thread(target=self.sample, args=(loop_thread,), name="profiler", daemon=True)
+            self._sampler.start()
+
+        self._timer = asyncio.get_running_loop().call_later(self.seconds, self.stop)
+        log.warning("profiling started", extra={"mode": mode, "seconds": self.seconds})
+        return True
+
+    def sample(self, loop_thread: int) -> None:
+        """Sampling thread: count the loop thread's collapsed stacks"""
+        while not self._stopping.wait(self.sample_interval):
+            frame = sys._current_frames().get(loop_thread)
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            if names:
+                self._stacks[";".join(reversed(names))] += 1
+
+    def stop(self) -> str | None:
+        """End the window and write the results, returns the path prefix written"""
+        if not self.running:
+            return None
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        if self._profile is not None:
+            self._profile.disable()
+        if self._sampler is not None:
+            self._stopping.set()
+            self._sampler.join()
+
+        os.makedirs(self.directory, exist_ok=True)
+        stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(self.started))
+        prefix = os.path.join(self.directory, f"profile-{os.getpid()}-{stamp}-{self.mode}")
+
+        if self._profile is not None:
+            self._profile.dump_stats(prefix + ".pstats")
+            with open(prefix + ".txt", "w") as f:
+                stats = pstats.Stats(self._profile, stream=f)
+                stats.sort_stats("cumulative").print_stats(TOP_FUNCTIONS)
+        else:
+            # Collapsed stack format, ready for flamegraph.pl or speedscope
+            with open(prefix + ".folded", "w") as f:
+                for stack, count in self._stacks.most_common():
+                    f.write(f"{stack} {count}\n")
+
+        summary = {
+            "pid": os.getpid(),
+            "mode": self.mode,
+            "started": self.started,
+            "seconds": time.time() - self.started,
+            "samples": sum(self._stacks.values()) if self._profile is None else None,
+            "wall_time": attribution_delta(self._baseline, attribution_snapshot()),
+        }
+        with open(prefix + ".json", "w") as f:
+            json.dump(summary, f, indent=2)
+
+        log.warning("profiling finished", extra={"mode": self.mode, "output": prefix})
+        self.mode = None
+        self._profile = None
+        self._sampler = None
+        self._stacks.clear()
+        self.last_output = prefix
+        return prefix
+
+    def stats(self) -> dict:
+        """Whether a window is running and where the last one went"""
+        return {
+            "running": self.running,
+            "mode": self.mode,
+            "remaining_seconds": max(0.0, self.started + self.seconds - time.time()) if self.running else 0.0,
+            "last_output": self.last_output,
+        }
+
+def attribution_snapshot() -> dict:
+    """(count, total ns) of every attributed histogram, keyed by name and labels"""
+    snapshot = {}
+    for metric in metrics.metrics.values():
+        if isinstance(metric, Histogram) and metric.name in ATTRIBUTED:
+            label_str = ",".join(f"{k}={v}" for k, v in metric.labels)
+            snapshot[f"{metric.name}{{{label_str}}}"] = (metric.count, metric.total)
+    return snapshot
+
+def attribution_delta(before: dict, after: dict) -> dict:
+    """Calls and wall seconds per handler/phase during the window, busiest first"""
+    rows = {}
+    for key, (count, total) in after.items():
+        count_before, total_before = before.get(key, (0, 0))
+        calls = count - count_before
+        if calls:
+            seconds = (total - total_before) / 1e9
+            rows[key] = {"calls": calls, "wall_seconds": seconds, "mean_seconds": seconds / calls}
+    return dict(sorted(rows.items(), key=lambda item: item[1]["wall_seconds"], reverse=True))
+
+# Shared profiler for this server process
+profiler = Profiler()
@@ -0,0 +1,156 @@
+# server_ratelimit.py - In-memory token-bucket rate limiting for logins
+import asyncio
+import time
+
+# Login rate limits. RATE is tokens refilled per second, BURST is the bucket size.
+LOGIN_RATE_PER_IP = 1.0
+LOGIN_BURST_PER_IP = 10
+LOGIN_RATE_PER_USER = 0.2
+LOGIN_BURST_PER_USER = 5
+
+# How often idle (full) buckets are dropped from the tables
+COMPACT_INTERVAL = 60
+
+"""
+A single bucket. Tokens are refilled lazily from the time of the last check,
+so nothing has to run in the background per key.
+"""
+class TokenBucket:
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, tokens: float, now: float) -> None:
+        self.tokens = tokens
+        self.updated = now
+
+"""
+Table of token buckets keyed by an arbitrary string (a username or an IP address).
+Each check is a dict lookup and a little arithmetic. Buckets that have refilled
+completely carry no information, so compact() drops them to keep the table small.
+"""
+class TokenBucketTable:
+    def __init__(self, rate: float, burst: int) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.buckets: dict[str, TokenBucket] = {}
+        self.allowed = 0
+        self.limited = 0
+
+    def _refill(self, key: str, now: float | None) -> TokenBucket:
+        """Look up the bucket for key, topped up for the time since it was last touched"""
+        if now is None:
+            now = time.monotonic()
+
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = TokenBucket(self.burst, now)
+        else:
+            bucket.tokens = min(self.burst, bucket.tokens + (now - bucket.updated) * self.rate)
+            bucket.updated = now
+        return bucket
+
+    def allow(self, key: str, now: float | None = None) -> bool:
+        """Take a token for key if one is available"""
+        bucket = self._refill(key, now)
+        if bucket.tokens >= 1:
+            bucket.tokens -= 1
+            self.allowed += 1
+            return True
+
+        self.limited += 1
+        return False
+
+    def check(self, key: str, now: float | None = None) -> bool:
+        """Whether key has a token left, without taking it"""
+        if key not in self.buckets:
+            self.allowed += 1
+            return True
+
+        if self._refill(key, now).tokens >= 1:
+            self.allowed += 1
+            return True
+
+        self.limited += 1
+        return False
+
+    def charge(self, key: str, now: float | None = None) -> None:
+        """Take a token for key after the fact. The bucket bottoms out at zero."""
+        bucket = self._refill(key, now)
+        bucket.tokens = max(0.0, bucket.tokens - 1)
+
+    def reset(self, key: str) -> None:
+        """Forget key, leaving it with a full bucket"""
+        self.buckets.pop(key, None)
+
+    def compact(self, now: float | None = None) -> int:
+        """Drop buckets that would be full by now. Returns how many were removed."""
+        if now is None:
+            now = time.monotonic()
+
+        idle = [key for key, bucket in self.buckets.items()
+                if bucket.tokens + (now - bucket.updated) * self.rate >= self.burst]
+        for key in idle:
+            del self.buckets[key]
+        return len(idle)
+
+    def stats(self) -> dict:
+        """Snapshot of the table counters"""
+        return {"buckets": len(self.buckets), "allowed": self.allowed, "limited": self.limited}
+
+"""
+Login limiter with one table per source IP and one per username. It only touches
+memory, so it is checked before any DB lookup or crypto work on the login path.
+Every attempt costs an address token. A username only pays for failed attempts and
+is cleared by a successful login, so nobody can lock a user out by starting logins
+in their name, and the user can always get back in with a valid resume ticket.
+"""
+class LoginRateLimiter:
+    def __init__(self, ip_rate: float = LOGIN_RATE_PER_IP, ip_burst: int = LOGIN_BURST_PER_IP,
+                 user_rate: float = LOGIN_RATE_PER_USER, user_burst: int = LOGIN_BURST_PER_USER,
+                 compact_interval: float = COMPACT_INTERVAL) -> None:
+        self.by_ip = TokenBucketTable(ip_rate, ip_burst)
+        self.by_user = TokenBucketTable(user_rate, user_burst)
+        self.compact_interval = compact_interval
+        self._task = None
+
+    def allow_ip(self, ip: str) -> bool:
+        """Check the per-address bucket"""
+        return self.by_ip.allow(ip)
+
+    def allow_user(self, username: str) -> bool:
+        """Check the per-username bucket without charging it"""
+        return self.by_user.check(username)
+
+    def fail_user(self, username: str) -> None:
+        """Charge the per-username bucket for a failed attempt"""
+        if username:
+            self.by_user.charge(username)
+
+    def clear_user(self, username: str) -> None:
+        """Reset the per-username bucket after a successful login"""
+        self.by_user.reset(username)
+
+    def start(self) -> None:
+        """Start the periodic compaction task on the running loop"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self.run())
+
+    def stop(self) -> None:
+        """Cancel the compaction task"""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def run(self) -> None:
+        """Compact both tables every compact_interval seconds"""
+        while True:
+            await asyncio.sleep(self.compact_interval)
+            now = time.monotonic()
+            self.by_ip.compact(now)
+            self.by_user.compact(now)
+
+    def stats(self) -> dict:
+        """Snapshot of both tables, for metrics"""
+        return {"ip": self.by_ip.stats(), "user": self.by_user.stats()}
+
+# Shared limiter used by the server modules
+login_limiter = LoginRateLimiter()
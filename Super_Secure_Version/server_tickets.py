@@ -0,0 +1,124 @@
+# server_tickets.py - Short-lived resume tickets so reconnects can skip the full login
+import asyncio
+import base64
+import hashlib
+import hmac
+import os
+import time
+from crypto.encryption import encrypt_message
+
+# Ticket policy (seconds)
+TICKET_LIFETIME = 600          # How long an issued ticket can be used to resume
+TICKET_KEY_ROTATION = 3600     # How often a fresh signing key is generated
+TICKET_KEYS_KEPT = 2           # Signing keys still accepted, newest first
+
+def b64url(data: bytes) -> str:
+    """Base64url encode without padding, safe to put inside a msg"""
+    return base64.urlsafe_b64encode(data).decode().rstrip("=")
+
+def unb64url(data: str) -> bytes:
+    """Reverse of b64url"""
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+"""
+Issues and checks HMAC-signed resume tickets. A ticket looks like
+
+    <key id>.<username>.<expiry>.<nonce>.<mac>
+
+where the username and nonce are base64url encoded and the mac is HMAC-SHA256 over
+everything before it. Checking one is a single MAC computation, no DB or RSA work.
+Tickets are single use: the nonce is remembered until the ticket would have expired,
+and every successful resume hands out a fresh ticket. Signing keys rotate on a timer
+and the previous TICKET_KEYS_KEPT - 1 keys stay valid so tickets survive a rotation.
+Tickets are handed out sealed to the user's public key (see seal), so one seen on
+the wire or in a log is no use without the user's private key.
+"""
+class TicketAuthority:
+    def __init__(self, lifetime: float = TICKET_LIFETIME, rotation: float = TICKET_KEY_ROTATION,
+                 keys_kept: int = TICKET_KEYS_KEPT) -> None:
+        self.lifetime = lifetime
+        self.rotation = rotation
+        self.keys_kept = keys_kept
+        self.keys: dict[int, bytes] = {}
+        self.current_key_id = 0
+        self.used_nonces: dict[str, float] = {}
+        self._task = None
+
+        # Counters
+        self.issued = 0
+        self.hits = 0
+        self.misses = 0
+
+        self.rotate()
+
+    def rotate(self) -> None:
+        """Start signing with a fresh key and forget keys past keys_kept"""
+        self.current_key_id += 1
+        self.keys[self.current_key_id] = os.urandom(32)
+        for key_id in [k for k in self.keys if k <= self.current_key_id - self.keys_kept]:
+            del self.keys[key_id]
+
+    def sign(self, key: bytes, body: str) -> str:
+        """MAC for the ticket body"""
+        return b64url(hmac.new(key, body.encode(), hashlib.sha256).digest())
+
+    def issue(self, username: str) -> str:
+        """Create a ticket for an authenticated user"""
+        expiry = int(time.time() + self.lifetime)
+        body = f"{self.current_key_id}.{b64url(username.encode())}.{expiry}.{b64url(os.urandom(12))}"
+        self.issued += 1
+        return f"{body}.{self.sign(self.keys[self.current_key_id], body)}"
+
+    @staticmethod
+    def seal(ticket: str, public_key_pem: str) -> str:
+        """
+        Encrypt an issued ticket to the user's public key, an encrypt_message JSON string.
+        Touches no authority state, so safe on any thread.
+        """
+        return encrypt_message(ticket, public_key_pem)
+
+    def redeem(self, ticket: str) -> str | None:
+        """Check a ticket and return its username, or None if it can't be used"""
+        try:
+            key_id, user_part, expiry, nonce, mac = ticket.split(".")
+            key = self.keys.get(int(key_id))
+            now = time.time()
+
+            if (key is None or int(expiry) < now or nonce in self.used_nonces
+                    or not hmac.compare_digest(mac, self.sign(key, ticket.rsplit(".", 1)[0]))):
+                self.misses += 1
+                return None
+
+            self.used_nonces[nonce] = int(expiry)
+            self.hits += 1
+            return unb64url(user_part).decode()
+        except (ValueError, UnicodeDecodeError):
+            self.misses += 1
+            return None
+
+    def start(self) -> None:
+        """Start the key rotation task on the running loop"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self.run())
+
+    def stop(self) -> None:
+        """Cancel the key rotation task"""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def run(self) -> None:
+        """Rotate keys and forget nonces of tickets that have expired anyway"""
+        while True:
+            await asyncio.sleep(self.rotation)
+            self.rotate()
+            now = time.time()
+            self.used_nonces = {n: exp for n, exp in self.used_nonces.items() if exp >= now}
+
+    def stats(self) -> dict:
+        """Snapshot of the ticket counters"""
+        return {"issued": self.issued, "hits": self.hits, "misses": self.misses,
+                "keys": len(self.keys), "used_nonces": len(self.used_nonces)}
+
+# Shared ticket authority used by the server modules
+tickets = TicketAuthority()
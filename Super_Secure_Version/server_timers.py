@@ -0,0 +1,238 @@
+# server_timers.py - Idle, auth and keepalive timeouts driven by a hashed timer wheel
+import asyncio
+import time
+from json_msg import CODES, msg
+from server_logging import get_logger
+
+log = get_logger("timers")
+
+# Timeout policies (seconds). Set KEEPALIVE_INTERVAL to None to disable keepalives.
+AUTH_TIMEOUT = 240          # Time a new connection has to finish logging in
+IDLE_TIMEOUT = 30 * 60      # Time an authenticated connection may stay silent
+KEEPALIVE_INTERVAL = 240    # Silence after which the server pings the client
+
+# Wheel geometry. TICK is the timeout resolution, WHEEL_SLOTS * TICK is one revolution.
+TICK = 1.0
+WHEEL_SLOTS = 512
+
+"""
+One tracked connection. Reads only ever update last_activity, the wheel works out
+the real deadline lazily when the slot the connection sits in comes around.
+protocol is "json" or "text", the protocol the connection speaks. keepalive is set
+once the client has shown it parses whole frames, see ConnectionManager.
+"""
+class Connection:
+    __slots__ = ("writer", "protocol", "created", "last_activity", "last_keepalive",
+                 "keepalive", "authenticated", "expired", "wheel_tick")
+
+    def __init__(self, writer: asyncio.StreamWriter, now: float, protocol: str = "json") -> None:
+        self.writer = writer
+        self.protocol = protocol
+        self.created = now
+        self.last_activity = now
+        self.last_keepalive = now
+        self.keepalive = False
+        self.authenticated = False
+        self.expired = False
+        self.wheel_tick = -1
+
+"""
+Hashed timer wheel. Items are bucketed by the tick their deadline falls on, so
+scheduling and cancelling are O(1) and a sweep only looks at the slots it passes.
+Items store their absolute tick, which takes care of deadlines more than one
+revolution away.
+"""
+class HashedTimerWheel:
+    def __init__(self, tick: float = TICK, slots: int = WHEEL_SLOTS) -> None:
+        self.tick = tick
+        self.slots = [set() for _ in range(slots)]
+        self.current_tick = int(time.monotonic() / tick)
+
+    def schedule(self, item: Connection, deadline: float) -> None:
+        """Place an item in the slot its deadline falls on"""
+        self.cancel(item)
+        item.wheel_tick = max(int(deadline / self.tick), self.current_tick + 1)
+        self.slots[item.wheel_tick % len(self.slots)].add(item)
+
+    def cancel(self, item: Connection) -> None:
+        """Remove an item from the wheel if it is scheduled"""
+        if item.wheel_tick >= 0:
+            self.slots[item.wheel_tick % len(self.slots)].discard(item)
+            item.wheel_tick = -1
+
+    def advance(self, now: float) -> list:
+        """Move the wheel up to now and return every item whose tick has passed"""
+        target = int(now / self.tick)
+        steps = min(target - self.current_tick, len(self.slots))
+        due = []
+
+        for step in range(1, steps + 1):
+            slot = self.slots[(self.current_tick + step) % len(self.slots)]
+            ready = [item for item in slot if item.wheel_tick <= target]
+            for item in ready:
+                slot.discard(item)
+                item.wheel_tick = -1
+            due.extend(ready)
+
+        self.current_tick = max(self.current_tick, target)
+        return due
+
+"""
+Tracks every open connection and expires the ones that have gone quiet. This replaces
+wrapping each reader.read in asyncio.wait_for: a read just calls touch(), and a single
+periodic sweep handles auth timeouts, idle timeouts and keepalives for all connections.
+Expired connections get an EXIT message and are closed, which makes their pending read
+return b'' so the handler unwinds normally.
+
+Plain text connections only have the auth timeout, told with a plain text line. Once
+logged in they get no keepalives and are never closed for being idle, as before.
+JSON connections only get keepalives after enable_keepalive(): the interactive client
+takes any frame for a prompt or a message, so pings go only to clients that have sent
+a tagged command and therefore sort frames by code.
+"""
+class ConnectionManager:
+    def __init__(self, idle_timeout: float = IDLE_TIMEOUT, auth_timeout: float = AUTH_TIMEOUT,
+                 keepalive_interval: float | None = KEEPALIVE_INTERVAL,
+                 tick: float = TICK, slots: int = WHEEL_SLOTS) -> None:
+        self.idle_timeout = idle_timeout
+        self.auth_timeout = auth_timeout
+        self.keepalive_interval = keepalive_interval
+        self.wheel = HashedTimerWheel(tick, slots)
+        self.connections: dict[asyncio.StreamWriter, Connection] = {}
+        self.expired_count = 0
+        self.keepalive_count = 0
+        self._task = None
+
+    def start(self) -> None:
+        """Start the sweep task on the running loop"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self.run())
+
+    def stop(self) -> None:
+        """Cancel the sweep task"""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def register(self, writer: asyncio.StreamWriter, protocol: str = "json") -> Connection:
+        """Start tracking a newly accepted connection speaking protocol ("json" or "text")"""
+        conn = Connection(writer, time.monotonic(), protocol)
+        self.connections[writer] = conn
+        self._schedule(conn)
+        return conn
+
+    def unregister(self, writer: asyncio.StreamWriter) -> None:
+        """Stop tracking a connection"""
+        conn = self.connections.pop(writer, None)
+        if conn is not None:
+            self.wheel.cancel(conn)
+
+    def touch(self, writer: asyncio.StreamWriter) -> None:
+        """Record activity on a connection. Called after every read, so keep it cheap."""
+        conn = self.connections.get(writer)
+        if conn is not None:
+            conn.last_activity = time.monotonic()
+
+    def mark_authenticated(self, writer: asyncio.StreamWriter) -> None:
+        """Switch a connection from the auth timeout to the idle timeout"""
+        conn = self.connections.get(writer)
+        if conn is not None and not conn.authenticated:
+            conn.authenticated = True
+            conn.last_activity = time.monotonic()
+            self._schedule(conn)
+
+    def enable_keepalive(self, writer: asyncio.StreamWriter) -> None:
+        """Start pinging a connection when it goes quiet. Only for clients that know KEEPALIVE."""
+        conn = self.connections.get(writer)
+        if conn is not None and not conn.keepalive:
+            conn.keepalive = True
+            self._schedule(conn)
+
+    def is_expired(self, writer: asyncio.StreamWriter) -> bool:
+        """Check if a connection was closed by the sweep rather than by the client"""
+        conn = self.connections.get(writer)
+        return conn is not None and conn.expired
+
+    def _deadline(self, conn: Connection) -> float | None:
+        """Earliest time the sweep needs to look at this connection again, None for never"""
+        if not conn.authenticated:
+            return conn.created + self.auth_timeout
+        if conn.protocol == "text":
+            return None
+
+        deadline = conn.last_activity + self.idle_timeout
+        if conn.keepalive and self.keepalive_interval is not None:
+            quiet_since = max(conn.last_activity, conn.last_keepalive)
+            deadline = min(deadline, quiet_since + self.keepalive_interval)
+        return deadline
+
+    def _schedule(self, conn: Connection) -> None:
+        deadline = self._deadline(conn)
+        if deadline is None:
+            self.wheel.cancel(conn)
+        else:
+            self.wheel.schedule(conn, deadline)
+
+    def sweep(self, now: float) -> None:
+        """Handle every connection whose slot has come around"""
+        for conn in self.wheel.advance(now):
+            if conn.writer not in self.connections:
+                continue
+
+            # Activity since scheduling pushed the deadline back, just re-file it
+            deadline = self._deadline(conn)
+            if deadline is None or deadline > now:
+                self._schedule(conn)
+                continue
+
+            if not conn.authenticated:
+                self._expire(conn, "Authentication timed out. Closing connection")
+            elif now - conn.last_activity >= self.idle_timeout:
+                self._expire(conn, "Idle timeout. Closing connection")
+            else:
+                self._keepalive(conn, now)
+
+    def _expire(self, conn: Connection, reason: str) -> None:
+        """Tell the client why and close the transport"""
+        conn.expired = True
+        self.expired_count += 1
+        try:
+            conn.writer.write(self._frame(conn, CODES.EXIT, reason))
+            conn.writer.close()
+        except Exception as e:
+            log.warning("expire failed", extra={"error": str(e)})
+
+    def _keepalive(self, conn: Connection, now: float) -> None:
+        """Ping a quiet client and schedule the next check"""
+        conn.last_keepalive = now
+        self.keepalive_count += 1
+        try:
+            conn.writer.write(self._frame(conn, CODES.KEEPALIVE, "Still there?"))
+        except Exception as e:
+            log.warning("keepalive failed", extra={"error": str(e)})
+        self._schedule(conn)
+
+    def _frame(self, conn: Connection, code: CODES, text: str) -> bytes:
+        """text as the connection's protocol sends it: a msg frame, or the bare line"""
+        if conn.protocol == "text":
+            return text.encode()
+        return msg(code.value, text).to_json_str().encode()
+
+    async def run(self) -> None:
+        """Periodic sweep, one for the whole server"""
+        while True:
+            await asyncio.sleep(self.wheel.tick)
+            self.sweep(time.monotonic())
+
+    def stats(self) -> dict:
+        """Snapshot of the tracked connections and timeout counters"""
+        authenticated = sum(1 for conn in self.connections.values() if conn.authenticated)
+        return {
+            "tracked": len(self.connections),
+            "authenticated": authenticated,
+            "expired": self.expired_count,
+            "keepalives": self.keepalive_count,
+        }
+
+# Shared manager used by the server modules
+connections = ConnectionManager()
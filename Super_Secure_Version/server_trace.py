@@ -0,0 +1,170 @@
+# server_trace.py - Records the timing and sizes of every frame for later replay
+import asyncio
+import itertools
+import json
+import re
+import struct
+import time
+from json_msg import CODES
+from server_timers import connections
+from server_logging import get_logger
+
+log = get_logger("trace")
+
+# File layout: MAGIC, one JSON header line, then fixed size records
+MAGIC = b"CHATTRACE1\n"
+RECORD = struct.Struct("<dIBBI")   # seconds since start, connection id, event, tag index, bytes
+FLUSH_INTERVAL = 1.0               # Seconds between writes to disk
+MAX_BUFFER = 1 << 20               # Flush early once this many bytes are waiting
+
+# Event kinds
+OPEN, IN, OUT, CLOSE = range(4)
+
+# Frame tags. Inbound frames are tagged by command, outbound ones by CODES value.
+# Anything sent before login finishes is LOGIN, so usernames and passwords never show up.
+COMMANDS = ["SEND", "EXIT", "GETUSERS", "HELP", "PUBKEY", "GETKEY", "GET_SALT", "RESUME", "GETKEYS", "PRESENCE", "SENDFILE", "RECVFILE"]
+TAGS = ["", "LOGIN", "DATA", "TEXT"] + COMMANDS + [code.value for code in CODES]
+TAG_INDEX = {tag: i for i, tag in enumerate(TAGS)}
+# "#<request id>:<length> " in front of a tagged command (server_utils.CommandReader)
+TAGGED_PREFIX = re.compile(rb"#[^:\s]{1,32}:(\d{1,9}) ")
+
+def load_trace(path: str) -> tuple[dict, list]:
+    """Read a trace file into (header, [(t, conn, event, tag, size), ...])"""
+    with open(path, "rb") as f:
+        if f.readline() != MAGIC:
+            raise ValueError(f"{path} is not a trace file")
+        header = json.loads(f.readline())
+        data = f.read()
+
+    tags = header["tags"]
+    usable = len(data) - len(data) % RECORD.size
+    records = [(t, conn, event, tags[tag], size) for t, conn, event, tag, size in RECORD.iter_unpack(data[:usable])]
+    return header, records
+
+"""
+Per-connection frame recorder. When enabled, attach() wraps a connection's
+reader.read and writer.write so every read and write is noted as a fixed 18 byte
+record: when, which connection, direction, a tag and the size. Message contents
+are never stored. Records collect in memory and a background task appends them
+to the trace file once a second on a worker thread.
+"""
+class TraceRecorder:
+    def __init__(self) -> None:
+        self.path = None
+        self.protocol = None
+        self.started = 0.0
+        self.buffer = bytearray()
+        self.ids = itertools.count(1)
+        self.open: dict[asyncio.StreamWriter, int] = {}
+        self.records = 0
+        self._file = None
+        self._task = None
+        self._flush_lock = asyncio.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self._file is not None
+
+    def start(self, path: str, protocol: str) -> None:
+        """Open the trace file and start the flush task on the running loop"""
+        self.path = path
+        self.protocol = protocol
+        self.started = time.monotonic()
+        self._file = open(path, "wb")
+        header = {"version": 1, "protocol": protocol, "started": time.time(), "tags": TAGS}
+        self._file.write(MAGIC + json.dumps(header).encode() + b"\n")
+        self._task = asyncio.get_running_loop().create_task(self.run())
+        log.info("tracing connections", extra={"path": path})
+
+    async def stop(self) -> None:
+        """Write whatever is buffered and close the file"""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._file is not None:
+            await self.flush()
+            self._file.close()
+            self._file = None
+
+    def record(self, conn: int, event: int, tag: str, size: int) -> None:
+        self.buffer += RECORD.pack(time.monotonic() - self.started, conn, event, TAG_INDEX.get(tag, 0), size)
+        self.records += 1
+        if len(self.buffer) >= MAX_BUFFER:
+            asyncio.get_running_loop().create_task(self.flush())
+
+    async def flush(self) -> None:
+        """Hand the buffered records to a worker thread for writing"""
+        async with self._flush_lock:
+            if not self.buffer or self._file is None:
+                return
+            data, self.buffer = bytes(self.buffer), bytearray()
+            await asyncio.to_thread(self._write, data)
+
+    def _write(self, data: bytes) -> None:
+        self._file.write(data)
+        self._file.flush()
+
+    async def run(self) -> None:
+        """Flush loop"""
+        while True:
+            await asyncio.sleep(FLUSH_INTERVAL)
+            try:
+                await self.flush()
+            except OSError as e:
+                log.error("trace write failed", extra={"error": str(e)})
+
+    def attach(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """Start recording a connection's frames. Does nothing unless tracing is on."""
+        if not self.enabled:
+            return
+
+        conn = self.open[writer] = next(self.ids)
+        read, write = reader.read, writer.write
+        self.record(conn, OPEN, "", 0)
+
+        async def traced_read(n: int = -1) -> bytes:
+            data = await read(n)
+            if data:
+                self.record(conn, IN, inbound_tag(writer, data), len(data))
+            return data
+
+        def traced_write(data: bytes) -> None:
+            self.record(conn, OUT, outbound_tag(data), len(data))
+            write(data)
+
+        reader.read = traced_read
+        writer.write = traced_write
+
+    def detach(self, writer: asyncio.StreamWriter) -> None:
+        """Note that a connection closed"""
+        conn = self.open.pop(writer, None)
+        if conn is not None and self.enabled:
+            self.record(conn, CLOSE, "", 0)
+
+    def stats(self) -> dict:
+        """Snapshot of the recorder, for metrics"""
+        return {"enabled": self.enabled, "records": self.records, "buffered_bytes": len(self.buffer)}
+
+def inbound_tag(writer: asyncio.StreamWriter, data: bytes) -> str:
+    """
+    Command name of a client frame, or LOGIN while the client is still logging in.
+    Tagged commands are named by the command after their "#<id>:<length> " prefix.
+    """
+    conn = connections.connections.get(writer)
+    if conn is not None and not conn.authenticated:
+        return "LOGIN"
+    tagged = TAGGED_PREFIX.match(data)
+    if tagged:
+        data = data[tagged.end():tagged.end() + int(tagged.group(1))]
+    word = data[:16].split(b" ", 1)[0].strip().upper().decode(errors="replace")
+    return word if word in TAG_INDEX else "DATA"
+
+def outbound_tag(data: bytes) -> str:
+    """CODES value of a JSON protocol frame, TEXT for the plain text protocol"""
+    if data.startswith(b'{"code": "'):
+        end = data.find(b'"', 10)
+        return data[10:end].decode(errors="replace")
+    return "TEXT"
+
+# Shared recorder used by the server
+tracer = TraceRecorder()
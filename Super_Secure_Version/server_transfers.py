@@ -0,0 +1,303 @@
+# server_transfers.py - Relays encrypted files between users in chunks, spilling to disk
+import asyncio
+import os
+import re
+import secrets
+import tempfile
+import time
+from collections import deque
+from server_metrics import metrics
+from server_logging import get_logger
+
+log = get_logger("transfers")
+
+# Transfer policy
+SPOOL_DIR = None                        # Chunks that don't fit in memory go here, None for a private temp dir
+SPOOL_PREFIX = "chat-transfers-"        # Name prefix of that temp dir
+MAX_CHUNK = 40 * 1024                   # Largest piece per SENDFILE / RECVFILE (base64 stays under MAX_TAGGED_COMMAND)
+MAX_FILE_SIZE = 4 * 1024 ** 3
+MEMORY_WINDOW = 1024 * 1024             # Undelivered bytes one transfer may hold in memory
+MEMORY_LIMIT = 64 * 1024 * 1024         # Undelivered bytes all transfers together may hold in memory
+DISK_LIMIT = 8 * 1024 ** 3              # Bytes all spool files together may hold before senders are told to wait
+SENDER_DISK_LIMIT = 1024 ** 3           # Bytes the spool files of one sender's transfers may hold
+MAX_SENDER_TRANSFERS = 8                # Transfers one sender may have open at once
+TRANSFER_LIFETIME = 3600                # Seconds an idle transfer is kept for its sender or recipient to resume
+SWEEP_INTERVAL = 60
+
+# Spool files are named after their transfer id, and only files named like this are ever removed
+PART_RE = re.compile(r"[0-9a-f]{16}\.part\Z")
+
+bytes_in = metrics.counter("file_bytes_total", {"direction": "in"}, "File transfer bytes received from senders")
+bytes_out = metrics.counter("file_bytes_total", {"direction": "out"}, "File transfer bytes handed to recipients")
+bytes_spilled = metrics.counter("file_spilled_bytes_total", help="File transfer bytes written to the spool")
+
+"""
+Raised when a transfer can't take a chunk right now. offset is where the sender
+should carry on from once it retries.
+"""
+class TransferBusy(Exception):
+    def __init__(self, message: str, offset: int) -> None:
+        super().__init__(message)
+        self.offset = offset
+
+"""
+One file on its way from sender to recipient. The server only sees the bytes of
+an encrypted stream (crypto.stream) and the stream key sealed for the recipient
+(an encrypt_message JSON string).
+
+Bytes in [delivered, received) are waiting for the recipient: the ones below
+spill_from are chunks in memory, the rest are in the spool file, which starts at
+spill_from. Once the recipient has caught up the spool is emptied and new chunks
+go to memory again.
+"""
+class Transfer:
+    def __init__(self, transfer_id: str, sender: str, recipient: str, name: str, size: int, key: str, path: str) -> None:
+        self.id = transfer_id
+        self.sender = sender
+        self.recipient = recipient
+        self.name = name
+        self.size = size
+        self.key = key
+        self.path = path
+        self.received = 0
+        self.delivered = 0
+        self.chunks: deque[tuple[int, bytes]] = deque()
+        self.memory_bytes = 0
+        self.spill_from = None
+        self.spool = None
+        self.updated = time.monotonic()
+        self.started = None
+
+    def offer(self) -> dict:
+        """What the recipient is told about the transfer"""
+        return {"id": self.id, "from": self.sender, "name": self.name, "size": self.size, "key": self.key}
+
+    def spooled(self) -> int:
+        """Bytes in the spool file"""
+        return self.received - self.spill_from if self.spill_from is not None else 0
+
+"""
+Keeps every transfer in flight. Senders append chunks at the offset the transfer
+has reached and recipients read from the offset they have reached, so either side
+can reconnect and carry on where it stopped. Reading at an offset releases
+everything before it.
+
+Undelivered chunks stay in memory while the recipient is online and keeping up,
+up to MEMORY_WINDOW per transfer and MEMORY_LIMIT overall. Past that, or while the
+recipient is offline, they are appended to a spool file instead, so memory use
+does not grow with file size. Spool writes and reads are single pwrite/pread calls
+of at most MAX_CHUNK bytes, served from the page cache.
+
+One sender may have max_sender_transfers open and sender_disk_limit bytes spooled,
+so a single account can't take the whole spool. Spool files live in directory, or
+in a private temp dir made for this run if that is None.
+"""
+class TransferStore:
+    def __init__(self, directory: str | None = SPOOL_DIR, memory_window: int = MEMORY_WINDOW,
+                 memory_limit: int = MEMORY_LIMIT, disk_limit: int = DISK_LIMIT,
+                 lifetime: float = TRANSFER_LIFETIME, sender_disk_limit: int = SENDER_DISK_LIMIT,
+                 max_sender_transfers: int = MAX_SENDER_TRANSFERS) -> None:
+        self.directory = directory
+        self.memory_window = memory_window
+        self.memory_limit = memory_limit
+        self.disk_limit = disk_limit
+        self.lifetime = lifetime
+        self.sender_disk_limit = sender_disk_limit
+        self.max_sender_transfers = max_sender_transfers
+        self.transfers: dict[str, Transfer] = {}
+        self.memory_bytes = 0
+        self.disk_bytes = 0
+        # sender -> open transfers, and spool bytes of those transfers
+        self.sender_transfers: dict[str, int] = {}
+        self.sender_disk: dict[str, int] = {}
+        self._temp_directory = None
+        self._task = None
+
+        # Counters
+        self.opened = 0
+        self.completed = 0
+        self.expired = 0
+        self.busy = 0
+        self.completed_bytes = 0
+        self.completed_seconds = 0.0
+
+    def open(self, sender: str, recipient: str, name: str, size: int, key: str) -> Transfer:
+        """Start a transfer of size encrypted bytes"""
+        if not 0 < size <= MAX_FILE_SIZE:
+            raise ValueError(f"File size must be between 1 and {MAX_FILE_SIZE} bytes")
+        if recipient == sender:
+            raise ValueError("Can't send a file to yourself")
+        if self.sender_transfers.get(sender, 0) >= self.max_sender_transfers:
+            raise ValueError(f"At most {self.max_sender_transfers} transfers can be open at once")
+        transfer_id = secrets.token_hex(8)
+        path = os.path.join(self._spool_directory(), f"{transfer_id}.part")
+        transfer = self.transfers[transfer_id] = Transfer(transfer_id, sender, recipient, name, size, key, path)
+        self.sender_transfers[sender] = self.sender_transfers.get(sender, 0) + 1
+        self.opened += 1
+        log.info("transfer opened", extra={"user": sender, "transfer": transfer_id, "bytes": size})
+        return transfer
+
+    def get(self, transfer_id: str, username: str) -> Transfer:
+        """A transfer username is the sender or recipient of"""
+        transfer = self.transfers.get(transfer_id)
+        if transfer is None or username not in (transfer.sender, transfer.recipient):
+            raise ValueError(f"No transfer {transfer_id}")
+        return transfer
+
+    def pending_for(self, username: str) -> list[dict]:
+        """Offers of every transfer waiting for username"""
+        return [t.offer() for t in self.transfers.values() if t.recipient == username]
+
+    def write(self, transfer: Transfer, offset: int, data: bytes, recipient_online: bool) -> int:
+        """Append the chunk at offset, returns the offset the sender carries on from"""
+        if offset != transfer.received:
+            raise TransferBusy(f"Expected offset {transfer.received}", transfer.received)
+        if not data or len(data) > MAX_CHUNK or offset + len(data) > transfer.size:
+            raise ValueError(f"Chunk must be 1 to {MAX_CHUNK} bytes and end within the file")
+
+        if (transfer.spill_from is None and recipient_online
+                and transfer.memory_bytes + len(data) <= self.memory_window
+                and self.memory_bytes + len(data) <= self.memory_limit):
+            transfer.chunks.append((offset, data))
+            transfer.memory_bytes += len(data)
+            self.memory_bytes += len(data)
+        else:
+            if self.disk_bytes + len(data) > self.disk_limit:
+                self.busy += 1
+                raise TransferBusy("Spool full, try again later", transfer.received)
+            sender_disk = self.sender_disk.get(transfer.sender, 0)
+            if sender_disk + len(data) > self.sender_disk_limit:
+                self.busy += 1
+                raise TransferBusy("Your files are waiting on their recipients, try again later", transfer.received)
+            if transfer.spill_from is None:
+                transfer.spill_from = offset
+                transfer.spool = os.open(transfer.path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+            os.pwrite(transfer.spool, data, offset - transfer.spill_from)
+            self.disk_bytes += len(data)
+            self.sender_disk[transfer.sender] = sender_disk + len(data)
+            bytes_spilled.inc(len(data))
+
+        if transfer.started is None:
+            transfer.started = time.perf_counter()
+        transfer.received += len(data)
+        transfer.updated = time.monotonic()
+        bytes_in.inc(len(data))
+        return transfer.received
+
+    def read(self, transfer: Transfer, offset: int, limit: int = MAX_CHUNK) -> bytes:
+        """
+        Up to limit bytes at offset, empty if the sender hasn't got that far yet.
+        Everything before offset is released, and reading at the end completes the transfer.
+        """
+        if offset < transfer.delivered or offset > transfer.received:
+            raise ValueError(f"Offset must be between {transfer.delivered} and {transfer.received}")
+        self._release(transfer, offset)
+        transfer.updated = time.monotonic()
+        limit = min(limit, MAX_CHUNK)
+
+        if transfer.chunks:
+            start, data = transfer.chunks[0]
+            data = data[offset - start:offset - start + limit]
+        elif transfer.spill_from is not None and offset < transfer.received:
+            data = os.pread(transfer.spool, min(limit, transfer.received - offset), offset - transfer.spill_from)
+        else:
+            data = b""
+        bytes_out.inc(len(data))
+
+        if offset == transfer.size:
+            self._complete(transfer)
+        return data
+
+    def _release(self, transfer: Transfer, offset: int) -> None:
+        """Drop chunks the recipient has read, and empty the spool once it has caught up"""
+        transfer.delivered = offset
+        while transfer.chunks and transfer.chunks[0][0] + len(transfer.chunks[0][1]) <= offset:
+            _, data = transfer.chunks.popleft()
+            transfer.memory_bytes -= len(data)
+            self.memory_bytes -= len(data)
+        if transfer.spill_from is not None and offset == transfer.received:
+            self._drop_spool(transfer)
+
+    def _drop_spool(self, transfer: Transfer) -> None:
+        spooled = transfer.spooled()
+        self.disk_bytes -= spooled
+        if spooled:
+            remaining = self.sender_disk.get(transfer.sender, 0) - spooled
+            if remaining > 0:
+                self.sender_disk[transfer.sender] = remaining
+            else:
+                self.sender_disk.pop(transfer.sender, None)
+        transfer.spill_from = None
+        if transfer.spool is not None:
+            os.close(transfer.spool)
+            transfer.spool = None
+            os.remove(transfer.path)
+
+    def _complete(self, transfer: Transfer) -> None:
+        """The recipient has read everything"""
+        self.completed += 1
+        self.completed_bytes += transfer.size
+        if transfer.started is not None:
+            self.completed_seconds += time.perf_counter() - transfer.started
+        self.close(transfer)
+        log.info("transfer complete", extra={"user": transfer.recipient, "transfer": transfer.id, "bytes": transfer.size})
+
+    def close(self, transfer: Transfer) -> None:
+        """Forget a transfer and free what it holds"""
+        if self.transfers.pop(transfer.id, None) is not None:
+            remaining = self.sender_transfers.get(transfer.sender, 0) - 1
+            if remaining > 0:
+                self.sender_transfers[transfer.sender] = remaining
+            else:
+                self.sender_transfers.pop(transfer.sender, None)
+        self._release(transfer, transfer.received)
+        self._drop_spool(transfer)
+
+    def _spool_directory(self) -> str:
+        """Where spool files go, making the private temp dir on first use"""
+        if self.directory is None:
+            self._temp_directory = self.directory = tempfile.mkdtemp(prefix=SPOOL_PREFIX)
+        return self.directory
+
+    def start(self) -> None:
+        """Clear spool files left in the spool directory by a previous run and start the expiry sweep"""
+        if self._task is None or self._task.done():
+            if self.directory is not None and os.path.isdir(self.directory):
+                for entry in os.scandir(self.directory):
+                    if PART_RE.match(entry.name) and entry.is_file(follow_symlinks=False):
+                        os.remove(entry.path)
+            self._task = asyncio.get_running_loop().create_task(self.run())
+
+    def stop(self) -> None:
+        """Cancel the expiry sweep, drop every transfer and remove the temp dir if we made one"""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        for transfer in list(self.transfers.values()):
+            self.close(transfer)
+        if self._temp_directory is not None:
+            try:
+                os.rmdir(self._temp_directory)
+            except OSError as e:
+                log.warning("spool directory not removed", extra={"error": str(e)})
+            self.directory = self._temp_directory = None
+
+    async def run(self) -> None:
+        """Drop transfers nobody has touched for lifetime seconds"""
+        while True:
+            await asyncio.sleep(SWEEP_INTERVAL)
+            cutoff = time.monotonic() - self.lifetime
+            for transfer in [t for t in self.transfers.values() if t.updated < cutoff]:
+                self.expired += 1
+                self.close(transfer)
+                log.info("transfer expired", extra={"user": transfer.sender, "transfer": transfer.id})
+
+    def stats(self) -> dict:
+        """Snapshot of the transfer counters, with the average rate of completed transfers"""
+        return {"active": len(self.transfers), "opened": self.opened, "completed": self.completed,
+                "expired": self.expired, "busy": self.busy, "memory_bytes": self.memory_bytes,
+                "disk_bytes": self.disk_bytes, "senders": len(self.sender_transfers), "completed_bytes": self.completed_bytes,
+                "mb_per_s": self.completed_bytes / self.completed_seconds / 1e6 if self.completed_seconds else 0.0}
+
+# Shared transfer store used by the server modules
+transfers = TransferStore()
@@ -1,9 +1,14 @@
 # server_utils.py - Updated for secure messaging
 import asyncio
 from json_msg import CODES, msg
+from server_timers import connections
+from server_logging import get_logger
+
+log = get_logger("utils")
 
 BUFFER = 2048  # Increased buffer size
 MAX_WAIT_TIME = 240
+MAX_TAGGED_COMMAND = 64 * 1024   # Largest command accepted in a tagged frame
 
 """
 Representation of a User. Easier to pass around for args rather than all three things
@@ -14,6 +19,12 @@ class client:
         self.writer = writer
         self.username = username
         self.message_history = None
+        # Set once the client sends a tagged command, so it parses frames itself
+        self.tagged = False
+        # Version and fingerprint of the user's current public key, sent to peers so
+        # they can tell whether their cached copy is stale
+        self.key_version = 0
+        self.key_fingerprint = None
     def __str__(self) -> str:
         return self.username
 
@@ -27,37 +38,93 @@ async def get_user_input(prompt: str, reader: asyncio.StreamReader, writer: asyn
             # Send user prompt requesting user input with CODE
             await send_user_msg(prompt, CODES.WRITE_BACK, writer)
 
-            # Read User Response
-            data = await asyncio.wait_for(reader.read(BUFFER), timeout=MAX_WAIT_TIME)
+            # Read User Response. Timeouts are enforced by the connection manager sweep
+            data = await reader.read(BUFFER)
+            connections.touch(writer)
 
             # If nothing is data, raise exception
             if not data:
-               raise asyncio.exceptions.IncompleteReadError(bytes(0), BUFFER) 
+                if connections.is_expired(writer):
+                    raise asyncio.TimeoutError()
+                raise asyncio.exceptions.IncompleteReadError(bytes(0), BUFFER) 
             
            # If success break from the loop
             break
         except asyncio.exceptions.IncompleteReadError:
-            print("Client Sent Incomplete Data\n")
+            log.debug("client sent incomplete data")
             raise  # Re-raise to allow caller to handle
 
     # Return the decoded data str
     return data.decode().strip()
 
+"""
+Splits what a client sends into commands. Plain commands are one read each, as
+before. A command can also be tagged as "#<request id>:<length> <command>", which
+is framed by its length, so a client can pipeline several of them in one write
+and match each reply by its id.
+"""
+class CommandReader:
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.reader = reader
+        self.writer = writer
+        self.buffer = b""
+
+    def _take(self) -> tuple[str | None, bytes] | None:
+        """Cut the next command off the buffer, or None if a tagged one isn't complete yet"""
+        if not self.buffer.startswith(b"#"):
+            data, self.buffer = self.buffer, b""
+            return None, data
+
+        header_end = self.buffer.find(b" ")
+        if header_end == -1:
+            if len(self.buffer) > 64:
+                self.buffer = b""
+                raise ValueError("Malformed command tag")
+            return None
+
+        request_id, _, length = self.buffer[1:header_end].partition(b":")
+        if not length.isdigit() or int(length) > MAX_TAGGED_COMMAND:
+            self.buffer = b""
+            raise ValueError("Malformed command tag")
+
+        end = header_end + 1 + int(length)
+        if len(self.buffer) < end:
+            return None
+        command, self.buffer = self.buffer[header_end + 1:end], self.buffer[end:]
+        return request_id.decode(errors="replace"), command
+
+    async def next(self) -> tuple[str | None, bytes]:
+        """(request id or None, command). An empty command means the client went away."""
+        while True:
+            if self.buffer:
+                taken = self._take()
+                if taken is not None:
+                    return taken
+
+            data = await self.reader.read(BUFFER)
+            connections.touch(self.writer)
+            if not data:
+                return None, b""
+            self.buffer += data
+
 """
 Send the user a message with a code prompting the user what to do.
-Ensures proper JSON formatting of messages.
+Ensures proper JSON formatting of messages. Replies to tagged commands carry the
+request id and skip the pacing delay, since those clients split frames themselves.
 """
-async def send_user_msg(prompt: str, code: CODES, writer: asyncio.StreamWriter) -> None:
+async def send_user_msg(prompt: str, code: CODES, writer: asyncio.StreamWriter,
+                        request_id: str | None = None, pace: bool = True) -> None:
     try:
         # Create a properly formatted JSON message
-        json_to_send = msg(code.value, prompt)
+        json_to_send = msg(code.value, prompt, request_id)
         # Convert to JSON string and encode
         json_str = json_to_send.to_json_str()
         # Send the message
         writer.write(json_str.encode())
         await writer.drain()
         # Small delay to ensure message is sent completely
-        await asyncio.sleep(0.1)
+        if pace and request_id is None:
+            await asyncio.sleep(0.1)
     except Exception as e:
-        print(f"Error sending message: {str(e)}")
+        log.warning("send failed", extra={"error": str(e)})
         # Don't raise so server can continue operating
\ No newline at end of file
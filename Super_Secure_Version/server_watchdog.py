@@ -0,0 +1,122 @@
+# server_watchdog.py - Event loop lag monitor and slow callback detector
+import asyncio
+import sys
+import threading
+import time
+import traceback
+from collections import Counter as Tally, deque
+from server_metrics import metrics
+from server_logging import get_logger
+
+log = get_logger("watchdog")
+
+# Watchdog settings (seconds)
+PROBE_INTERVAL = 0.1            # How often the loop side wakes up to measure lag
+SLOW_CALLBACK_THRESHOLD = 0.1   # Stall length after which a stack sample is taken
+MAX_SAMPLES = 50                # Stack samples kept for /stats
+STACK_DEPTH = 25                # Frames kept per sample
+
+"""
+Two halves watching the same heartbeat. A task on the event loop sleeps PROBE_INTERVAL
+and records how late it woke up into the loop_lag_seconds histogram. A daemon thread
+checks the heartbeat that task leaves behind; if it goes stale for longer than the
+threshold the loop is stuck in a callback, so the thread grabs the loop thread's
+current stack with sys._current_frames(). That shows the blocking call (scrypt, RSA,
+SQLite, print...) while it is still running rather than after the fact.
+"""
+class LoopWatchdog:
+    def __init__(self, interval: float = PROBE_INTERVAL, threshold: float = SLOW_CALLBACK_THRESHOLD,
+                 max_samples: int = MAX_SAMPLES) -> None:
+        self.interval = interval
+        self.threshold = threshold
+
+        self.heartbeat = time.monotonic()
+        self.loop_thread_id = None
+        self.samples: deque[dict] = deque(maxlen=max_samples)
+        # "file:line function" of the innermost frame -> number of stalls caught there
+        self.hotspots: Tally = Tally()
+        self._sampled_beat = None
+        self._task = None
+        self._thread = None
+        self._stopping = threading.Event()
+
+        self.lag = metrics.histogram("loop_lag_seconds", help="How late the event loop ran a timer")
+        self.stalls = metrics.counter("loop_stalls_total", help="Callbacks that blocked the loop past the threshold")
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+
+    def start(self) -> None:
+        """Start the probe task on the running loop and the sampling thread"""
+        self.loop_thread_id = threading.get_ident()
+        self.heartbeat = time.monotonic()
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self.probe())
+        if self._thread is None or not self._thread.is_alive():
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self.watch, name="loop-watchdog", daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        """Cancel the probe and let the thread exit"""
+        self._stopping.set()
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def probe(self) -> None:
+        """Loop side: measure timer overshoot and refresh the heartbeat"""
+        while True:
+            started = self.heartbeat = time.monotonic()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, time.monotonic() - started - self.interval)
+            self.lag.record(int(lag * 1e9))
+            self.last_lag = lag
+            self.max_lag = max(self.max_lag, lag)
+
+            # Fill in how long the stall we sampled actually lasted
+            if lag > self.threshold and self.samples and self.samples[-1]["beat"] == started:
+                self.samples[-1]["blocked_seconds"] = lag
+
+    def watch(self) -> None:
+        """Thread side: sample the loop thread's stack whenever the heartbeat goes stale"""
+        while not self._stopping.wait(self.threshold / 2):
+            beat = self.heartbeat
+            stale = time.monotonic() - beat - self.interval
+            if stale > self.threshold and beat != self._sampled_beat:
+                self._sampled_beat = beat
+                self.sample(beat, stale)
+
+    def sample(self, beat: float, stale: float) -> None:
+        """Record the stack the loop thread is currently running"""
+        frame = sys._current_frames().get(self.loop_thread_id)
+        if frame is None:
+            return
+
+        stack = traceback.extract_stack(frame, limit=STACK_DEPTH)
+        top = stack[-1] if stack else None
+        where = f"{top.filename}:{top.lineno} {top.name}" if top else "unknown"
+        self.hotspots[where] += 1
+        self.stalls.inc()
+        self.samples.append({
+            "beat": beat,
+            "time": time.time(),
+            "blocked_seconds": stale,
+            "where": where,
+            "stack": traceback.format_list(stack),
+        })
+        log.warning("event loop blocked", extra={"ms": round(stale * 1000), "where": where})
+
+    def stats(self) -> dict:
+        """Lag figures, worst offenders and the latest stack samples"""
+        return {
+            "lag_seconds": self.last_lag,
+            "lag_max_seconds": self.max_lag,
+            "lag_p99_seconds": self.lag.percentile(99),
+            "stalls": self.stalls.value,
+            "threshold_seconds": self.threshold,
+            "hotspots": self.hotspots.most_common(10),
+            "samples": [{k: v for k, v in s.items() if k != "beat"} for s in list(self.samples)],
+        }
+
+# Shared watchdog used by the server
+watchdog = LoopWatchdog()
@@ -0,0 +1,290 @@
+# bench_versions.py - Compare what the security costs across the three server versions
+"""
+Starts Unsecure_Version, Secure_Version and Super_Secure_Version servers one at a time,
+each on a free port in a scratch directory with its own chat.db seeded with test users,
+and runs the same scripted workload against every one:
+
+    * every user connects and logs in with that version's protocol
+      (plaintext password, SHA-256 password, or RSA challenge + scrypt response)
+    * users are paired up and each sender sends --messages messages to its partner,
+      one at a time, waiting for each delivery
+
+and prints a table of login latency, message latency, server CPU per message and
+bytes on the wire, so every security change has a performance baseline.
+
+Super_Secure_Version is run as `server.py --json --load-test`, the JSON msg protocol
+the other two versions speak, with the per-IP limits lifted since every simulated
+client comes from this host. Server CPU is read from /proc (or psutil if installed).
+Unsecure_Version uses nested-quote f-strings and needs Python 3.12 or newer; on older
+interpreters its row reports the server's SyntaxError instead of numbers.
+
+Example:
+    python bench_versions.py --pairs 5 --messages 20 --json-out versions.json
+"""
+import argparse
+import asyncio
+import base64
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+SUPER_DIR = os.path.join(ROOT, "Super_Secure_Version")
+
+# The Super Secure client side needs its crypto package and frame reader
+sys.path.insert(0, SUPER_DIR)
+from crypto.key_management import generate_key_pair
+from crypto.encryption import encrypt_message, decrypt_message
+from loadgen import FrameReader, free_port, percentile
+from json_msg import CODES
+
+VERSIONS = ["Unsecure_Version", "Secure_Version", "Super_Secure_Version"]
+PASSWORD = "benchmark password 1"
+# Only characters the older versions' command parser accepts inside quotes
+PLAIN_MESSAGE = "The quick brown fox jumps over the lazy dog, again and again!"
+
+def scrypt_hash(password: str, salt: str) -> str:
+    """Same derivation as Super_Secure_Version/hash_utils.hash_password"""
+    return hashlib.scrypt(password.encode(), salt=bytes.fromhex(salt), n=16384, r=8, p=1, dklen=32).hex()
+
+def challenge_response(password_hash: str, challenge: str) -> str:
+    """Same as Super_Secure_Version/hash_utils.compute_challenge_response"""
+    return hashlib.sha256(bytes.fromhex(password_hash) + base64.b64decode(challenge)).hexdigest()
+
+def seed_database(version: str, workdir: str, usernames: list, public_key: bytes) -> None:
+    """Create chat.db in workdir with every benchmark user already registered"""
+    conn = sqlite3.connect(os.path.join(workdir, "chat.db"))
+    cur = conn.cursor()
+
+    if version == "Super_Secure_Version":
+        cur.execute("CREATE TABLE IF NOT EXISTS members (username TEXT PRIMARY KEY, password_hash TEXT NOT NULL, salt TEXT NOT NULL)")
+        cur.execute("CREATE TABLE IF NOT EXISTS public_keys (username TEXT PRIMARY KEY, public_key TEXT NOT NULL)")
+        for username in usernames:
+            salt = os.urandom(16).hex()
+            cur.execute("INSERT INTO members VALUES (?, ?, ?)", (username, scrypt_hash(PASSWORD, salt), salt))
+            cur.execute("INSERT INTO public_keys VALUES (?, ?)", (username, public_key.decode()))
+    else:
+        # Both older versions run init_database.sql from the working directory on startup
+        shutil.copy(os.path.join(ROOT, version, "init_database.sql"), workdir)
+        cur.execute("CREATE TABLE IF NOT EXISTS members (username TEXT PRIMARY KEY, password TEXT NOT NULL)")
+        for username in usernames:
+            password = PASSWORD if version == "Unsecure_Version" else hashlib.sha256(PASSWORD.encode()).hexdigest()
+            cur.execute("INSERT INTO members VALUES (?, ?)", (username, password))
+
+    conn.commit()
+    conn.close()
+
+def start_server(version: str, port: int, workdir: str, log) -> subprocess.Popen:
+    """Launch one version's server on port with workdir as its working directory"""
+    version_dir = os.path.join(ROOT, version)
+    if version == "Super_Secure_Version":
+        cmd = [sys.executable, os.path.join(version_dir, "server.py"), "--json", "--load-test",
+               "--host", "127.0.0.1", "--port", str(port)]
+    else:
+        # Older servers hardcode IP/PORT as module globals, so override them before main()
+        boot = (f"import sys; sys.path.insert(0, {version_dir!r}); import server; "
+                f"server.IP = '127.0.0.1'; server.PORT = {port}; server.main()")
+        cmd = [sys.executable, "-c", boot]
+    return subprocess.Popen(cmd, cwd=workdir, stdout=log, stderr=subprocess.STDOUT)
+
+async def wait_for_server(proc: subprocess.Popen, port: int, timeout: float = 15) -> None:
+    """Poll until the server accepts connections, or fail if it exits"""
+    deadline = time.monotonic() + timeout
+    while True:
+        if proc.poll() is not None:
+            raise RuntimeError(f"server exited with code {proc.returncode}")
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise RuntimeError("server did not start listening")
+            await asyncio.sleep(0.1)
+
+def cpu_seconds(pid: int) -> float | None:
+    """User + system CPU time used by a process so far"""
+    try:
+        import psutil
+        times = psutil.Process(pid).cpu_times()
+        return times.user + times.system
+    except ImportError:
+        pass
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return None
+
+"""
+One benchmark user speaking whichever version's protocol.
+"""
+class BenchClient:
+    def __init__(self, version: str, username: str, private_key: bytes) -> None:
+        self.version = version
+        self.username = username
+        self.private_key = private_key
+        self.frames = None
+        self.writer = None
+        self.bytes_out = 0
+
+    @property
+    def bytes_total(self) -> int:
+        return self.bytes_out + (self.frames.bytes_in if self.frames else 0)
+
+    async def send(self, text: str) -> None:
+        data = text.encode()
+        self.bytes_out += len(data)
+        self.writer.write(data)
+        await self.writer.drain()
+
+    async def login(self, port: int) -> None:
+        reader, self.writer = await asyncio.open_connection("127.0.0.1", port)
+        self.frames = FrameReader(reader, legacy=self.version != "Super_Secure_Version")
+
+        if self.version == "Super_Secure_Version":
+            await self.frames.expect(CODES.WRITE_BACK)
+            await self.send("1")
+            await self.frames.expect(CODES.WRITE_BACK)
+            await self.send(self.username)
+            challenge_msg = await self.frames.expect(CODES.WRITE_BACK)
+            challenge = decrypt_message(challenge_msg[len("CHALLENGE "):], self.private_key)
+            await self.send("GET_SALT")
+            salt = await self.frames.expect(CODES.SALT)
+            await self.send(challenge_response(scrypt_hash(PASSWORD, salt), challenge))
+            await self.frames.expect(CODES.TICKET)
+        else:
+            password = PASSWORD if self.version == "Unsecure_Version" else hashlib.sha256(PASSWORD.encode()).hexdigest()
+            await self.frames.expect(CODES.WRITE_BACK)
+            await self.send(self.username)
+            await self.frames.expect(CODES.WRITE_BACK)
+            await self.send(password)
+
+        await self.frames.expect(CODES.AUTHENTICATED)
+
+    def message_for(self, public_key: bytes) -> str:
+        """The SEND payload this version expects"""
+        if self.version == "Super_Secure_Version":
+            return encrypt_message(PLAIN_MESSAGE, public_key)
+        return f'"{PLAIN_MESSAGE}"'
+
+    async def close(self) -> None:
+        try:
+            await self.send("EXIT")
+            self.writer.close()
+            await self.writer.wait_closed()
+        except (ConnectionError, AttributeError):
+            pass
+
+async def run_workload(version: str, port: int, pid: int, pairs: int, messages: int,
+                       usernames: list, private_key: bytes, public_key: bytes) -> dict:
+    """Log everyone in, then have each sender message its partner"""
+    clients = [BenchClient(version, username, private_key) for username in usernames]
+
+    login_latencies = []
+    for client in clients:
+        started = time.perf_counter()
+        await client.login(port)
+        login_latencies.append(time.perf_counter() - started)
+    login_bytes = sum(c.bytes_total for c in clients)
+
+    # Older servers pause a second after login before reading commands
+    await asyncio.sleep(1.5)
+
+    message_latencies = []
+    bytes_before = sum(c.bytes_total for c in clients)
+    cpu_before = cpu_seconds(pid)
+
+    async def converse(sender: BenchClient, receiver: BenchClient) -> None:
+        for _ in range(messages):
+            payload = sender.message_for(public_key)
+            started = time.perf_counter()
+            await sender.send(f"SEND {payload} TO {receiver.username}")
+            await receiver.frames.expect(CODES.SUCCESS)
+            message_latencies.append(time.perf_counter() - started)
+            if version == "Super_Secure_Version":
+                await sender.frames.expect(CODES.SUCCESS)  # sender ack
+
+    await asyncio.gather(*(converse(clients[i], clients[i + pairs]) for i in range(pairs)))
+
+    cpu_after = cpu_seconds(pid)
+    total_messages = pairs * messages
+    message_bytes = sum(c.bytes_total for c in clients) - bytes_before
+    await asyncio.gather(*(c.close() for c in clients))
+
+    logins = sorted(login_latencies)
+    sends = sorted(message_latencies)
+    return {
+        "version": version,
+        "login_p50_ms": percentile(logins, 50) * 1000,
+        "login_p95_ms": percentile(logins, 95) * 1000,
+        "message_p50_ms": percentile(sends, 50) * 1000,
+        "message_p95_ms": percentile(sends, 95) * 1000,
+        "cpu_ms_per_message": ((cpu_after - cpu_before) / total_messages * 1000
+                               if cpu_before is not None and cpu_after is not None else None),
+        "bytes_per_login": login_bytes / len(clients),
+        "bytes_per_message": message_bytes / total_messages,
+    }
+
+async def bench_version(version: str, args, private_key: bytes, public_key: bytes) -> dict:
+    """Set up, run and tear down one version"""
+    usernames = [f"bench{i}" for i in range(args.pairs * 2)]
+    with tempfile.TemporaryDirectory() as workdir, open(os.path.join(workdir, "server.log"), "w+") as log:
+        seed_database(version, workdir, usernames, public_key)
+        port = free_port()
+        proc = start_server(version, port, workdir, log)
+        try:
+            await wait_for_server(proc, port)
+            return await asyncio.wait_for(
+                run_workload(version, port, proc.pid, args.pairs, args.messages, usernames, private_key, public_key),
+                timeout=args.timeout)
+        except Exception as e:
+            log.seek(0)
+            tail = log.read().strip().splitlines()[-3:]
+            return {"version": version, "error": f"{type(e).__name__}: {e}", "server_log": tail}
+        finally:
+            proc.terminate()
+            proc.wait()
+
+def print_table(results: list) -> None:
+    """Render results as a fixed-width table"""
+    columns = [("login p50 ms", "login_p50_ms"), ("login p95 ms", "login_p95_ms"),
+               ("msg p50 ms", "message_p50_ms"), ("msg p95 ms", "message_p95_ms"),
+               ("CPU ms/msg", "cpu_ms_per_message"), ("B/login", "bytes_per_login"),
+               ("B/msg", "bytes_per_message")]
+    print(f"{'version':<22}" + "".join(f"{title:>14}" for title, _ in columns))
+    for result in results:
+        if "error" in result:
+            print(f"{result['version']:<22}  failed: {result['error']}")
+            for line in result.get("server_log", []):
+                print(f"{'':<24}{line}")
+            continue
+        cells = "".join(f"{'n/a':>14}" if result[key] is None else f"{result[key]:>14.1f}" for _, key in columns)
+        print(f"{result['version']:<22}{cells}")
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark the Unsecure, Secure and Super Secure servers side by side")
+    parser.add_argument("--pairs", type=int, default=5, help="sender/receiver pairs")
+    parser.add_argument("--messages", type=int, default=20, help="messages per sender")
+    parser.add_argument("--versions", nargs="+", default=VERSIONS, choices=VERSIONS)
+    parser.add_argument("--timeout", type=float, default=600, help="seconds allowed per version")
+    parser.add_argument("--json-out", help="also write the results as JSON to this file")
+    args = parser.parse_args()
+
+    private_key, public_key = generate_key_pair()
+    results = [asyncio.run(bench_version(version, args, private_key, public_key)) for version in args.versions]
+
+    print_table(results)
+    if args.json_out:
+        with open(args.json_out, "w") as f:
+            json.dump({"pairs": args.pairs, "messages": args.messages, "results": results}, f, indent=2)
+
+if __name__ == "__main__":
+    main()